@@ -0,0 +1,186 @@
+import re
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterator, Optional
+import numpy as np
+from embeddingsdb import EmbeddingsDb
+
+
+@dataclass
+class AnswerCacheStats:
+    """
+    Counters of a SemanticAnswerCache
+    """
+    lookups: int = 0
+    hits: int = 0
+    stores: int = 0
+    evictions: int = 0
+    invalidations: int = 0
+
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups > 0 else 0.0
+
+    def __str__(self):
+        return f'{self.hits}/{self.lookups} hits ({self.hit_rate():.1%}), {self.stores} stored, ' \
+            f'{self.evictions} evicted, {self.invalidations} invalidated'
+
+
+@dataclass
+class CachedAnswer:
+    question: str
+    vector: np.ndarray
+    answer: str
+    created: float
+
+
+class SemanticAnswerCache:
+    """
+    Caches answers by the meaning of the question. A question is embedded
+    and compared (cosine similarity) with previously answered questions in
+    the same namespace (e.g. chain and model), if one is above threshold its
+    answer is reused. Entries expire after ttl seconds, the least recently
+    used entries are evicted above max_entries and everything is dropped
+    when the index generation changes. The answers of a namespace are also
+    dropped when the generation given with it changes, e.g. that of the
+    partition of the owner the namespace is for.
+    """
+    embeddings_db: EmbeddingsDb
+    threshold: float
+    ttl: float
+    max_entries: int
+    stats: AnswerCacheStats
+
+    def __init__(self,
+                 embeddings_db: EmbeddingsDb,
+                 threshold=0.95,
+                 ttl=24 * 3600,
+                 max_entries=1000,
+                 ):
+        """
+        Constructor
+        :param embeddings_db: Used to embed questions and to track the index generation.
+        :param threshold: Min cosine similarity for two questions to be the same.
+        :param ttl: Seconds an answer is reused.
+        :param max_entries: Max number of answers kept (per namespace).
+        """
+        self.embeddings_db = embeddings_db
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = AnswerCacheStats()
+
+        self._lock = threading.Lock()
+        self._namespaces: Dict[str, OrderedDict[str, CachedAnswer]] = {}
+        self._namespace_generations: Dict[str, int] = {}
+        self._generation = embeddings_db.generation
+
+    def lookup(self, namespace: str, question: str, generation=0) -> Optional[str]:
+        """
+        Gets the answer of a similar enough question
+        :param namespace: The namespace e.g. chain name and model
+        :param question: The question
+        :param generation: Of what the answers of the namespace depend on besides the index
+        :return: The cached answer or None
+        """
+        vector = self._embed(question)
+
+        with self._lock:
+            self.stats.lookups += 1
+            entries = self._entries(namespace, generation)
+
+            if len(entries) == 0:
+                return None
+
+            keys = list(entries.keys())
+            similarities = np.stack([entries[key].vector for key in keys]) @ vector
+            best = int(np.argmax(similarities))
+
+            if similarities[best] < self.threshold:
+                return None
+
+            entries.move_to_end(keys[best])
+            self.stats.hits += 1
+
+            return entries[keys[best]].answer
+
+    def store(self, namespace: str, question: str, answer: str, generation=0):
+        """
+        Stores the answer to a question
+        :param namespace: The namespace e.g. chain name and model
+        :param question: The question
+        :param answer: The answer
+        :param generation: Of what the answers of the namespace depend on besides the index
+        """
+        if len(answer.strip()) == 0:
+            return
+
+        vector = self._embed(question)
+
+        with self._lock:
+            # Answered from what has changed since
+            if generation < self._namespace_generations.get(namespace, generation):
+                return
+
+            entries = self._entries(namespace, generation)
+
+            entries[question] = CachedAnswer(question, vector, answer, time.time())
+            entries.move_to_end(question)
+            self.stats.stores += 1
+
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self.stats.invalidations += sum(len(entries) for entries in self._namespaces.values())
+            self._namespaces = {}
+
+    def _entries(self, namespace: str, generation: int) -> OrderedDict[str, CachedAnswer]:
+        """
+        Gets the live entries of a namespace, dropping expired ones, those of
+        the namespace if its generation has changed and everything if the
+        index has changed. Call with the lock held.
+        """
+        if self._generation != self.embeddings_db.generation:
+            self.stats.invalidations += sum(len(entries) for entries in self._namespaces.values())
+            self._namespaces = {}
+            self._generation = self.embeddings_db.generation
+
+        if self._namespace_generations.get(namespace, generation) != generation:
+            self.stats.invalidations += len(self._namespaces.pop(namespace, {}))
+
+        self._namespace_generations[namespace] = generation
+        entries = self._namespaces.setdefault(namespace, OrderedDict())
+        expired = [key for key, entry in entries.items() if time.time() - entry.created > self.ttl]
+
+        for key in expired:
+            del entries[key]
+
+        self.stats.evictions += len(expired)
+
+        return entries
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embeddings_db.embed(question), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+
+        return vector / norm if norm > 0 else vector
+
+
+def replay_tokens(answer: str) -> Iterator[str]:
+    """
+    Splits a cached answer into word tokens so it can be streamed like a
+    fresh completion.
+    :param answer: The answer
+    :return: Generator of tokens
+    """
+    for match in re.finditer(r"\s*\S+", answer):
+        yield match.group(0)
+
+    trailing = answer[len(answer.rstrip()):]
+
+    if len(trailing) > 0:
+        yield trailing
@@ -1,15 +1,21 @@
 import os
+import asyncio
 from dotenv import load_dotenv
 
 from chains.base import BaseChain
-from chain import setup_chain_from_chat_settings
-from index import system_index, user_index, add_file_to_user_index
+from chain import setup_chain_from_chat_settings, openai_clients
+from index import start_background_index
+from upload_indexer import UploadIndexer
 from embeddingsdb import EmbeddingsDb
+from embeddings_cache import CachedEmbeddings
+from partitions import session_owner as anonymous_owner
+from answer_cache import SemanticAnswerCache
 from chat_start import get_chat_settings, get_avatar, get_initial_messages
+from metrics import registry as metrics
+from turns import run_turn
 
 import chainlit as cl
 from langchain.embeddings import OpenAIEmbeddings
-from langchain.schema.runnable import RunnableConfig
 
 # Load environment variables from .env file
 load_dotenv()
@@ -24,22 +30,62 @@ user_file_path = os.path.join(os.path.dirname(__file__), "data", "user")
 if not os.path.exists(user_file_path):
     os.makedirs(user_file_path)
 
-# Embeddings
+# Embeddings, sharing the (pooled) HTTP clients of the chat models
+openai_client, openai_async_client = openai_clients()
+
 embeddings_db = EmbeddingsDb(
-    embeddings=OpenAIEmbeddings(openai_api_key=os.environ["OPENAI_API_KEY"]),
+    embeddings=CachedEmbeddings(
+        OpenAIEmbeddings(
+            openai_api_key=os.environ["OPENAI_API_KEY"],
+            client=openai_client.embeddings,
+            async_client=openai_async_client.embeddings,
+        ),
+    ),
+    search_type="hybrid",
+    # Threads searching the vectors and max number of retrievals in flight
+    search_workers=int(os.environ.get("CEOS_SEARCH_WORKERS", "4")),
+    async_queries=int(os.environ.get("CEOS_ASYNC_QUERIES", "16")),
+    backend=os.environ.get("CEOS_VECTOR_BACKEND", "chroma"),
+    quantization=os.environ.get("CEOS_VECTOR_QUANTIZATION") or None,
+    rescore=int(os.environ.get("CEOS_VECTOR_RESCORE", "4")),
+    # Uploads are only searched by their owner
+    partitions=True,
+)
+
+# Bring the index up to date in the background, queries are answered
+# from what is already indexed meanwhile
+index_status = start_background_index(
+    embeddings=embeddings_db,
+    # Uploads of sessions that are not authenticated are removed after a day
+    session_ttl=float(os.environ.get("CEOS_SESSION_UPLOAD_TTL_HOURS", "24")) * 3600,
+)
+
+# Uploaded files are indexed in the background, one at a time
+upload_indexer = UploadIndexer(embeddings_db)
+
+# Answers to (semantically) the same question are reused until the index changes
+answer_cache = SemanticAnswerCache(embeddings_db)
+
+# Tokens are streamed in frames, at most CEOS_STREAM_WINDOW_MS apart (0
+# sends each token on its own) or when CEOS_STREAM_FRAME_BYTES is reached
+stream_window_ms = float(os.environ.get("CEOS_STREAM_WINDOW_MS", "40"))
+stream_frame_bytes = int(os.environ.get("CEOS_STREAM_FRAME_BYTES", "512"))
+
+# Latency and token metrics of each turn: prometheus and/or jsonl, off by default
+metrics.configure(
+    os.environ.get("CEOS_METRICS", ""),
+    port=int(os.environ.get("CEOS_METRICS_PORT", "9464")),
 )
 
-# Make sure index is up to date
-system_index(embeddings=embeddings_db)
-user_index(embeddings=embeddings_db)
+
+# Tasks started by the sessions, kept until done (the event loop only keeps weak references)
+background_tasks = set()
 
 
 @cl.on_chat_start
 async def on_chat_start():
     settings = get_chat_settings()
-    chain = setup_chain_from_chat_settings(settings.settings(), embeddings_db)
-
-    cl.user_session.set("chain", chain.create())
+    cl.user_session.set("chain", setup_chain_from_chat_settings(settings.settings(), embeddings_db))
 
     await settings.send()
     await get_avatar(ceos_user).send()
@@ -47,24 +93,66 @@ async def on_chat_start():
     for message in get_initial_messages(ceos_user):
         await message.send()
 
+    if not index_status.is_ready():
+        await cl.Message(
+            content=f"I'm still indexing the knowledge base ({index_status}), "
+                    "answers may be incomplete until I'm done.",
+            author=ceos_user,
+        ).send()
+
+        task = asyncio.create_task(notify_when_indexed())
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+async def notify_when_indexed():
+    """
+    Tells a session that connected during startup indexing when it is done.
+    """
+    indexed = asyncio.Event()
+    loop = asyncio.get_running_loop()
+
+    # Set from the indexing thread
+    index_status.on_ready(lambda: loop.call_soon_threadsafe(indexed.set))
+
+    await indexed.wait()
+
+    await cl.Message(content=f"Indexing is {index_status}.", author=ceos_user).send()
+
+
+def session_owner() -> str:
+    """
+    The owner of what is uploaded in this session, the user when
+    authenticated, otherwise the session.
+    """
+    user = cl.user_session.get("user")
+
+    return user.username if user is not None else anonymous_owner(cl.user_session.get("id"))
+
 
 @cl.on_settings_update
 async def setup_agent(settings):
-    cl.user_session.set(
-        "chain", setup_chain_from_chat_settings(settings, embeddings_db).create(),
-    )
+    cl.user_session.set("chain", setup_chain_from_chat_settings(settings, embeddings_db))
 
 
 @cl.on_message
 async def on_message(message: cl.Message):
-    for element in message.elements:
-        if isinstance(element, cl.File):
-            file = element
+    files = [element for element in message.elements if isinstance(element, cl.File)]
+
+    if len(files) > 0:
+        jobs = [upload_indexer.submit(file.name, file.content, owner=session_owner()) for file in files]
 
-            await cl.Message(content=f"Processing `{file.name}`...").send()
-            add_file_to_user_index(file.name, embeddings_db, file.content)
-            await cl.Message(content="...done!").send()
-            return
+        for job in jobs:
+            msg = cl.Message(content=f"Processing `{job.file_name}`...")
+            await msg.send()
+
+            async for progress in job.progress():
+                msg.content += f"\n* {progress}"
+                await msg.update()
+
+            await cl.Message(content="...done!" if await job.result() else "...failed!").send()
+
+        return
 
     # Get the current chain
     chain = cl.user_session.get("chain")  # type: BaseChain
@@ -78,17 +166,15 @@ async def on_message(message: cl.Message):
     msg = cl.Message(content="", author=ceos_user)
     await msg.send()
 
-    async for chunk in chain.chain().astream(
-        input=chain.before({
-            "question": message.content,
-        }),
-        config=RunnableConfig(callbacks=[cl.LangchainCallbackHandler()]),
-    ):
-        chunk = chain.chunk(chunk)
-        output = chain.get_output(chunk)
-
-        await msg.stream_token(token=output)
-
-    chain.after(msg.content)
+    await run_turn(
+        chain,
+        message.content,
+        owner=session_owner(),
+        stream_token=msg.stream_token,
+        answer_cache=answer_cache,
+        callbacks=[cl.LangchainCallbackHandler()],
+        stream_window=stream_window_ms / 1000 if stream_window_ms > 0 else None,
+        stream_bytes=stream_frame_bytes,
+    )
 
     await msg.update()
@@ -0,0 +1,90 @@
+from abc import ABC, abstractmethod
+from typing import List, NamedTuple, Optional, Set, Tuple
+from langchain.docstore.document import Document
+
+
+class SearchHit(NamedTuple):
+    """
+    A chunk found by a VectorBackend
+    """
+    chunk_id: str
+    doc: Document
+    # Higher is better
+    score: float
+    # Only set when the search was asked to include the vectors
+    vector: Optional[List[float]] = None
+
+
+class VectorBackend(ABC):
+    """
+    Storage and nearest neighbour search of the chunk vectors behind an
+    EmbeddingsDb. Backends never embed, they are handed the vectors.
+    """
+
+    @abstractmethod
+    def upsert(self, ids: List[str], vectors: List[List[float]], docs: List[Document]):
+        """
+        Adds or replaces chunks
+        :param ids: The chunk ids
+        :param vectors: The embeddings, one per chunk
+        :param docs: The chunks
+        """
+
+    @abstractmethod
+    def delete(self, ids: List[str]):
+        """
+        Removes chunks, unknown ids are ignored
+        :param ids: The chunk ids
+        """
+
+    @abstractmethod
+    def search(self, vector: List[float], k: int, include_vectors=False, ids: Set[str] = None,
+               where: dict = None) -> List[SearchHit]:
+        """
+        Gets the k nearest chunks
+        :param vector: The query embedding
+        :param k: Max number of chunks
+        :param include_vectors: If the stored vectors shall be returned (e.g. for mmr)
+        :param ids: Only search among these chunks (only these are scanned)
+        :param where: Optionally the same chunks as ids as a Chroma where clause on the
+                      metadata, backends that filter natively may use it instead of ids
+        :return: List of hits, best first
+        """
+
+    def search_many(self, vectors: List[List[float]], k: int, include_vectors=False,
+                    ids: Set[str] = None, where: dict = None) -> List[List[SearchHit]]:
+        """
+        Gets the k nearest chunks of each query, backends override this to
+        search all queries at once
+        :param vectors: The query embeddings
+        :param k: Max number of chunks per query
+        :param include_vectors: If the stored vectors shall be returned (e.g. for mmr)
+        :param ids: Only search among these chunks (only these are scanned)
+        :param where: Optionally the same chunks as ids as a where clause (see search)
+        :return: List of hits (best first) per query, in the order of vectors
+        """
+        return [self.search(vector, k, include_vectors=include_vectors, ids=ids, where=where) for vector in vectors]
+
+    @abstractmethod
+    def get_all(self) -> Tuple[List[str], List[Document]]:
+        """
+        Gets all stored chunks
+        :return: The chunk ids and the chunks
+        """
+
+    @abstractmethod
+    def count(self) -> int:
+        """
+        Number of stored chunks
+        """
+
+    @abstractmethod
+    def clear(self):
+        """
+        Removes all chunks
+        """
+
+    def close(self):
+        """
+        Releases open files, the backend cannot be used afterwards
+        """
@@ -0,0 +1,151 @@
+import chromadb.config
+from typing import List, Set, Tuple
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.vectorstores.chroma import Chroma
+from backends.base import SearchHit, VectorBackend
+
+
+class ChromaBackend(VectorBackend):
+    """
+    Persistent Chroma collection (the default backend). It is searched from
+    many threads at once (the search threads of EmbeddingsDb), the segments
+    of the collection lock themselves. A search is not isolated from a
+    concurrent delete though, the chunks deleted meanwhile are dropped from
+    its hits. Telemetry is turned off.
+
+    A search among selected chunks scores small selections itself (they are
+    fetched by id), larger ones are filtered by Chroma with the where clause
+    of the selection.
+    """
+    chroma: Chroma
+    persist_directory: str
+    id_scan_limit: int
+
+    def __init__(self, persist_directory: str, id_scan_limit=200):
+        """
+        Constructor
+        :param persist_directory: The directory Chroma persists the collection in.
+        :param id_scan_limit: Max number of selected chunks that are fetched and
+                              scored by id, when the search has a where clause.
+        """
+        self.persist_directory = persist_directory
+        self.id_scan_limit = id_scan_limit
+        self.chroma = self._open()
+
+    def upsert(self, ids: List[str], vectors: List[List[float]], docs: List[Document]):
+        self.chroma._collection.upsert(
+            ids=ids,
+            embeddings=vectors,
+            metadatas=[doc.metadata or None for doc in docs],
+            documents=[doc.page_content for doc in docs],
+        )
+
+    def delete(self, ids: List[str]):
+        self.chroma.delete(ids=ids)
+
+    def search(self, vector: List[float], k: int, include_vectors=False, ids: Set[str] = None,
+               where: dict = None) -> List[SearchHit]:
+        return self.search_many([vector], k, include_vectors=include_vectors, ids=ids, where=where)[0]
+
+    def search_many(self, vectors: List[List[float]], k: int, include_vectors=False,
+                    ids: Set[str] = None, where: dict = None) -> List[List[SearchHit]]:
+        if ids is not None and (where is None or len(ids) <= self.id_scan_limit):
+            return self._search_ids(vectors, k, include_vectors, ids)
+
+        k = min(k, self.count() if ids is None else len(ids))
+
+        if k == 0:
+            return [[] for _ in vectors]
+
+        include = ["documents", "metadatas", "distances"]
+
+        if include_vectors:
+            include.append("embeddings")
+
+        # One request for all queries
+        result = self.chroma._collection.query(
+            query_embeddings=list(vectors), n_results=k, where=where, include=include)
+
+        return [
+            [
+                SearchHit(
+                    chunk_id=chunk_id,
+                    doc=Document(page_content=text, metadata=metadata or {}),
+                    score=1.0 / (1.0 + distance),
+                    vector=stored,
+                )
+                for chunk_id, text, metadata, distance, stored in zip(
+                    result["ids"][query],
+                    result["documents"][query],
+                    result["metadatas"][query],
+                    result["distances"][query],
+                    result["embeddings"][query] if include_vectors else [None] * len(result["ids"][query]),
+                )
+                # Deleted while it was searched
+                if text is not None
+            ]
+            for query in range(len(vectors))
+        ]
+
+    def _search_ids(self, vectors: List[List[float]], k: int, include_vectors: bool, ids: Set[str],
+                    batch_size=1000) -> List[List[SearchHit]]:
+        """
+        Scores only the given chunks (same squared l2 distance as the
+        collection), they are fetched once for all queries
+        """
+        queries = np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1)
+        ids = sorted(ids)
+        hits: List[List[SearchHit]] = [[] for _ in vectors]
+
+        for offset in range(0, len(ids), batch_size):
+            stored = self.chroma._collection.get(
+                ids=ids[offset:offset + batch_size],
+                include=["embeddings", "documents", "metadatas"],
+            )
+
+            if len(stored["ids"]) == 0:
+                continue
+
+            matrix = np.asarray(stored["embeddings"], dtype=np.float32)
+            distances = (queries ** 2).sum(axis=1)[:, None] - 2 * queries @ matrix.T + (matrix ** 2).sum(axis=1)[None, :]
+
+            for query_hits, query_distances in zip(hits, distances):
+                # Only the k best of each batch can be among the k best overall
+                for position in np.argsort(query_distances, kind="stable")[:k].tolist():
+                    # Deleted while it was fetched
+                    if stored["documents"][position] is None:
+                        continue
+
+                    query_hits.append(SearchHit(
+                        chunk_id=stored["ids"][position],
+                        doc=Document(page_content=stored["documents"][position],
+                                     metadata=dict(stored["metadatas"][position] or {})),
+                        score=1.0 / (1.0 + max(0.0, float(query_distances[position]))),
+                        vector=stored["embeddings"][position] if include_vectors else None,
+                    ))
+
+        return [sorted(query_hits, key=lambda hit: hit.score, reverse=True)[:k] for query_hits in hits]
+
+    def get_all(self) -> Tuple[List[str], List[Document]]:
+        stored = self.chroma.get(include=["documents", "metadatas"])
+
+        return stored["ids"], [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(stored["documents"], stored["metadatas"])
+        ]
+
+    def count(self) -> int:
+        return self.chroma._collection.count()
+
+    def clear(self):
+        # The client keeps the files open, drop the collection rather than
+        # deleting them
+        self.chroma.delete_collection()
+        self.chroma = self._open()
+
+    def _open(self) -> Chroma:
+        return Chroma(
+            persist_directory=self.persist_directory,
+            client_settings=chromadb.config.Settings(is_persistent=True, anonymized_telemetry=False),
+        )
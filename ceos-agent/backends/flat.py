@@ -0,0 +1,658 @@
+import os
+import json
+import shutil
+import threading
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+import numpy as np
+from langchain.docstore.document import Document
+from backends.base import SearchHit, VectorBackend
+from journal import Journal
+
+
+# Compressed forms the vectors can be searched in, see FlatBackend
+quantizations = ("float16", "int8")
+
+
+class MatrixFile:
+    """
+    A matrix in a memory-mapped file that grows (doubling) as rows are added
+    """
+    file_path: str
+    dtype: np.dtype
+    columns: int
+    capacity: int
+    data: Optional[np.memmap]
+
+    def __init__(self, file_path: str, dtype, columns: int):
+        """
+        Constructor, opens the file if it exists
+        :param file_path: The file
+        :param dtype: Type of the elements
+        :param columns: Number of columns
+        """
+        self.file_path = file_path
+        self.dtype = np.dtype(dtype)
+        self.columns = columns
+        self.capacity = 0
+        self.data = None
+
+        if os.path.exists(file_path):
+            self.capacity = os.path.getsize(file_path) // (self.dtype.itemsize * columns)
+            self.data = np.memmap(file_path, dtype=self.dtype, mode="r+", shape=(self.capacity, columns))
+
+    def reserve(self, rows: int, used: int, initial_capacity: int):
+        """
+        Grows the file so that it holds at least rows
+        :param rows: Number of rows needed
+        :param used: Number of rows in use (copied to the new file)
+        :param initial_capacity: Min number of rows to allocate
+        """
+        if rows <= self.capacity:
+            return
+
+        capacity = max(initial_capacity, self.capacity * 2, rows)
+
+        os.makedirs(os.path.dirname(self.file_path), exist_ok=True)
+
+        tmp_path = self.file_path + ".tmp"
+        data = np.memmap(tmp_path, dtype=self.dtype, mode="w+", shape=(capacity, self.columns))
+
+        if self.data is not None:
+            data[:used] = self.data[:used]
+
+        data.flush()
+        del data
+
+        self.close()
+        os.replace(tmp_path, self.file_path)
+
+        self.capacity = capacity
+        self.data = np.memmap(self.file_path, dtype=self.dtype, mode="r+", shape=(capacity, self.columns))
+
+    def flush(self):
+        if self.data is not None:
+            self.data.flush()
+
+    def close(self):
+        self.flush()
+        self.data = None
+
+
+class MatrixView(NamedTuple):
+    """
+    What a search of a FlatBackend scores, taken with the lock held and
+    scored without it
+    """
+    # Of the backend when taken, the search is done again if it has changed
+    generation: int
+    # The rows to scan, None for the first count
+    rows: Optional[np.ndarray]
+    count: int
+    # None if no float32 copy is kept (rescore 0)
+    matrix: Optional[np.memmap]
+    codes: Optional[np.memmap]
+    scales: Optional[np.memmap]
+
+
+class FlatBackend(VectorBackend):
+    """
+    In-process exact search for small corpora (thousands of chunks).
+
+    The normalized vectors are rows of a float32 matrix in a memory-mapped
+    file, the ids, texts and metadata are kept in a side-car JSON table
+    with the same row order. A query is one matrix-vector product (cosine
+    similarity) and a partial sort (argpartition) of the scores. Deleted
+    rows are filled with the last row, so rows [0, count) are always live.
+    Changes to the table are appended to a log (see Journal) and the table
+    is only rewritten once the log has grown larger than it.
+
+    With quantization, a float16 or int8 (with a per-vector scale) copy of
+    the matrix is scanned instead and only the rescore * k best candidates
+    are scored exactly against the float32 rows, so only the compressed
+    matrix needs to be kept in memory. The float32 matrix stays on disk,
+    i.e. the disk grows by the compressed copy, unless rescore is 0: then
+    no float32 copy is kept and the results are ranked by the compressed
+    scores.
+    """
+    index_path: str
+    quantization: Optional[str]
+    rescore: int
+    dims: Optional[int]
+    ids: List[str]
+    docs: List[dict]
+    rows: Dict[str, int]
+    matrix: Optional[MatrixFile]
+    codes: Optional[MatrixFile]
+    scales: Optional[MatrixFile]
+    journal: Journal
+    # Bumped by each write, see search_many
+    generation: int
+
+    def __init__(self, index_path: str, initial_capacity=1024, quantization: str = None, rescore=4):
+        """
+        Constructor
+        :param index_path: The directory where the matrix and the table are persisted.
+        :param initial_capacity: Number of rows allocated for the first vectors,
+                                 the file is doubled when full.
+        :param quantization: None (search the float32 vectors), float16 or int8
+        :param rescore: With quantization, number of candidates per result
+                        that are scored exactly, 0 to keep no float32 copy
+                        of the vectors (not re-scored, less disk).
+        """
+        if quantization is not None and quantization not in quantizations:
+            raise ValueError(f"Unknown quantization: {quantization}, expected one of {', '.join(quantizations)}")
+
+        if rescore < 0 or (rescore == 0 and quantization is None):
+            raise ValueError(f"Expected a rescore of at least {0 if quantization else 1}, got {rescore}")
+
+        self.index_path = index_path
+        self.initial_capacity = initial_capacity
+        self.quantization = quantization
+        self.rescore = rescore
+        self.dims = None
+        self.ids = []
+        self.docs = []
+        self.rows = {}
+        self.matrix = None
+        self.codes = None
+        self.scales = None
+        self.generation = 0
+        self.journal = Journal(os.path.join(index_path, "table.log"))
+
+        self._lock = threading.RLock()
+
+        stored_quantization = None
+        stored_float32 = True
+
+        if os.path.exists(self.table_path()):
+            with open(self.table_path(), "r") as f:
+                table = json.load(f)
+
+            self.dims = table["dims"]
+            self.ids = table["ids"]
+            self.docs = table["docs"]
+            self.rows = {chunk_id: row for row, chunk_id in enumerate(self.ids)}
+            stored_quantization = table.get("quantization")
+            stored_float32 = table.get("float32", True)
+
+            # The matrix rows were moved before a change was logged
+            for change in self.journal.replay():
+                for chunk_id in change.get("delete", []):
+                    self._remove_row(chunk_id)
+
+                upsert = change.get("upsert", {})
+
+                for chunk_id, doc in zip(upsert.get("ids", []), upsert.get("docs", [])):
+                    self.docs[self._row(chunk_id)] = doc
+
+        if self.dims is not None:
+            if not stored_float32 and (stored_quantization != quantization or self.keeps_float32()):
+                raise ValueError(f"{index_path} was stored without float32 vectors (rescore 0) and "
+                                 f"{stored_quantization} quantization, clear and re-index it to change that")
+
+            self._open_files()
+
+            # Stored without (or with another) quantization, encode from the float32 rows
+            if quantization is not None and stored_quantization != quantization:
+                source = MatrixFile(self.matrix_path(), np.float32, self.dims)
+                self._encode(np.arange(len(self.ids)), source.data[:len(self.ids)])
+                source.close()
+
+            # The float32 copy is no longer kept (or updated), drop it
+            if stored_float32 and not self.keeps_float32():
+                if os.path.exists(self.matrix_path()):
+                    os.remove(self.matrix_path())
+
+            if stored_quantization != quantization or stored_float32 != self.keeps_float32():
+                self.save()
+
+    def keeps_float32(self) -> bool:
+        """
+        :return: True if the float32 vectors are kept, i.e. unless rescore is 0
+        """
+        return self.quantization is None or self.rescore > 0
+
+    def matrix_path(self) -> str:
+        return os.path.join(self.index_path, "vectors.f32")
+
+    def codes_path(self) -> str:
+        return os.path.join(self.index_path, f"vectors.{self.quantization}")
+
+    def scales_path(self) -> str:
+        return os.path.join(self.index_path, "scales.f32")
+
+    def table_path(self) -> str:
+        return os.path.join(self.index_path, "table.json")
+
+    def upsert(self, ids: List[str], vectors: List[List[float]], docs: List[Document]):
+        if len(ids) == 0:
+            return
+
+        vectors = normalize(np.asarray(vectors, dtype=np.float32))
+
+        with self._lock:
+            self.generation += 1
+            created = self.dims is None
+
+            if created:
+                self.dims = vectors.shape[1]
+                self._open_files()
+            elif vectors.shape[1] != self.dims:
+                raise ValueError(f"Expected vectors with {self.dims} dimensions, got {vectors.shape[1]}")
+
+            added = sum(1 for chunk_id in set(ids) if chunk_id not in self.rows)
+            self._reserve(len(self.ids) + added)
+
+            table_docs = [{"text": doc.page_content, "metadata": dict(doc.metadata)} for doc in docs]
+
+            rows = np.array([self._row(chunk_id) for chunk_id in ids], dtype=np.int64)
+
+            for row, doc in zip(rows.tolist(), table_docs):
+                self.docs[row] = doc
+
+            if self.matrix is not None:
+                self.matrix.data[rows] = vectors
+
+            if self.quantization is not None:
+                self._encode(rows, vectors)
+
+            # The log needs a table (with the dimensions) to be replayed on
+            if created:
+                self.save()
+            else:
+                self._log({"upsert": {"ids": list(ids), "docs": table_docs}})
+
+    def delete(self, ids: List[str]):
+        with self._lock:
+            self.generation += 1
+            deleted: List[str] = []
+
+            for chunk_id in ids:
+                moved = self._remove_row(chunk_id)
+
+                if moved is None:
+                    continue
+
+                row, last = moved
+
+                if row != last:
+                    for matrix in self._files():
+                        matrix.data[row] = matrix.data[last]
+
+                deleted.append(chunk_id)
+
+            if len(deleted) > 0:
+                self._log({"delete": deleted})
+
+    def search(self, vector: List[float], k: int, include_vectors=False, ids: Set[str] = None,
+               where: dict = None) -> List[SearchHit]:
+        return self.search_many([vector], k, include_vectors=include_vectors, ids=ids)[0]
+
+    def search_many(self, vectors: List[List[float]], k: int, include_vectors=False,
+                    ids: Set[str] = None, where: dict = None, block_size=256) -> List[List[SearchHit]]:
+        """
+        Scores block_size queries at a time with one matrix product and
+        takes the top k of each row (the selected rows are looked up by
+        id, where is not needed). The scoring is done without the lock (on
+        the memory maps of when the search started), the search is done
+        again holding the lock if the backend was written to meanwhile.
+        """
+        queries = normalize(np.asarray(vectors, dtype=np.float32).reshape(len(vectors), -1))
+
+        with self._lock:
+            view = self._view(ids)
+
+        if view is None:
+            return [[] for _ in queries]
+
+        # Scored without the lock, so that searches run in parallel
+        ranked = self._rank(queries, k, view, block_size)
+
+        with self._lock:
+            # Written to while it was scored, score again holding the lock
+            if view.generation != self.generation:
+                view = self._view(ids)
+
+                if view is None:
+                    return [[] for _ in queries]
+
+                ranked = self._rank(queries, k, view, block_size)
+
+            return [self._hits(best, scores, include_vectors) for best, scores in ranked]
+
+    def get_all(self) -> Tuple[List[str], List[Document]]:
+        with self._lock:
+            return list(self.ids), [
+                Document(page_content=doc["text"], metadata=dict(doc["metadata"] or {}))
+                for doc in self.docs
+            ]
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def clear(self):
+        with self._lock:
+            self.close()
+
+            if os.path.exists(self.index_path):
+                shutil.rmtree(self.index_path)
+
+            self.journal.truncate()
+            self.generation += 1
+            self.dims = None
+            self.ids = []
+            self.docs = []
+            self.rows = {}
+
+    def close(self):
+        with self._lock:
+            # Write the logged changes to the table, so the next start does not replay them
+            if self.dims is not None and len(self.journal) > 0:
+                self.save()
+
+            for matrix in self._files():
+                matrix.close()
+
+            self.generation += 1
+            self.matrix = None
+            self.codes = None
+            self.scales = None
+
+    def disk_bytes(self) -> int:
+        """
+        Bytes of the matrix files (allocated rows included) and the table
+        """
+        paths = [matrix.file_path for matrix in self._files()] + [self.table_path(), self.journal.log_path]
+
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    def memory_bytes(self) -> int:
+        """
+        Bytes of the matrix that is scanned by a search (i.e. what needs to
+        stay in memory to avoid paging)
+        """
+        if self.dims is None:
+            return 0
+
+        if self.quantization is None:
+            return len(self.ids) * self.dims * 4
+
+        return len(self.ids) * (self.dims * self.codes.dtype.itemsize + (4 if self.scales is not None else 0))
+
+    def save(self):
+        """
+        Flushes the matrix and persists the table (atomically replaces the
+        previous one), the log is truncated
+        """
+        with self._lock:
+            for matrix in self._files():
+                matrix.flush()
+
+            tmp_path = self.table_path() + ".tmp"
+
+            with open(tmp_path, "w") as f:
+                json.dump({
+                    "dims": self.dims,
+                    "quantization": self.quantization,
+                    "float32": self.keeps_float32(),
+                    "ids": self.ids,
+                    "docs": self.docs,
+                }, f)
+
+            os.replace(tmp_path, self.table_path())
+            self.journal.truncate()
+
+    def _log(self, change: dict):
+        """
+        Flushes the matrix and persists a change of the table by appending
+        it to the log, the table is rewritten when the log is due
+        """
+        for matrix in self._files():
+            matrix.flush()
+
+        self.journal.append(change)
+
+        if self.journal.due(self.table_path()):
+            self.save()
+
+    def _row(self, chunk_id: str) -> int:
+        """
+        Gets the row of a chunk, a new row at the end if it has none
+        """
+        row = self.rows.get(chunk_id)
+
+        if row is None:
+            row = len(self.ids)
+            self.rows[chunk_id] = row
+            self.ids.append(chunk_id)
+            self.docs.append({})
+
+        return row
+
+    def _remove_row(self, chunk_id: str) -> Optional[Tuple[int, int]]:
+        """
+        Removes a chunk from the table by moving the last row into its row,
+        the caller moves the matrix rows
+        :return: The (row, last row) or None if the chunk is not stored
+        """
+        row = self.rows.pop(chunk_id, None)
+
+        if row is None:
+            return None
+
+        last = len(self.ids) - 1
+
+        if row != last:
+            self.ids[row] = self.ids[last]
+            self.docs[row] = self.docs[last]
+            self.rows[self.ids[row]] = row
+
+        self.ids.pop()
+        self.docs.pop()
+
+        return row, last
+
+    def _open_files(self):
+        if self.keeps_float32():
+            self.matrix = MatrixFile(self.matrix_path(), np.float32, self.dims)
+
+        if self.quantization == "float16":
+            self.codes = MatrixFile(self.codes_path(), np.float16, self.dims)
+        elif self.quantization == "int8":
+            self.codes = MatrixFile(self.codes_path(), np.int8, self.dims)
+            self.scales = MatrixFile(self.scales_path(), np.float32, 1)
+
+    def _files(self) -> List[MatrixFile]:
+        return [matrix for matrix in [self.matrix, self.codes, self.scales] if matrix is not None]
+
+    def _reserve(self, rows: int):
+        """
+        Grows the matrix files so that they hold at least rows
+        """
+        for matrix in self._files():
+            matrix.reserve(rows, len(self.ids), self.initial_capacity)
+
+    def _encode(self, rows: np.ndarray, vectors: np.ndarray):
+        """
+        Writes the compressed form of the (normalized) vectors of the rows
+        """
+        if len(rows) == 0:
+            return
+
+        self._reserve(len(self.ids))
+
+        if self.quantization == "float16":
+            self.codes.data[rows] = vectors.astype(np.float16)
+        else:
+            scales = np.abs(vectors).max(axis=1, keepdims=True) / 127.0
+            scales = np.where(scales > 0, scales, 1.0)
+
+            self.codes.data[rows] = np.round(vectors / scales).astype(np.int8)
+            self.scales.data[rows] = scales
+
+    def _hits(self, rows: np.ndarray, scores: np.ndarray, include_vectors: bool) -> List[SearchHit]:
+        return [
+            SearchHit(
+                chunk_id=self.ids[row],
+                doc=Document(
+                    page_content=self.docs[row]["text"],
+                    metadata=dict(self.docs[row]["metadata"] or {}),
+                ),
+                score=score,
+                vector=self._vector(row).tolist() if include_vectors else None,
+            )
+            for row, score in zip(rows.tolist(), scores.tolist())
+        ]
+
+    def _vector(self, row: int) -> np.ndarray:
+        """
+        The vector of a row, decoded from the compressed one if no float32
+        copy is kept
+        """
+        if self.matrix is not None:
+            return self.matrix.data[row]
+
+        vector = self.codes.data[row].astype(np.float32)
+
+        return vector * self.scales.data[row, 0] if self.scales is not None else vector
+
+    def _view(self, ids: Optional[Set[str]]) -> Optional['MatrixView']:
+        """
+        The rows to search and the matrices to search them in. Call with the
+        lock held.
+        :return: The view, None if there is nothing to search
+        """
+        rows = None
+
+        if ids is not None:
+            rows = np.sort(np.fromiter((self.rows[i] for i in ids if i in self.rows), dtype=np.int64))
+
+        count = len(self.ids) if rows is None else len(rows)
+
+        if count == 0:
+            return None
+
+        return MatrixView(
+            generation=self.generation,
+            rows=rows,
+            count=count,
+            matrix=self.matrix.data if self.matrix is not None else None,
+            codes=self.codes.data if self.codes is not None else None,
+            scales=self.scales.data if self.scales is not None else None,
+        )
+
+    def _rank(self, queries: np.ndarray, k: int, view: 'MatrixView',
+              block_size: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Scores block_size queries at a time with one matrix product and
+        takes the top k of each
+        :return: The (rows, scores) of the best, per query
+        """
+        k = min(k, view.count)
+        rows = view.rows
+        ranked: List[Tuple[np.ndarray, np.ndarray]] = []
+
+        for start in range(0, len(queries), block_size):
+            block = queries[start:start + block_size]
+
+            if view.codes is None:
+                scores = block @ (view.matrix[:view.count] if rows is None else view.matrix[rows]).T
+
+                for query_scores, query_ranked in zip(scores, top_k(scores, k)):
+                    ranked.append((query_ranked if rows is None else rows[query_ranked], query_scores[query_ranked]))
+            elif view.matrix is None:
+                # Ranked by the compressed scores, no float32 copy to re-score with
+                scores = self._approximate_scores(block, view)
+
+                for query_scores, query_ranked in zip(scores, top_k(scores, k)):
+                    ranked.append((query_ranked if rows is None else rows[query_ranked], query_scores[query_ranked]))
+            else:
+                # Scan the compressed matrix, then score the candidates exactly
+                candidates = top_k(self._approximate_scores(block, view), min(view.count, k * self.rescore))
+
+                for query, query_candidates in zip(block, candidates):
+                    query_candidates = np.sort(query_candidates if rows is None else rows[query_candidates])
+                    exact = view.matrix[query_candidates] @ query
+                    best = top_k(exact, k)
+                    ranked.append((query_candidates[best], exact[best]))
+
+        return ranked
+
+    def _approximate_scores(self, queries: np.ndarray, view: 'MatrixView', block_size=128) -> np.ndarray:
+        """
+        Scores the queries against the compressed rows (the first count or the
+        given rows), block by block: each block is converted into the same
+        float32 scratch buffer, which is small enough to stay in the CPU cache
+        :return: Matrix of scores, one row per query
+        """
+        count, rows = view.count, view.rows
+        scores = np.empty((len(queries), count), dtype=np.float32)
+        scratch = np.empty((min(block_size, count), view.codes.shape[1]), dtype=np.float32)
+
+        if view.scales is None:
+            # The float16 rows are converted to float32 ones scaled by 2**-112, see half_to_float32
+            sign = np.empty(scratch.shape, dtype=np.uint32)
+            queries = queries * np.float32(2.0 ** 112)
+
+        for start in range(0, count, block_size):
+            end = min(count, start + block_size)
+            block = slice(start, end) if rows is None else rows[start:end]
+            converted = scratch[:end - start]
+
+            if view.scales is None:
+                half_to_float32(view.codes[block], converted, sign[:end - start])
+            else:
+                np.copyto(converted, view.codes[block])
+
+            np.matmul(queries, converted.T, out=scores[:, start:end])
+
+            if view.scales is not None:
+                scores[:, start:end] *= view.scales[block, 0]
+
+        return scores
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    """
+    Scales vectors (the last axis) to unit length, zero vectors are kept
+    """
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def half_to_float32(halves: np.ndarray, out: np.ndarray, sign: np.ndarray):
+    """
+    Converts float16 values to float32 ones scaled by 2**-112, by moving the
+    sign, exponent and mantissa bits into place without re-biasing the
+    exponent (exact for zeros and subnormals as well). Several times faster
+    than astype, which numpy does one value at a time.
+    :param halves: The float16 values
+    :param out: Receives the float32 values, same shape
+    :param sign: Scratch buffer of uint32, same shape
+    """
+    bits = out.view(np.uint32)
+
+    np.copyto(bits, halves.view(np.uint16))
+    np.bitwise_and(bits, 0x8000, out=sign)
+    np.left_shift(sign, 16, out=sign)
+    np.bitwise_and(bits, 0x7fff, out=bits)
+    np.left_shift(bits, 13, out=bits)
+    np.bitwise_or(bits, sign, out=bits)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    The indices of the k highest scores (along the last axis, i.e. per row
+    of a matrix), best first
+    """
+    count = scores.shape[-1]
+
+    if k < count:
+        candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        candidates = np.broadcast_to(np.arange(count), scores.shape)
+
+    order = np.argsort(-np.take_along_axis(scores, candidates, axis=-1), axis=-1, kind="stable")
+
+    return np.take_along_axis(candidates, order, axis=-1)
@@ -0,0 +1,128 @@
+"""
+Compares the vector backends of EmbeddingsDb on synthetic chunks: build
+time, cold-open time (in a fresh process) and query latency (one query
+at a time and batched).
+
+    python -m bench.backends --chunks 5000 --dims 1536
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+from typing import Dict, List
+import numpy as np
+from langchain.docstore.document import Document
+from embeddingsdb import open_backend, vector_backends
+
+
+def random_vectors(count: int, dims: int, seed: int) -> np.ndarray:
+    vectors = np.random.default_rng(seed).standard_normal((count, dims)).astype(np.float32)
+
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def build(name: str, index_path: str, vectors: np.ndarray, batch_size=500) -> float:
+    """
+    Stores the vectors as chunks in a new backend
+    :return: Seconds it took
+    """
+    backend = open_backend(name, index_path)
+    start = time.perf_counter()
+
+    for offset in range(0, len(vectors), batch_size):
+        batch = vectors[offset:offset + batch_size]
+        ids = [f"chunk-{offset + i}" for i in range(len(batch))]
+        docs = [Document(page_content=f"Chunk {offset + i}", metadata={"source": "bench"}) for i in range(len(batch))]
+
+        backend.upsert(ids=ids, vectors=batch.tolist(), docs=docs)
+
+    seconds = time.perf_counter() - start
+    backend.close()
+
+    return seconds
+
+
+def cold_open(name: str, index_path: str, query: List[float], k: int) -> Dict[str, float]:
+    """
+    Opens the backend and runs the first query, run in a fresh process so
+    that nothing is imported or cached beforehand.
+    """
+    start = time.perf_counter()
+    backend = open_backend(name, index_path)
+    opened = time.perf_counter()
+    backend.search(query, k=k)
+    queried = time.perf_counter()
+
+    return {"open_seconds": opened - start, "first_query_seconds": queried - opened}
+
+
+def query_latency(name: str, index_path: str, queries: np.ndarray, k: int) -> Dict[str, float]:
+    backend = open_backend(name, index_path)
+    backend.search(queries[0].tolist(), k=k)
+
+    latencies = []
+
+    for query in queries:
+        start = time.perf_counter()
+        backend.search(query.tolist(), k=k)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    backend.search_many(queries.tolist(), k=k)
+    batched = (time.perf_counter() - start) / len(queries)
+
+    backend.close()
+
+    return {
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "mean_ms": float(np.mean(latencies) * 1000),
+        "batched_ms": float(batched * 1000),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Vector backend benchmark")
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--backends", nargs="+", default=list(vector_backends))
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    vectors = random_vectors(args.chunks, args.dims, seed=1)
+    queries = random_vectors(args.queries, args.dims, seed=2)
+    results = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name in args.backends:
+            index_path = os.path.join(directory, name)
+            result = {"build_seconds": build(name, index_path, vectors)}
+
+            with multiprocessing.get_context("spawn").Pool(1) as pool:
+                result.update(pool.apply(cold_open, (name, index_path, queries[0].tolist(), args.k)))
+
+            result.update(query_latency(name, index_path, queries, args.k))
+            results[name] = result
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{args.chunks} chunks, {args.dims} dims, {args.queries} queries, k={args.k}")
+
+    for name, result in results.items():
+        print(
+            f"{name:>8}: build {result['build_seconds']:.2f}s, "
+            f"cold open {result['open_seconds'] * 1000:.0f}ms "
+            f"(+{result['first_query_seconds'] * 1000:.1f}ms first query), "
+            f"query p50 {result['p50_ms']:.2f}ms p95 {result['p95_ms']:.2f}ms, "
+            f"batched {result['batched_ms']:.3f}ms/query"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+import hashlib
+from typing import List
+import numpy as np
+from langchain.schema.embeddings import Embeddings
+from bm25 import tokenize
+
+
+class HashingEmbeddings(Embeddings):
+    """
+    Deterministic, offline stand-in for OpenAI embeddings. Words and word
+    pairs are hashed (with a sign) into a fixed number of dimensions and
+    the vector is normalized, so texts sharing words are similar. Good
+    enough to exercise indexing and retrieval without an API key, not a
+    measure of semantic quality.
+    """
+    dims: int
+
+    def __init__(self, dims=256):
+        """
+        Constructor
+        :param dims: Number of dimensions
+        """
+        self.dims = dims
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = np.zeros(self.dims, dtype=np.float32)
+        terms = tokenize(text)
+
+        for feature in terms + [f"{a} {b}" for a, b in zip(terms, terms[1:])]:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            value = int.from_bytes(digest, "little")
+
+            vector[value % self.dims] += 1.0 if (value >> 63) & 1 else -1.0
+
+        norm = np.linalg.norm(vector)
+
+        return (vector / norm if norm > 0 else vector).tolist()
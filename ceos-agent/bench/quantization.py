@@ -0,0 +1,133 @@
+"""
+Compares the quantized storage modes of the flat backend with the full
+precision index: memory scanned per search, disk, recall@k and query
+latency. The re-scored modes keep the float32 vectors on disk next to the
+compressed ones (more disk than float32 alone), the "no float32" modes
+(rescore 0) keep only the compressed vectors and rank by them.
+
+    python -m bench.quantization --chunks 5000 --dims 1536
+    python -m bench.quantization --vectors vectors.npy
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+from typing import Dict, List
+import numpy as np
+from langchain.docstore.document import Document
+from backends.flat import FlatBackend, quantizations
+
+
+def clustered_vectors(count: int, dims: int, clusters: int, seed: int) -> np.ndarray:
+    """
+    Synthetic embeddings, scattered around a number of topics so that
+    queries have a meaningful neighbourhood
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dims)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)] + 0.5 * rng.standard_normal((count, dims)).astype(np.float32)
+
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def build(index_path: str, vectors: np.ndarray, quantization: str = None, rescore=4, batch_size=500) -> FlatBackend:
+    backend = FlatBackend(index_path, quantization=quantization, rescore=rescore)
+
+    for offset in range(0, len(vectors), batch_size):
+        batch = vectors[offset:offset + batch_size]
+
+        backend.upsert(
+            ids=[f"chunk-{offset + i}" for i in range(len(batch))],
+            vectors=batch.tolist(),
+            docs=[Document(page_content=f"Chunk {offset + i}") for i in range(len(batch))],
+        )
+
+    return backend
+
+
+def run_queries(backend: FlatBackend, queries: np.ndarray, k: int) -> (List[List[str]], List[float]):
+    results = []
+    latencies = []
+
+    for query in queries:
+        start = time.perf_counter()
+        hits = backend.search(query.tolist(), k=k)
+        latencies.append(time.perf_counter() - start)
+        results.append([hit.chunk_id for hit in hits])
+
+    return results, latencies
+
+
+def recall(results: List[List[str]], expected: List[List[str]]) -> float:
+    return float(np.mean([len(set(r) & set(e)) / len(e) for r, e in zip(results, expected) if len(e) > 0]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flat backend quantization benchmark")
+    parser.add_argument("--chunks", type=int, default=5000)
+    parser.add_argument("--dims", type=int, default=1536)
+    parser.add_argument("--clusters", type=int, default=50)
+    parser.add_argument("--vectors", help="Use the embeddings in this .npy file instead of synthetic ones")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--rescore", type=int, default=4, help="Candidates per result scored exactly")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    if args.vectors is not None:
+        vectors = np.load(args.vectors).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    else:
+        vectors = clustered_vectors(args.chunks, args.dims, args.clusters, seed=1)
+
+    # Queries are perturbed chunks, i.e. close to but not equal to a stored vector
+    rng = np.random.default_rng(2)
+    queries = vectors[rng.integers(0, len(vectors), args.queries)] + \
+        0.1 * rng.standard_normal((args.queries, vectors.shape[1])).astype(np.float32)
+
+    results: Dict[str, dict] = {}
+
+    with tempfile.TemporaryDirectory() as directory:
+        modes = [("float32", None, 1)] + \
+            [(f"{quantization}", quantization, args.rescore) for quantization in quantizations] + \
+            [(f"{quantization} (no float32)", quantization, 0) for quantization in quantizations]
+
+        expected = None
+
+        for name, quantization, rescore in modes:
+            index_path = os.path.join(directory, name.replace(" ", "_"))
+            backend = build(index_path, vectors, quantization=quantization, rescore=rescore)
+            found, latencies = run_queries(backend, queries, args.k)
+
+            if expected is None:
+                expected = found
+
+            results[name] = {
+                "memory_bytes": backend.memory_bytes(),
+                "disk_bytes": backend.disk_bytes(),
+                f"recall@{args.k}": recall(found, expected),
+                "p50_ms": float(np.percentile(latencies, 50) * 1000),
+                "p95_ms": float(np.percentile(latencies, 95) * 1000),
+            }
+
+            backend.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{len(vectors)} chunks, {vectors.shape[1]} dims, {args.queries} queries, k={args.k}, rescore={args.rescore}")
+    print("memory: scanned per search, disk: all files (re-scored modes keep the float32 vectors too)")
+
+    for name, result in results.items():
+        print(
+            f"{name:>20}: memory {result['memory_bytes'] / 1024 / 1024:.1f} MiB, "
+            f"disk {result['disk_bytes'] / 1024 / 1024:.1f} MiB, "
+            f"recall@{args.k} {result[f'recall@{args.k}']:.3f}, "
+            f"p50 {result['p50_ms']:.2f}ms p95 {result['p95_ms']:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+"""
+Measures retrieval quality and latency on a question/answer corpus. Each
+markdown section is a question (the first line below the header) and its
+answer, so the expected chunk of a question is the chunk of its section.
+The corpus is indexed per backend and the questions are run through
+EmbeddingsDb.query_text, query_many and the retriever of the chains for
+each search type and k.
+
+    python -m bench.retrieval --json > before.json
+    python -m bench.retrieval --openai --k 1 4 --json > after.json
+
+Embeddings are a deterministic offline stand-in (HashingEmbeddings)
+unless --openai is given, OpenAI embeddings are cached (see
+CachedEmbeddings) so repeated runs only embed what changed.
+"""
+import os
+import re
+import glob
+import json
+import time
+import argparse
+import tempfile
+from typing import Callable, Dict, List, NamedTuple, Tuple
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.schema.embeddings import Embeddings
+from bench.embeddings import HashingEmbeddings
+from embeddingsdb import EmbeddingsDb, vector_backends
+from scanner import scan_file
+
+search_types = ("similarity", "mmr", "hybrid")
+modes = ("query_text", "query_many", "chain")
+
+
+class Question(NamedTuple):
+    """
+    A question and the section that answers it
+    """
+    text: str
+    source: str
+    # The header path of the section e.g. ("Crossbreed Smarter Heating", "Bootstrapping")
+    headers: Tuple[str, ...]
+
+
+def parse_questions(file_path: str) -> List[Question]:
+    """
+    Reads the questions of a markdown Q&A file, the first line of each
+    section is the question
+    :param file_path: Path to the file
+    :return: The questions in file order
+    """
+    questions = []
+    headers: List[str] = []
+    expect_question = False
+
+    with open(file_path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            header = re.match(r"^(#{1,3})\s+(.*)$", line)
+
+            if header is not None:
+                headers = headers[:len(header.group(1)) - 1] + [header.group(2).strip()]
+                expect_question = True
+            elif expect_question and line != "":
+                questions.append(Question(line, file_path, tuple(headers)))
+                expect_question = False
+
+    return questions
+
+
+def is_answer(doc: Document, question: Question) -> bool:
+    """
+    If the chunk belongs to the section of the question, the chunks carry
+    their header path as "Header 1" .. "Header 3" metadata (see scanner.py)
+    """
+    headers = tuple(
+        doc.metadata[f"Header {level}"] for level in range(1, 4) if f"Header {level}" in doc.metadata
+    )
+
+    return doc.metadata.get("source") == question.source and headers == question.headers
+
+
+def rank_of_answer(docs: List[Document], question: Question) -> int:
+    """
+    :return: The 1-based rank of the first chunk answering the question, 0 if none
+    """
+    for rank, doc in enumerate(docs, start=1):
+        if is_answer(doc, question):
+            return rank
+
+    return 0
+
+
+def directory_bytes(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(path) for name in names
+    )
+
+
+def build(embeddings: Embeddings, files: List[str], embeddings_path: str, backend: str,
+          answers_only: bool) -> Tuple[EmbeddingsDb, Dict[str, float]]:
+    """
+    Indexes the files in a new EmbeddingsDb
+    :param answers_only: Index the sections without their question line, so
+                         the question text itself cannot be matched.
+    :return: The database and the build metrics
+    """
+    start = time.perf_counter()
+    embeddings_db = EmbeddingsDb(embeddings=embeddings, embeddings_path=embeddings_path, backend=backend)
+    chunks = 0
+
+    for file_path in files:
+        scan_path = file_path
+
+        if answers_only:
+            scan_path = os.path.join(embeddings_path + "-answers", os.path.basename(file_path))
+            without_questions(file_path, scan_path)
+
+        result = scan_file(scan_path)
+
+        if result.error is not None:
+            raise RuntimeError(f"Failed to parse {file_path}: {result.error}")
+
+        for doc in result.docs:
+            doc.metadata["source"] = file_path
+
+        embeddings_db.store_structured_data(docs=result.docs, id=file_path)
+        chunks += len(result.docs)
+
+    return embeddings_db, {
+        "build_seconds": time.perf_counter() - start,
+        "chunks": chunks,
+        "index_bytes": directory_bytes(embeddings_path),
+    }
+
+
+def without_questions(file_path: str, target_path: str):
+    """
+    Copies a Q&A file without the question lines
+    """
+    questions = {question.text for question in parse_questions(file_path)}
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+
+    with open(file_path, "r", encoding="utf-8") as source, open(target_path, "w", encoding="utf-8") as target:
+        for line in source:
+            if line.strip() not in questions:
+                target.write(line)
+
+
+def measure(retrieve: Callable[[List[str]], List[List[Document]]], questions: List[Question],
+            repeat: int, batched: bool) -> Dict[str, float]:
+    """
+    Runs the questions, one at a time or as one batch, repeat times after a
+    warm up run
+    :param retrieve: Gets the documents of each of the given questions
+    :return: Quality and latency metrics, latency is per question
+    """
+    texts = [question.text for question in questions]
+    ranks = [rank_of_answer(docs, question) for docs, question in zip(retrieve(texts), questions)]
+    latencies = []
+
+    for _ in range(repeat):
+        if batched:
+            start = time.perf_counter()
+            retrieve(texts)
+            latencies.append((time.perf_counter() - start) / len(texts))
+            continue
+
+        for text in texts:
+            start = time.perf_counter()
+            retrieve([text])
+            latencies.append(time.perf_counter() - start)
+
+    return {
+        "recall": sum(1 for rank in ranks if rank > 0) / len(ranks),
+        "mrr": sum(1.0 / rank for rank in ranks if rank > 0) / len(ranks),
+        "p50_ms": float(np.percentile(latencies, 50) * 1000),
+        "p95_ms": float(np.percentile(latencies, 95) * 1000),
+        "p99_ms": float(np.percentile(latencies, 99) * 1000),
+        "mean_ms": float(np.mean(latencies) * 1000),
+        "misses": [question.text for question, rank in zip(questions, ranks) if rank == 0],
+    }
+
+
+def retriever(embeddings_db: EmbeddingsDb, mode: str, k: int, search_type: str) -> Callable[[List[str]], List[List[Document]]]:
+    if mode == "query_many":
+        return lambda texts: [result.docs for result in embeddings_db.query_many(texts, k=k, search_type=search_type)]
+
+    if mode == "chain":
+        # The chains retrieve with the k and search type of the database
+        from chains.no_history import NoHistoryChain
+
+        embeddings_db.k = k
+        embeddings_db.search_type = search_type
+        runnable = NoHistoryChain(model=None, embeddings_db=embeddings_db, debug=False).retriever(embeddings_db)
+
+        return lambda texts: [runnable.invoke({"question": text}) for text in texts]
+
+    return lambda texts: [embeddings_db.query_text(text, k=k, search_type=search_type) for text in texts]
+
+
+def create_embeddings(openai: bool) -> Tuple[Embeddings, str]:
+    if not openai:
+        embeddings = HashingEmbeddings()
+        return embeddings, f"hashing-{embeddings.dims}"
+
+    from langchain.embeddings import OpenAIEmbeddings
+    from embeddings_cache import CachedEmbeddings
+
+    embeddings = CachedEmbeddings(OpenAIEmbeddings(openai_api_key=os.environ["OPENAI_API_KEY"]))
+
+    return embeddings, embeddings.model_name
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval quality and latency benchmark")
+    parser.add_argument("--qa", nargs="+", default=["data/training/*_qa.md"],
+                        help="Q&A markdown files (globs), these are also the indexed corpus")
+    parser.add_argument("--backends", nargs="+", default=list(vector_backends))
+    parser.add_argument("--search-types", nargs="+", default=list(search_types))
+    parser.add_argument("--modes", nargs="+", default=list(modes))
+    parser.add_argument("--k", nargs="+", type=int, default=[1, 4])
+    parser.add_argument("--repeat", type=int, default=20, help="Timed runs of each question")
+    parser.add_argument("--answers-only", action="store_true",
+                        help="Index the answers without the question lines")
+    parser.add_argument("--openai", action="store_true", help="Use OpenAI embeddings (cached)")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    args = parser.parse_args()
+
+    files = sorted({file for pattern in args.qa for file in glob.glob(pattern)})
+    questions = [question for file in files for question in parse_questions(file)]
+
+    if len(questions) == 0:
+        parser.error(f"No questions found in {args.qa}")
+
+    embeddings, embeddings_name = create_embeddings(args.openai)
+    builds = {}
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        for backend in args.backends:
+            embeddings_db, builds[backend] = build(
+                embeddings, files, os.path.join(directory, backend), backend, args.answers_only,
+            )
+
+            for search_type in args.search_types:
+                for k in args.k:
+                    for mode in args.modes:
+                        result = measure(retriever(embeddings_db, mode, k, search_type), questions,
+                                         args.repeat, batched=mode == "query_many")
+                        results.append({"backend": backend, "search_type": search_type, "k": k, "mode": mode,
+                                        **result})
+
+            embeddings_db.close()
+
+    report = {
+        "config": {
+            "files": files,
+            "questions": len(questions),
+            "embeddings": embeddings_name,
+            "answers_only": args.answers_only,
+            "repeat": args.repeat,
+        },
+        "builds": builds,
+        "results": results,
+    }
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print(f"{len(questions)} questions from {', '.join(files)}, {embeddings_name} embeddings"
+          f"{', answers only' if args.answers_only else ''}")
+
+    for backend, metrics in builds.items():
+        print(f"{backend:>8}: build {metrics['build_seconds']:.2f}s, {metrics['chunks']} chunks, "
+              f"{metrics['index_bytes'] / 1024:.0f} KiB")
+
+    for result in results:
+        print(
+            f"{result['backend']:>8} {result['search_type']:>10} k={result['k']:<2} {result['mode']:>10}: "
+            f"recall {result['recall']:.2f} mrr {result['mrr']:.2f}, "
+            f"p50 {result['p50_ms']:.2f}ms p95 {result['p95_ms']:.2f}ms p99 {result['p99_ms']:.2f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import os
+import re
+import json
+import math
+import heapq
+import threading
+from typing import Dict, List, Set, Tuple
+from langchain.docstore.document import Document
+from journal import Journal
+
+# Identifiers such as "T123", "Plant-1" or "v2.3" are kept as one token
+# (and also split into their parts)
+token_pattern = re.compile(r"\w+(?:[\-\./:]\w+)*")
+part_separators = re.compile(r"[\-\./:]")
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Splits a text into lower case terms
+    :param text: The text
+    :return: List of terms (with repetitions)
+    """
+    terms: List[str] = []
+
+    for token in token_pattern.findall(text.lower()):
+        terms.append(token)
+
+        if part_separators.search(token):
+            terms.extend(part for part in part_separators.split(token) if part)
+
+    return terms
+
+
+class Bm25Index:
+    """
+    Local inverted index that scores chunks with Okapi BM25. It is kept
+    incrementally in sync with the vector store (same chunk ids) and is
+    used for exact term matching, e.g. equipment models, parameter names
+    and error codes, that embeddings retrieve poorly.
+
+    Changes are appended to a log next to the index (see Journal) and the
+    index is only rewritten once the log has grown larger than it.
+    """
+    index_path: str
+    k1: float
+    b: float
+    docs: Dict[str, dict]
+    postings: Dict[str, Dict[str, int]]
+    lengths: Dict[str, int]
+    journal: Journal
+
+    def __init__(self, index_path: str, k1=1.5, b=0.75):
+        """
+        Constructor
+        :param index_path: The JSON file where the indexed chunks are persisted.
+        :param k1: Term frequency saturation
+        :param b: Document length normalization
+        """
+        self.index_path = index_path
+        self.k1 = k1
+        self.b = b
+        self.docs = {}
+        self.postings = {}
+        self.lengths = {}
+        self.total_length = 0
+
+        self.journal = Journal(index_path + ".log")
+
+        self._lock = threading.RLock()
+
+        if os.path.exists(index_path):
+            with open(index_path, "r") as f:
+                for chunk_id, doc in json.load(f).items():
+                    self._add(chunk_id, doc)
+
+        for change in self.journal.replay():
+            for chunk_id in change.get("remove", []):
+                self._remove(chunk_id)
+
+            for chunk_id, doc in change.get("add", {}).items():
+                self._remove(chunk_id)
+                self._add(chunk_id, doc)
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, ids: List[str], docs: List[Document], save=True):
+        """
+        Adds (or replaces) chunks
+        :param ids: The chunk ids
+        :param docs: The chunks
+        :param save: If the index shall be persisted
+        """
+        with self._lock:
+            added: Dict[str, dict] = {}
+
+            for chunk_id, doc in zip(ids, docs):
+                added[chunk_id] = {"text": doc.page_content, "metadata": dict(doc.metadata)}
+                self._remove(chunk_id)
+                self._add(chunk_id, added[chunk_id])
+
+            if save:
+                self.log({"add": added})
+
+    def remove(self, ids: List[str], save=True):
+        """
+        Removes chunks
+        :param ids: The chunk ids
+        :param save: If the index shall be persisted
+        """
+        with self._lock:
+            for chunk_id in ids:
+                self._remove(chunk_id)
+
+            if save:
+                self.log({"remove": list(ids)})
+
+    def clear(self):
+        with self._lock:
+            self.docs = {}
+            self.postings = {}
+            self.lengths = {}
+            self.total_length = 0
+            self.journal.truncate()
+
+    def close(self):
+        """
+        Writes the logged changes to the index, so the next start does not
+        replay them
+        """
+        with self._lock:
+            if len(self.journal) > 0:
+                self.save()
+
+    def get_all(self) -> Tuple[List[str], List[Document]]:
+        """
+        Gets all indexed chunks
+        :return: The chunk ids and the chunks
+        """
+        with self._lock:
+            return list(self.docs.keys()), [
+                Document(page_content=doc["text"], metadata=dict(doc["metadata"] or {}))
+                for doc in self.docs.values()
+            ]
+
+    def search(self, query: str, k: int, ids: Set[str] = None) -> List[Tuple[str, Document, float]]:
+        """
+        Gets the k best matching chunks
+        :param query: The query
+        :param k: Max number of chunks
+        :param ids: Only score these chunks
+        :return: List of (chunk id, Document, score), best first
+        """
+        with self._lock:
+            if len(self.docs) == 0:
+                return []
+
+            scores: Dict[str, float] = {}
+            average_length = self.total_length / len(self.docs)
+
+            for term in set(tokenize(query)):
+                postings = self.postings.get(term)
+
+                if postings is None:
+                    continue
+
+                idf = math.log(1 + (len(self.docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+
+                for chunk_id, frequency in postings.items():
+                    if ids is not None and chunk_id not in ids:
+                        continue
+
+                    norm = self.k1 * (1 - self.b + self.b * self.lengths[chunk_id] / average_length)
+                    scores[chunk_id] = scores.get(chunk_id, 0.0) + \
+                        idf * frequency * (self.k1 + 1) / (frequency + norm)
+
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+            return [
+                (chunk_id, Document(
+                    page_content=self.docs[chunk_id]["text"],
+                    metadata=dict(self.docs[chunk_id]["metadata"] or {}),
+                ), score)
+                for chunk_id, score in best
+            ]
+
+    def log(self, change: dict):
+        """
+        Persists a change by appending it to the log, the index is rewritten
+        when the log is due
+        """
+        self.journal.append(change)
+
+        if self.journal.due(self.index_path):
+            self.save()
+
+    def save(self):
+        """
+        Persists the indexed chunks (atomically replaces the previous file)
+        and truncates the log
+        """
+        with self._lock:
+            os.makedirs(os.path.dirname(self.index_path), exist_ok=True)
+
+            tmp_path = self.index_path + ".tmp"
+
+            with open(tmp_path, "w") as f:
+                json.dump(self.docs, f)
+
+            os.replace(tmp_path, self.index_path)
+            self.journal.truncate()
+
+    def _add(self, chunk_id: str, doc: dict):
+        terms = tokenize(doc["text"])
+        frequencies: Dict[str, int] = {}
+
+        for term in terms:
+            frequencies[term] = frequencies.get(term, 0) + 1
+
+        for term, frequency in frequencies.items():
+            self.postings.setdefault(term, {})[chunk_id] = frequency
+
+        self.docs[chunk_id] = doc
+        self.lengths[chunk_id] = len(terms)
+        self.total_length += len(terms)
+
+    def _remove(self, chunk_id: str):
+        doc = self.docs.pop(chunk_id, None)
+
+        if doc is None:
+            return
+
+        for term in set(tokenize(doc["text"])):
+            postings = self.postings.get(term)
+
+            if postings is not None:
+                postings.pop(chunk_id, None)
+
+                if len(postings) == 0:
+                    del self.postings[term]
+
+        self.total_length -= self.lengths.pop(chunk_id)
@@ -1,12 +1,27 @@
+import os
+from functools import lru_cache
+from typing import Tuple
+
 from chains.history_tools import HistoryWithToolsChain
 from chains.history import HistoryChain
 from chains.no_history import NoHistoryChain
 from chains.base import BaseChain
+from chains.tool_calls import ToolCallingChatOpenAI
 from embeddingsdb import EmbeddingsDb
+from metadata_index import MetadataFilter
 
+import openai
 from langchain.chat_models import ChatOpenAI
 from langchain.globals import set_verbose, set_debug
 
+# What the chains can be scoped to (see chat_start.py)
+scopes = {
+    "all": None,
+    "training": MetadataFilter(sources=("data/training/*",)),
+    "knowledge": MetadataFilter(sources=("data/knowledge/*",)),
+    "uploads": MetadataFilter(sources=("data/user/*",)),
+}
+
 
 def setup_chain_from_chat_settings(
         settings: any,
@@ -20,6 +35,9 @@ def setup_chain_from_chat_settings(
         max_tokens=settings["MaxTokens"],
         chat_type=settings["Chain"],
         debug=settings["Debug"],
+        context_tokens=settings.get("ContextTokens", 3000),
+        history_tokens=settings.get("HistoryTokens", 2000),
+        scope=settings.get("Scope", "all"),
     )
 
 
@@ -31,9 +49,14 @@ def setup_chain(
         chat_type: str,
         debug: bool,
         max_tokens=4096,
+        context_tokens=3000,
+        history_tokens=2000,
+        scope="all",
 ) -> BaseChain:
     """
-    Setup the LLM model and the chain.
+    Setup the LLM model and the chain. Created chains are shared by all
+    sessions with the same settings, the returned chain is a session of
+    it (see BaseChain.session) and needs no create().
 
     :param model: The model name
     :param temp: The temperature
@@ -42,10 +65,14 @@ def setup_chain(
     :params chat_type: The chat type (see chat_start.py)
     :params debug: The debug flag
     :param max_tokens: The max tokens
+    :param context_tokens: The max tokens of retrieved context in the prompt
+    :param history_tokens: The max tokens of chat history in the prompt (summary included)
+    :param scope: The documents retrieved from (see scopes)
     :return: The BaseChain derivate
     """
     print(
-        f'model:{model}, temp:{temperature}, streaming:{streaming}, max_tokens:{max_tokens}'
+        f'model:{model}, temp:{temperature}, streaming:{streaming}, max_tokens:{max_tokens}, '
+        f'context_tokens:{context_tokens}, history_tokens:{history_tokens}, scope:{scope}'
     )
 
     print(f"chat_type: {chat_type} debug: {debug}")
@@ -53,42 +80,109 @@ def setup_chain(
     set_verbose(debug)
     set_debug(debug)
 
-    chat_model = ChatOpenAI(
-        model_name=model,
-        streaming=streaming,
-        temperature=temperature,
-        max_tokens=max_tokens,
+    chain = created_chain(
+        model, temperature, streaming, max_tokens, chat_type, debug, context_tokens, history_tokens, scope,
+        embeddings_db,
     )
 
+    return chain.session()
+
+
+@lru_cache(maxsize=64)
+def created_chain(
+        model: str,
+        temperature: float,
+        streaming: bool,
+        max_tokens: int,
+        chat_type: str,
+        debug: bool,
+        context_tokens: int,
+        history_tokens: int,
+        scope: str,
+        embeddings_db: EmbeddingsDb,
+) -> BaseChain:
+    """
+    Creates the chain for the settings once, it holds no per session state
+    """
     switch_chat_type = {
         "no-history": case_chat_type_no_history,
         "history": case_chat_type_with_history,
         "history-with-tools": case_chat_type_with_history_and_tools,
     }
 
-    chain = switch_chat_type[chat_type](chat_model, embeddings_db, debug)
+    chat_model = shared_chat_model(model, temperature, streaming, max_tokens)
+
+    chain = switch_chat_type[chat_type](chat_model, embeddings_db, debug, context_tokens, history_tokens, scopes[scope])
 
-    return chain
+    return chain.create()
+
+
+@lru_cache(maxsize=64)
+def shared_chat_model(model: str, temperature: float, streaming: bool, max_tokens: int) -> ChatOpenAI:
+    """
+    Gets the model for the settings, all models use the same OpenAI clients.
+    It can stream tool calls (see HistoryWithToolsChain).
+    """
+    client, async_client = openai_clients()
+
+    return ToolCallingChatOpenAI(
+        model_name=model,
+        streaming=streaming,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        client=client.chat.completions,
+        async_client=async_client.chat.completions,
+    )
+
+
+@lru_cache(maxsize=None)
+def openai_clients() -> Tuple[openai.OpenAI, openai.AsyncOpenAI]:
+    """
+    The OpenAI clients (and thereby HTTP connection pools) shared by all
+    models, configured from OPENAI_API_KEY and OPENAI_API_BASE as
+    ChatOpenAI would.
+    """
+    base_url = os.environ.get("OPENAI_API_BASE") or None
+
+    return openai.OpenAI(base_url=base_url), openai.AsyncOpenAI(base_url=base_url)
 
 
 def case_chat_type_with_history_and_tools(
         model: ChatOpenAI,
         embeddings_db: EmbeddingsDb,
         debug: bool,
+        context_tokens: int,
+        history_tokens: int,
+        scope: MetadataFilter,
 ) -> BaseChain:
-    return HistoryWithToolsChain(model=model, embeddings_db=embeddings_db, debug=debug)
+    return HistoryWithToolsChain(
+        model=model, embeddings_db=embeddings_db, debug=debug, context_tokens=context_tokens,
+        history_tokens=history_tokens, scope=scope,
+    )
 
 
 def case_chat_type_with_history(
         model: ChatOpenAI,
         embeddings_db: EmbeddingsDb,
         debug: bool,
+        context_tokens: int,
+        history_tokens: int,
+        scope: MetadataFilter,
 ) -> BaseChain:
-    return HistoryChain(model=model, embeddings_db=embeddings_db, debug=debug)
+    return HistoryChain(
+        model=model, embeddings_db=embeddings_db, debug=debug, context_tokens=context_tokens,
+        history_tokens=history_tokens, scope=scope,
+    )
 
 def case_chat_type_no_history(
         model: ChatOpenAI,
         embeddings_db: EmbeddingsDb,
         debug: bool,
+        context_tokens: int,
+        history_tokens: int,
+        scope: MetadataFilter,
 ) -> BaseChain:
-    return NoHistoryChain(model=model, embeddings_db=embeddings_db, debug=debug)
\ No newline at end of file
+    return NoHistoryChain(
+        model=model, embeddings_db=embeddings_db, debug=debug, context_tokens=context_tokens,
+        history_tokens=history_tokens, scope=scope,
+    )
\ No newline at end of file
@@ -1,7 +1,9 @@
 from abc import ABC, abstractmethod
 from embeddingsdb import EmbeddingsDb
+from metadata_index import MetadataFilter
+from metrics import timed_retrieval
 from typing import TypeVar
-from langchain.schema.runnable import Runnable
+from langchain.schema.runnable import Runnable, RunnableLambda
 from langchain.chat_models import ChatOpenAI
 
 T = TypeVar('T', bound='BaseChain')
@@ -15,18 +17,28 @@ class BaseChain(ABC):
     model: ChatOpenAI
     embeddings_db: EmbeddingsDb
     debug: bool
+    context_tokens: int
+    history_tokens: int
+    scope: MetadataFilter
     current_chain: Runnable
 
     def __init__(self, name: str,
                  model: ChatOpenAI,
                  embeddings_db: EmbeddingsDb,
-                 debug: bool, **kwargs: any):
+                 debug: bool,
+                 context_tokens: int = 3000,
+                 history_tokens: int = 2000,
+                 scope: MetadataFilter = None,
+                 **kwargs: any):
         super().__init__(**kwargs)
 
         self.name = name
         self.model = model
         self.embeddings_db = embeddings_db
         self.debug = debug
+        self.context_tokens = context_tokens
+        self.history_tokens = history_tokens
+        self.scope = scope
 
     @abstractmethod
     def create(self: type[T],
@@ -54,9 +66,47 @@ class BaseChain(ABC):
         
         return self.current_chain
 
+    def retriever(self, embeddings_db: EmbeddingsDb) -> Runnable:
+        """
+        Gets a runnable that retrieves the documents for a chain message.
+        The search is restricted to the "filter" of the message, if any,
+        otherwise to the scope of the chain, and includes the partition of
+        the "owner" of the message. It retrieves natively async when the
+        chain is run async (ainvoke, astream) and the time is added to the
+        metrics of the turn.
+        :param embeddings_db: The embeddings database to retrieve from.
+        :return: Runnable taking the chain message and returning the documents
+        """
+        def arguments(chain_message: any) -> dict:
+            return {
+                "text": chain_message["question"],
+                "filter": chain_message.get("filter") or self.scope,
+                "owner": chain_message.get("owner"),
+            }
+
+        def retrieve(chain_message: any):
+            with timed_retrieval():
+                return embeddings_db.query_text(**arguments(chain_message))
+
+        async def aretrieve(chain_message: any):
+            with timed_retrieval():
+                return await embeddings_db.aquery_text(**arguments(chain_message))
+
+        return RunnableLambda(retrieve, afunc=aretrieve)
+
     def __str__(self):
         return self.name
 
+    def session(self: type[T]) -> T:
+        """
+        Gets the chain for a new chat session. The created chain is shared
+        by all sessions with the same settings, chains with per session
+        state (e.g. memory) return a copy holding a fresh state, the
+        runnable must get that state through the chain message (see before).
+        :return: The chain for the session (itself by default)
+        """
+        return self
+
     def destroy(self):
         """
         The chain is no longer needed, this gives the chain a chance to clean up
@@ -78,6 +128,47 @@ class BaseChain(ABC):
         """
         pass
 
+    def cacheable(self, chain_message: any) -> bool:
+        """
+        This method is called before the chain is executed to check if the
+        answer to the message may be served from, and stored in, the answer
+        cache. Chains where the answer depends on more than the question
+        (history, tools) must only return True when it does not.
+        :param chain_message: The message sent to the chain (after before()).
+        :return: True if the answer only depends on the question
+        """
+        return True
+
+    def cache_namespace(self, chain_message: any = None) -> str:
+        """
+        Answers are only shared between chains with the same cache namespace
+        :param chain_message: The message sent to the chain (after before()).
+        :return: The namespace (chain name, model name and scope by default,
+                 and the owner when the owner has a partition of its own)
+        """
+        namespace = f"{self.name}:{self.model.model_name}"
+
+        if self.scope is not None:
+            namespace = f"{namespace}:{self.scope}"
+
+        owner = chain_message.get("owner") if chain_message is not None else None
+
+        if self.embeddings_db.has_partition(owner):
+            namespace = f"{namespace}:owner={owner}"
+
+        return namespace
+
+    def cache_generation(self, chain_message: any = None) -> int:
+        """
+        The cached answers of the cache namespace are dropped when this
+        changes (all of them are when the shared index changes)
+        :param chain_message: The message sent to the chain (after before()).
+        :return: The generation of the owner's partition, if it is searched
+        """
+        owner = chain_message.get("owner") if chain_message is not None else None
+
+        return self.embeddings_db.partition_generation(owner) if self.embeddings_db.has_partition(owner) else 0
+
     def chunk(self, chunk: any) -> any:
         """
         This method is called for each chunk emitted from the chain
@@ -1,15 +1,23 @@
 from .base import BaseChain
-from .utils import docs_as_messages
+from .utils import ContextPacker
+from .memory import TokenBudgetMemory, summarizer
 from embeddingsdb import EmbeddingsDb
 
-from operator import itemgetter
+import re
+import copy
+from typing import Callable, List
 
 from langchain.chat_models import ChatOpenAI
-from langchain.schema.runnable import RunnableLambda
-from langchain.schema.messages import HumanMessage, SystemMessage
+from langchain.schema.messages import BaseMessage, HumanMessage, SystemMessage
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder, HumanMessagePromptTemplate
 from langchain.schema.output_parser import StrOutputParser
-from langchain.memory import ConversationBufferMemory
+
+
+# Words that typically refer back to earlier turns of the conversation
+follow_up_pattern = re.compile(
+    r"\b(it|its|that|this|those|these|they|them|their|he|she|previous|above|earlier|again|else|more)\b",
+    re.IGNORECASE,
+)
 
 
 class HistoryChain(BaseChain):
@@ -19,8 +27,11 @@ class HistoryChain(BaseChain):
 
     Based on: https://python.langchain.com/docs/expression_language/cookbook/memory
     """
-    memory: ConversationBufferMemory
-    input: any
+    # Per session, see session()
+    memory: TokenBudgetMemory = None
+    packer: ContextPacker
+    summarize: Callable[[str, List[BaseMessage]], str]
+    input: any = None
 
     def __init__(self,
                  model: ChatOpenAI,
@@ -62,28 +73,56 @@ class HistoryChain(BaseChain):
             ]
         )
 
-        self.memory = ConversationBufferMemory(
-            memory_key="chat_history", return_messages=True)
+        self.packer = ContextPacker(model.model_name, budget=self.context_tokens, debug=debug)
+        self.summarize = summarizer(model)
 
         self.current_chain = {
             "question": lambda x: x["question"],
-            "chat_history": RunnableLambda(self.memory.load_memory_variables) | itemgetter("chat_history"),
-            "context": itemgetter("question") | embeddings_db.as_retriever() | docs_as_messages,
+            "chat_history": lambda x: x["chat_history"],
+            "context": self.retriever(embeddings_db) | self.packer.runnable(),
         } | prompt | model | StrOutputParser()
 
         return self
 
+    def session(self) -> 'HistoryChain':
+        """
+        A copy of the chain with a memory of its own
+        """
+        session = copy.copy(self)
+        session.memory = TokenBudgetMemory(
+            self.model.model_name,
+            budget=self.history_tokens,
+            summary_budget=self.history_tokens // 4,
+            summarize=self.summarize,
+            debug=self.debug,
+        )
+        session.input = None
+
+        return session
+
     def before(self, chain_message: any) -> any:
         """
-        Stores, temporarily, the chain_message as input.
+        Stores, temporarily, the chain_message as input and adds the
+        chat_history of the session to it.
         """
         self.input = chain_message
-        
+        chain_message["chat_history"] = self.memory.messages() if self.memory is not None else []
+
         return chain_message
 
+    def cacheable(self, chain_message: any) -> bool:
+        """
+        Only turns that do not depend on the history are cacheable, i.e.
+        the first turn or a question that does not refer back.
+        """
+        if self.memory is None or self.memory.stats().turns == 0:
+            return True
+
+        return follow_up_pattern.search(chain_message["question"]) is None
+
     def after(self, chain_message: any):
         """
         Stores the chain_message in memory along with the input.
         """
         if self.memory is not None:
-            self.memory.save_context(self.input, {"output": chain_message})
+            self.memory.save(self.input["question"], chain_message)
@@ -1,27 +1,60 @@
 from .base import BaseChain
+from .utils import ContextPacker
+from .memory import TokenBudgetMemory, summarizer
+from .tool_calls import tool_calls, tool_call_message, run_tool_calls
 from tools.smhi import ForecastTool
+from tools.knowledge import KnowledgeTool
 from embeddingsdb import EmbeddingsDb
 
-from langchain.agents.format_scratchpad import format_to_openai_function_messages
-from langchain.agents.output_parsers import OpenAIFunctionsAgentOutputParser
-from langchain.agents import initialize_agent, AgentType
+import copy
+from typing import AsyncIterator, Callable, List
+
 from langchain.chat_models import ChatOpenAI
-from langchain.schema.messages import SystemMessage
+from langchain.schema.messages import BaseMessage, SystemMessage
+from langchain.schema.runnable import RunnableConfig, RunnableGenerator
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain.tools import BaseTool
+from langchain.tools.render import format_tool_to_openai_tool
 
 
 class HistoryWithToolsChain(BaseChain):
     """
-    This is a chain, that loads a context from the database, have tools, and
-    keep history.
+    This is a chain, that keeps history and answers with the help of tools:
+    a search in the database (scoped as the chain, as the owner of the
+    session) and the weather forecast.
+
+    The model is called with the tools (OpenAI tool calling), the tool calls
+    of a response are run concurrently and their results sent back, until
+    the model answers or max_iterations model calls are made (the last one
+    must answer). A question needing both the documents and the weather
+    costs two model calls. The answer is streamed.
+
+    Only runs async (astream, ainvoke).
     """
+    # Per session, see session()
+    memory: TokenBudgetMemory = None
+    packer: ContextPacker
+    summarize: Callable[[str, List[BaseMessage]], str]
+    max_iterations: int
+    input: any = None
 
     def __init__(self,
                  model: ChatOpenAI,
                  embeddings_db: EmbeddingsDb,
-                 debug: bool, **kwargs: any):
+                 debug: bool,
+                 max_iterations=3,
+                 **kwargs: any):
+        """
+        Constructor
+        :param max_iterations: Max model calls per question.
+        """
         super().__init__("history-with-tools", model, embeddings_db, debug, **kwargs)
 
+        if max_iterations < 1:
+            raise ValueError(f"max_iterations must be at least 1, got {max_iterations}")
+
+        self.max_iterations = max_iterations
+
     def create(self,
                model: ChatOpenAI = None,
                embeddings_db: EmbeddingsDb = None,
@@ -29,7 +62,7 @@ class HistoryWithToolsChain(BaseChain):
                ) -> 'HistoryWithToolsChain':
         """
         Create the chain
-        :param model: The model. If omitted, the default model is used.
+        :param model: The model (streaming tool calls needs a ToolCallingChatOpenAI). If omitted, the default model is used.
         :param embeddings_db: The embeddings database. If omitted, the default embeddings database is used.
         :param debug: The debug flag. If omitted, the default debug flag is used.
         :return: The runnable chain
@@ -41,47 +74,113 @@ class HistoryWithToolsChain(BaseChain):
         prompt = ChatPromptTemplate.from_messages(
             [
                 SystemMessage(
-                    content="You are very powerful assistant, but bad at calculating lengths of words."),
+                    content="""You are a very knowledgeable assistant, and are willingly to assist a \
+human with correct answers. Search the knowledge base for anything about CEOS and base the answer \
+on what is found (without mention the search in the response). When more than one tool is needed, \
+call them at the same time."""
+                ),
                 MessagesPlaceholder(variable_name="chat_history"),
-                ("user", "{input}"),
+                ("user", "{question}"),
                 MessagesPlaceholder(variable_name="agent_scratchpad"),
             ]
         )
 
-        agent = (
-            {
-                "input": lambda x: x["input"],
-                "agent_scratchpad": lambda x: format_to_openai_function_messages(
-                    x["intermediate_steps"]
-                ),
-                "chat_history": lambda x: x["chat_history"],
-            }
-            | prompt
-            | model
-            | OpenAIFunctionsAgentOutputParser()
-        )
+        self.packer = ContextPacker(model.model_name, budget=self.context_tokens, debug=debug)
+        self.summarize = summarizer(model)
 
-        self.current_chain = initialize_agent(
-            agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-            llm=model,
-            # return_direct=True?? -> https://github.com/Chainlit/chainlit/issues/377
-            tools=[ForecastTool()], verbose=debug, return_direct=True
-        )
+        knowledge = self.retriever(embeddings_db) | self.packer.runnable()
+        schemas = [format_tool_to_openai_tool(tool) for tool in self.tools(knowledge, owner=None)]
+        call_tools = model.bind(tools=schemas)
+        # The last call must answer
+        answer = model.bind(tools=schemas, tool_choice="none")
+
+        async def agent(chain_messages: AsyncIterator[dict], config: RunnableConfig) -> AsyncIterator[dict]:
+            async for chain_message in chain_messages:
+                tools = {tool.name: tool for tool in self.tools(knowledge, chain_message.get("owner"))}
+                scratchpad: List[BaseMessage] = []
+
+                for iteration in range(self.max_iterations):
+                    messages = prompt.format_messages(
+                        question=chain_message["question"],
+                        chat_history=chain_message["chat_history"],
+                        agent_scratchpad=scratchpad,
+                    )
+                    response = None
+
+                    async for chunk in (call_tools if iteration + 1 < self.max_iterations else answer).astream(
+                            messages, config=config):
+                        response = chunk if response is None else response + chunk
+
+                        if len(chunk.content) > 0:
+                            yield {"output": chunk.content}
+
+                    calls = tool_calls(response) if response is not None else []
+
+                    if len(calls) == 0:
+                        break
+
+                    if debug:
+                        print(f"*** TOOL CALLS ({iteration + 1}/{self.max_iterations}): "
+                              f"{[call['function']['name'] for call in calls]} ***")
+
+                    yield {"tool_calls": calls}
+
+                    scratchpad.append(tool_call_message(response.content, calls))
+                    scratchpad.extend(await run_tool_calls(calls, tools, config))
+
+        self.current_chain = RunnableGenerator(agent)
 
         return self
 
+    def tools(self, knowledge: any, owner: str = None) -> List[BaseTool]:
+        """
+        The tools of a turn
+        :param knowledge: Runnable retrieving the context of a chain message.
+        :param owner: The owner of the session, whose uploads are searched.
+        """
+        return [KnowledgeTool(retriever=knowledge, owner=owner), ForecastTool()]
+
+    def session(self) -> 'HistoryWithToolsChain':
+        """
+        A copy of the chain with a memory of its own
+        """
+        session = copy.copy(self)
+        session.memory = TokenBudgetMemory(
+            self.model.model_name,
+            budget=self.history_tokens,
+            summary_budget=self.history_tokens // 4,
+            summarize=self.summarize,
+            debug=self.debug,
+        )
+        session.input = None
+
+        return session
+
     def before(self, chain_message: any) -> any:
         """
-        Replaces the key question with input, if question is not present.
+        Stores, temporarily, the chain_message as input and adds the
+        chat_history of the session to it.
         """
-        if "input" not in chain_message:
-            chain_message["input"] = chain_message["question"]
-            del chain_message["question"]
+        self.input = chain_message
+        chain_message["chat_history"] = self.memory.messages() if self.memory is not None else []
 
         return chain_message
-    
+
+    def after(self, chain_message: any):
+        """
+        Stores the chain_message in memory along with the input.
+        """
+        if self.memory is not None:
+            self.memory.save(self.input["question"], chain_message)
+
+    def cacheable(self, chain_message: any) -> bool:
+        """
+        Tool results (e.g. the weather) change over time, never cache.
+        """
+        return False
+
     def get_output(self, chunk: any) -> str:
         """
-        Get the output from the chunk.
+        Get the output from the chunk, chunks without (e.g. tool calls) are ignored.
         """
-        return chunk["output"]
+        return chunk.get("output", "")
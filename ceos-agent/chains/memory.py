@@ -0,0 +1,252 @@
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Tuple
+from langchain.prompts import ChatPromptTemplate
+from langchain.schema.language_model import BaseLanguageModel
+from langchain.schema.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+from langchain.schema.output_parser import StrOutputParser
+from .utils import token_counter, trim_to_tokens
+
+# Summaries are written in the background, off the response path
+summary_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="summary")
+
+summary_prefix = "Summary of the earlier conversation: "
+
+
+@dataclass
+class MemoryStats:
+    """
+    Size of a TokenBudgetMemory
+    """
+    turns: int = 0
+    recent_turns: int = 0
+    recent_tokens: int = 0
+    summary_tokens: int = 0
+    budget: int = 0
+    # Turns folded into the summary, turns waiting to be folded and turns
+    # dropped without being folded (too many pending, see pending_budget)
+    summarized_turns: int = 0
+    pending_turns: int = 0
+    dropped_turns: int = 0
+    summaries: int = 0
+    summary_seconds: float = 0.0
+
+    @property
+    def tokens(self) -> int:
+        return self.recent_tokens + self.summary_tokens
+
+    def __str__(self):
+        return f'{self.tokens}/{self.budget} history tokens ({self.summary_tokens} summary), ' \
+            f'{self.recent_turns}/{self.turns} turns verbatim, {self.summarized_turns} summarized ' \
+            f'({self.pending_turns} pending, {self.dropped_turns} dropped), ' \
+            f'{self.summaries} summaries in {self.summary_seconds:.2f}s'
+
+
+class TokenBudgetMemory:
+    """
+    Conversation memory that never exceeds a token budget. The most recent
+    turns are kept verbatim, older turns are folded into a running summary.
+    The summary is refreshed in the background when turns no longer fit,
+    until then those turns are left out of the history. If summarizing
+    keeps failing, the oldest pending turns beyond pending_budget tokens
+    are dropped.
+    """
+    model_name: str
+    budget: int
+    summary_budget: int
+    pending_budget: int
+    summarize: Optional[Callable[[str, List[BaseMessage]], str]]
+    debug: bool
+
+    def __init__(self,
+                 model_name: str,
+                 budget=2000,
+                 summary_budget=500,
+                 summarize: Callable[[str, List[BaseMessage]], str] = None,
+                 pending_budget: int = None,
+                 debug=False,
+                 ):
+        """
+        Constructor
+        :param model_name: The model the tokens are counted for.
+        :param budget: Max number of tokens of the history (summary included).
+        :param summary_budget: Max number of tokens of the summary.
+        :param summarize: Gets a new summary from the current summary and
+                          the turns to fold into it. Without it older turns
+                          are forgotten.
+        :param pending_budget: Max number of tokens of the turns waiting to be
+                               summarized, defaults to budget.
+        :param debug: Prints the stats when they change.
+        """
+        self.model_name = model_name
+        self.budget = budget
+        self.summary_budget = min(summary_budget, budget)
+        self.summarize = summarize
+        self.pending_budget = pending_budget if pending_budget is not None else budget
+        self.debug = debug
+
+        self._lock = threading.Lock()
+        self._summary = ""
+        # (turn messages, tokens), oldest first
+        self._recent: List[Tuple[List[BaseMessage], int]] = []
+        self._pending: List[Tuple[List[BaseMessage], int]] = []
+        self._running: Optional[Future] = None
+        self._stats = MemoryStats(budget=budget)
+
+    def messages(self) -> List[BaseMessage]:
+        """
+        Gets the history to put in the prompt
+        :return: The summary (if any) as a system message followed by the recent turns
+        """
+        with self._lock:
+            messages: List[BaseMessage] = []
+
+            if len(self._summary) > 0:
+                messages.append(SystemMessage(content=summary_prefix + self._summary))
+
+            for turn, _ in self._recent:
+                messages.extend(turn)
+
+            return messages
+
+    def save(self, question: str, answer: str):
+        """
+        Adds a turn, turns that no longer fit are folded into the summary
+        :param question: The question of the human
+        :param answer: The answer of the assistant
+        """
+        count = token_counter(self.model_name)
+        # A turn never takes more than what is left next to a full summary
+        limit = self.budget - self.summary_budget
+
+        if count(question) > limit // 2:
+            question = trim_to_tokens(question, limit // 2, count)
+
+        if count(question) + count(answer) > limit:
+            answer = trim_to_tokens(answer, limit - count(question), count)
+
+        with self._lock:
+            self._recent.append(([HumanMessage(content=question), AIMessage(content=answer)],
+                                 count(question) + count(answer)))
+            self._stats.turns += 1
+
+            while len(self._recent) > 0 and self._recent_tokens() > self.budget - self._summary_tokens():
+                self._pending.append(self._recent.pop(0))
+
+            self._update_stats()
+            self._schedule()
+
+        if self.debug:
+            print(f"memory: {self.stats()}")
+
+    def stats(self) -> MemoryStats:
+        with self._lock:
+            return MemoryStats(**self._stats.__dict__)
+
+    def wait(self, timeout: float = None):
+        """
+        Waits for the background summaries, e.g. before reading the stats
+        """
+        while True:
+            with self._lock:
+                running = self._running
+
+            if running is None:
+                return
+
+            running.result(timeout=timeout)
+
+    def _schedule(self):
+        """
+        Starts a summary of the pending turns unless one is running, call
+        with the lock held
+        """
+        if self._running is not None or len(self._pending) == 0:
+            return
+
+        # E.g. summarize failed for a while, the oldest turns are not folded then
+        while sum(tokens for _, tokens in self._pending) > self.pending_budget and len(self._pending) > 1:
+            self._pending.pop(0)
+            self._stats.dropped_turns += 1
+            self._update_stats()
+
+        if self.summarize is None:
+            self._stats.summarized_turns += len(self._pending)
+            self._pending.clear()
+            self._update_stats()
+            return
+
+        turns = list(self._pending)
+        self._running = summary_executor.submit(self._fold, self._summary, turns)
+
+    def _fold(self, summary: str, turns: List[Tuple[List[BaseMessage], int]]):
+        start = time.perf_counter()
+
+        try:
+            summary = self.summarize(summary, [message for turn, _ in turns for message in turn])
+        except Exception as e:
+            # The turns are kept pending and folded with the next ones
+            print(f"memory: failed to summarize {len(turns)} turns: {type(e).__name__}: {e}")
+
+            with self._lock:
+                self._running = None
+
+            return
+
+        count = token_counter(self.model_name)
+
+        if count(summary_prefix + summary) > self.summary_budget:
+            summary = trim_to_tokens(summary, self.summary_budget - count(summary_prefix), count)
+
+        with self._lock:
+            self._summary = summary
+            del self._pending[:len(turns)]
+            self._stats.summarized_turns += len(turns)
+            self._stats.summaries += 1
+            self._stats.summary_seconds += time.perf_counter() - start
+
+            # A longer summary may push out more recent turns
+            while len(self._recent) > 0 and self._recent_tokens() > self.budget - self._summary_tokens():
+                self._pending.append(self._recent.pop(0))
+
+            self._running = None
+            self._update_stats()
+            self._schedule()
+
+    def _recent_tokens(self) -> int:
+        return sum(tokens for _, tokens in self._recent)
+
+    def _summary_tokens(self) -> int:
+        if len(self._summary) == 0:
+            return 0
+
+        return token_counter(self.model_name)(summary_prefix + self._summary)
+
+    def _update_stats(self):
+        self._stats.recent_turns = len(self._recent)
+        self._stats.recent_tokens = self._recent_tokens()
+        self._stats.summary_tokens = self._summary_tokens()
+        self._stats.pending_turns = len(self._pending)
+
+
+def summarizer(model: BaseLanguageModel) -> Callable[[str, List[BaseMessage]], str]:
+    """
+    Gets a summarize function for TokenBudgetMemory that asks the model to
+    extend the summary with the turns
+    :param model: The model writing the summary
+    :return: The summarize function
+    """
+    chain = ChatPromptTemplate.from_messages(
+        [
+            ("system", "Progressively summarize the conversation, adding onto the previous summary. "
+                       "Keep names, identifiers and numbers, be brief."),
+            ("human", "Previous summary:\n{summary}\n\nNew lines of conversation:\n{lines}\n\nNew summary:"),
+        ]
+    ) | model | StrOutputParser()
+
+    return lambda summary, messages: chain.invoke({
+        "summary": summary or "(none)",
+        "lines": get_buffer_string(messages),
+    }).strip()
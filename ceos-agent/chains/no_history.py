@@ -1,9 +1,7 @@
 from .base import BaseChain
-from .utils import docs_as_messages
+from .utils import ContextPacker
 from embeddingsdb import EmbeddingsDb
 
-from operator import itemgetter
-
 from langchain.chat_models import ChatOpenAI
 from langchain.schema.messages import HumanMessage, SystemMessage, BaseMessage
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder, HumanMessagePromptTemplate
@@ -15,6 +13,7 @@ class NoHistoryChain(BaseChain):
     This is a plain chain, that loads a context from the database and
     but do not keep history.
     """
+    packer: ContextPacker
 
     def __init__(self,
                  model: ChatOpenAI,
@@ -53,9 +52,11 @@ class NoHistoryChain(BaseChain):
             ]
         )
 
+        self.packer = ContextPacker(model.model_name, budget=self.context_tokens, debug=debug)
+
         self.current_chain = (
             {
-                "context": itemgetter("question") | embeddings_db.as_retriever() | docs_as_messages,
+                "context": self.retriever(embeddings_db) | self.packer.runnable(),
                 "question": lambda x: x["question"],
             }
             | prompt
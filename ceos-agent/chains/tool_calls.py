@@ -0,0 +1,103 @@
+import json
+import asyncio
+from typing import Any, AsyncIterator, Dict, List, Optional
+from langchain.chat_models import ChatOpenAI
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun
+from langchain.schema.messages import AIMessage, BaseMessage, ToolMessage
+from langchain.schema.output import ChatGenerationChunk
+from langchain.schema.runnable import RunnableConfig
+from langchain.tools import BaseTool
+
+# Key of the streamed tool calls in additional_kwargs (see ToolCallingChatOpenAI)
+tool_call_deltas = "tool_call_deltas"
+
+
+class ToolCallingChatOpenAI(ChatOpenAI):
+    """
+    ChatOpenAI that can stream tool calls. Langchain adds up the chunks of a
+    stream but cannot add up the deltas of the tool calls (a list), so they
+    are keyed by their index instead, which adds up field by field. The
+    calls of the complete message are read with tool_calls(). Behaves as
+    ChatOpenAI otherwise.
+    """
+
+    async def _astream(
+            self,
+            messages: List[BaseMessage],
+            stop: Optional[List[str]] = None,
+            run_manager: Optional[AsyncCallbackManagerForLLMRun] = None,
+            **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            deltas = chunk.message.additional_kwargs.pop("tool_calls", None)
+
+            if deltas:
+                chunk.message.additional_kwargs[tool_call_deltas] = {
+                    str(delta["index"]): without_none({k: v for k, v in delta.items() if k != "index"})
+                    for delta in deltas
+                }
+
+            yield chunk
+
+
+def without_none(value: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Drops the fields a delta does not set (None), recursively
+    """
+    return {
+        k: without_none(v) if isinstance(v, dict) else v
+        for k, v in value.items() if v is not None
+    }
+
+
+def tool_calls(message: BaseMessage) -> List[dict]:
+    """
+    :return: The tool calls of a (streamed or not) model response, as OpenAI
+             sends them
+    """
+    if "tool_calls" in message.additional_kwargs:
+        return message.additional_kwargs["tool_calls"]
+
+    deltas = message.additional_kwargs.get(tool_call_deltas) or {}
+
+    return [{"type": "function", **deltas[index]} for index in sorted(deltas, key=int)]
+
+
+def tool_call_message(content: str, calls: List[dict]) -> AIMessage:
+    """
+    :return: The assistant message of the tool calls, to be sent back with
+             the results
+    """
+    return AIMessage(content=content, additional_kwargs={"tool_calls": calls})
+
+
+async def run_tool_calls(calls: List[dict],
+                         tools: Dict[str, BaseTool],
+                         config: RunnableConfig = None,
+                         ) -> List[ToolMessage]:
+    """
+    Runs the tool calls of a model response concurrently. A failing call
+    (unknown tool, bad arguments, tool error) is answered with the error, so
+    the model can recover.
+    :param calls: The tool calls (see tool_calls).
+    :param tools: The tools by name.
+    :param config: Config of the tool runs (callbacks).
+    :return: A tool message per call, in order
+    """
+    async def run(call: dict) -> ToolMessage:
+        function = call.get("function") or {}
+
+        try:
+            tool = tools.get(function.get("name"))
+
+            if tool is None:
+                raise ValueError(f"There is no tool named {function.get('name')}")
+
+            result = await tool.ainvoke(json.loads(function.get("arguments") or "{}"), config=config)
+            content = result if isinstance(result, str) else json.dumps(result)
+        except Exception as e:
+            content = f"Error: {type(e).__name__}: {e}"
+
+        return ToolMessage(content=content, tool_call_id=call["id"])
+
+    return list(await asyncio.gather(*[run(call) for call in calls]))
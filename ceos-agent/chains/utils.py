@@ -1,17 +1,192 @@
-from typing import List
+import re
+import asyncio
+from contextvars import copy_context
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Callable, List, Set
+from langchain.docstore.document import Document
 from langchain.schema.messages import HumanMessage, BaseMessage
+from langchain.schema.runnable import Runnable, RunnableLambda
 
+sentence_boundary = re.compile(r"(?<=[.!?])\s+|\n+")
 
-def docs_as_messages(docs) -> List[BaseMessage]:
+
+@lru_cache(maxsize=None)
+def token_counter(model_name: str) -> Callable[[str], int]:
     """
-    Format the documents into a string. otherwise the output would
-    be a list of [Document(page_content=...),...]
+    Gets a function that counts the tokens of a text for the model. If
+    tiktoken (or its encoding files) are not available, it is approximated
+    with four characters per token.
+    :param model_name: The model name e.g. gpt-4
+    :return: Function that counts the tokens of a text
+    """
+    try:
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    except Exception:
+        return lambda text: (len(text) + 3) // 4
+
+
+def count_tokens(text: str, model_name: str) -> int:
+    """
+    Counts the tokens of a text for the model
     """
-    msg = HumanMessage(
-        content="\n\n".join(doc.page_content for doc in docs)
-    )
+    return token_counter(model_name)(text)
+
+
+@dataclass
+class ContextUsage:
+    """
+    What the ContextPacker did with the retrieved documents of a request
+    """
+    tokens: int = 0
+    budget: int = 0
+    retrieved: int = 0
+    packed: int = 0
+    duplicates: int = 0
+    trimmed: int = 0
+
+    def __str__(self):
+        return f'{self.tokens}/{self.budget} context tokens, {self.packed}/{self.retrieved} documents ' \
+            f'({self.duplicates} near-duplicates, {self.trimmed} trimmed)'
+
+
+class ContextPacker:
+    """
+    Formats retrieved documents into a context message that fits a token
+    budget. Documents are ordered by score (metadata "score", if present),
+    near-duplicates are removed and the last document that does not fit is
+    trimmed at a sentence boundary. What it did is recorded on the metrics
+    of the current turn.
+    """
+    model_name: str
+    budget: int
+    duplicate_threshold: float
+    debug: bool
+
+    def __init__(self, model_name: str, budget=3000, duplicate_threshold=0.85, debug=False):
+        """
+        Constructor
+        :param model_name: The model the tokens are counted for.
+        :param budget: Max number of context tokens.
+        :param duplicate_threshold: Min word shingle overlap (Jaccard) of near-duplicates.
+        :param debug: Prints the usage of each request.
+        """
+        self.model_name = model_name
+        self.budget = budget
+        self.duplicate_threshold = duplicate_threshold
+        self.debug = debug
+
+    def __call__(self, docs: List[Document]) -> List[BaseMessage]:
+        return self.pack(docs)
+
+    def runnable(self) -> Runnable:
+        """
+        Gets a runnable that packs the documents, see apack
+        """
+        return RunnableLambda(self.pack, afunc=self.apack)
+
+    async def apack(self, docs: List[Document]) -> List[BaseMessage]:
+        """
+        Packs the documents in a thread, with the context variables of the
+        caller (e.g. the turn the usage is recorded on)
+        """
+        return await asyncio.get_running_loop().run_in_executor(None, copy_context().run, self.pack, docs)
+
+    def pack(self, docs: List[Document]) -> List[BaseMessage]:
+        """
+        Packs the documents into a message
+        :param docs: The retrieved documents
+        :return: List with a single HumanMessage
+        """
+        count = token_counter(self.model_name)
+        usage = ContextUsage(budget=self.budget, retrieved=len(docs))
+
+        if all("score" in doc.metadata for doc in docs):
+            docs = sorted(docs, key=lambda doc: doc.metadata["score"], reverse=True)
+
+        separator = count("\n\n")
+        packed: List[str] = []
+        seen: List[Set[str]] = []
+
+        for doc in docs:
+            text = doc.page_content.strip()
+            words = shingles(text)
+
+            if any(jaccard(words, other) >= self.duplicate_threshold for other in seen):
+                usage.duplicates += 1
+                continue
+
+            remaining = self.budget - usage.tokens - (separator if len(packed) > 0 else 0)
+            tokens = count(text)
+
+            if tokens > remaining:
+                text = trim_to_tokens(text, remaining, count)
+                tokens = count(text)
+
+                if len(text) == 0:
+                    break
+
+                usage.trimmed += 1
+
+            packed.append(text)
+            seen.append(words)
+            usage.tokens += tokens + (separator if len(packed) > 1 else 0)
+
+        usage.packed = len(packed)
+
+        # Imported on use, metrics imports this module
+        from metrics import record_context
+        record_context(usage)
+
+        if self.debug:
+            print(f"context: {usage}")
+
+        return [HumanMessage(content="\n\n".join(packed))]
+
+
+def shingles(text: str, size=3) -> Set[str]:
+    """
+    The word n-grams of a text
+    """
+    words = text.lower().split()
+
+    if len(words) < size:
+        return {" ".join(words)}
+
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if len(a) == 0 or len(b) == 0:
+        return 0.0
+
+    return len(a & b) / len(a | b)
+
+
+def trim_to_tokens(text: str, max_tokens: int, count: Callable[[str], int]) -> str:
+    """
+    Keeps the leading sentences of a text that fit within max_tokens
+    :return: The trimmed text (empty if not even the first sentence fits)
+    """
+    result = ""
+
+    for sentence in sentence_boundary.split(text):
+        candidate = f"{result} {sentence}" if len(result) > 0 else sentence
+
+        if count(candidate) > max_tokens:
+            break
+
+        result = candidate
+
+    return result
 
-    return [msg]
 
 def format_docs(docs):
     """
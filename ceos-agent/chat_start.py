@@ -41,6 +41,28 @@ def get_chat_settings() -> cl.ChatSettings:
                 max=128*1024,
                 step=512,
             ),
+            Select(
+                id="Scope",
+                label="Knowledge Scope",
+                values=["all", "training", "knowledge", "uploads"],
+                initial_index=0,
+            ),
+            Slider(
+                id="ContextTokens",
+                label="Max Context Tokens",
+                initial=3000,
+                min=500,
+                max=32*1024,
+                step=500,
+            ),
+            Slider(
+                id="HistoryTokens",
+                label="Max History Tokens",
+                initial=2000,
+                min=500,
+                max=16*1024,
+                step=500,
+            ),
         ]
     )
 
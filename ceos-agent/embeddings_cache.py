@@ -0,0 +1,328 @@
+import os
+import time
+import asyncio
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List
+from langchain.schema.embeddings import Embeddings
+from manifest import hash_text
+
+
+@dataclass
+class CacheStats:
+    """
+    Hit/miss counters of a CachedEmbeddings
+    """
+    hits: int = 0
+    misses: int = 0
+    query_hits: int = 0
+    evictions: int = 0
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def __str__(self):
+        return f'{self.hits} hits ({self.query_hits} from memory), {self.misses} misses, ' \
+            f'{self.hit_rate():.1%} hit rate, {self.evictions} evicted'
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that caches vectors on local disk (SQLite) keyed by
+    model name and content hash. Query embeddings are also kept in an in
+    memory LRU. The disk cache is bounded by max_entries and evicts the
+    least recently used vectors.
+    """
+    embeddings: Embeddings
+    model_name: str
+    cache_path: str
+    max_entries: int
+    query_cache_size: int
+    stats: CacheStats
+
+    def __init__(self,
+                 embeddings: Embeddings,
+                 cache_path="./data/cache/embeddings.sqlite",
+                 model_name: str = None,
+                 max_entries=500_000,
+                 query_cache_size=4096,
+                 ):
+        """
+        Constructor
+        :param embeddings: The embeddings to cache.
+        :param cache_path: The SQLite file where vectors are stored.
+        :param model_name: Part of the cache key, defaults to the model of the embeddings.
+        :param max_entries: Max number of vectors stored on disk.
+        :param query_cache_size: Max number of query vectors kept in memory.
+        """
+        self.embeddings = embeddings
+        self.model_name = model_name or getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.query_cache_size = query_cache_size
+        self.stats = CacheStats()
+
+        self._lock = threading.Lock()
+        self._queries: OrderedDict[str, List[float]] = OrderedDict()
+        # Disk access of the async methods, SQLite is serialized by the lock anyway
+        self._disk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embeddings-cache")
+
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+
+        self._db = sqlite3.connect(cache_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_accessed ON embeddings (accessed)")
+        self._db.commit()
+
+        self._count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed documents, only the texts not already cached are embedded
+        :param texts: The texts to embed
+        :return: List of vectors (in the same order as texts)
+        """
+        keys = [self.key(text, "document") for text in texts]
+        found = self._load(keys)
+
+        missing: Dict[str, str] = {}
+        misses = 0
+
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+                misses += 1
+
+        with self._lock:
+            self.stats.hits += len(texts) - misses
+            self.stats.misses += misses
+
+        if len(missing) > 0:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            embedded = dict(zip(missing.keys(), vectors))
+
+            self._store(embedded)
+            found.update(embedded)
+
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        """
+        Embed a query, served from memory or disk if embedded before
+        :param text: The text to embed
+        :return: The vector
+        """
+        key = self.key(text, "query")
+
+        with self._lock:
+            vector = self._queries.get(key)
+
+            if vector is not None:
+                self._queries.move_to_end(key)
+                self.stats.hits += 1
+                self.stats.query_hits += 1
+
+                return vector
+
+        vector = self._load([key]).get(key)
+
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._store({key: vector})
+
+            with self._lock:
+                self.stats.misses += 1
+        else:
+            with self._lock:
+                self.stats.hits += 1
+
+        self._remember_query(key, vector)
+
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """
+        Embed a query without blocking the event loop. Served from memory
+        on the loop, the disk is read on a thread of its own and a miss is
+        embedded by the async client of the embeddings.
+        :param text: The text to embed
+        :return: The vector
+        """
+        key = self.key(text, "query")
+
+        with self._lock:
+            vector = self._queries.get(key)
+
+            if vector is not None:
+                self._queries.move_to_end(key)
+                self.stats.hits += 1
+                self.stats.query_hits += 1
+
+                return vector
+
+        loop = asyncio.get_running_loop()
+        vector = (await loop.run_in_executor(self._disk_executor, self._load, [key])).get(key)
+
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await loop.run_in_executor(self._disk_executor, self._store, {key: vector})
+
+            with self._lock:
+                self.stats.misses += 1
+        else:
+            with self._lock:
+                self.stats.hits += 1
+
+        self._remember_query(key, vector)
+
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed many queries, cached like embed_query but the texts not cached
+        are embedded in one call (embed_documents of the embeddings, which
+        for OpenAI is the same as embed_query)
+        :param texts: The texts to embed
+        :return: List of vectors (in the same order as texts)
+        """
+        keys = [self.key(text, "query") for text in texts]
+        found: Dict[str, List[float]] = {}
+
+        with self._lock:
+            for key in keys:
+                vector = self._queries.get(key)
+
+                if vector is not None:
+                    self._queries.move_to_end(key)
+                    found[key] = vector
+
+            self.stats.query_hits += sum(1 for key in keys if key in found)
+
+        found.update(self._load([key for key in keys if key not in found]))
+
+        missing: Dict[str, str] = {}
+        misses = 0
+
+        for key, text in zip(keys, texts):
+            if key not in found:
+                missing.setdefault(key, text)
+                misses += 1
+
+        with self._lock:
+            self.stats.hits += len(texts) - misses
+            self.stats.misses += misses
+
+        if len(missing) > 0:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            embedded = dict(zip(missing.keys(), vectors))
+
+            self._store(embedded)
+            found.update(embedded)
+
+        for key in dict.fromkeys(keys):
+            self._remember_query(key, found[key])
+
+        return [found[key] for key in keys]
+
+    def key(self, text: str, kind: str) -> str:
+        """
+        The cache key of a text
+        :param text: The text
+        :param kind: 'document' or 'query' (some models embed them differently)
+        :return: The key
+        """
+        return hash_text(f"{self.model_name}\0{kind}\0{text}")
+
+    def size(self) -> int:
+        """
+        Number of vectors stored on disk
+        """
+        return self._count
+
+    def close(self):
+        self._disk_executor.shutdown(wait=True)
+
+        with self._lock:
+            self._db.close()
+
+    def _remember_query(self, key: str, vector: List[float]):
+        with self._lock:
+            self._queries[key] = vector
+            self._queries.move_to_end(key)
+
+            while len(self._queries) > self.query_cache_size:
+                self._queries.popitem(last=False)
+
+    def _load(self, keys: List[str]) -> Dict[str, List[float]]:
+        result: Dict[str, List[float]] = {}
+        unique = list(dict.fromkeys(keys))
+
+        with self._lock:
+            # Keep well below SQLite's max number of host parameters
+            for offset in range(0, len(unique), 500):
+                batch = unique[offset:offset + 500]
+                placeholders = ",".join("?" * len(batch))
+
+                for key, blob in self._db.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch):
+                    result[key] = _decode(blob)
+
+                if len(result) > 0:
+                    self._db.execute(
+                        f"UPDATE embeddings SET accessed = ? WHERE key IN ({placeholders})",
+                        [time.time(), *batch],
+                    )
+
+            self._db.commit()
+
+        return result
+
+    def _store(self, vectors: Dict[str, List[float]]):
+        now = time.time()
+
+        with self._lock:
+            before = self._db.total_changes
+
+            self._db.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, accessed) VALUES (?, ?, ?)",
+                [(key, _encode(vector), now) for key, vector in vectors.items()],
+            )
+
+            self._count += self._db.total_changes - before
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        overflow = self._count - self.max_entries
+
+        if overflow <= 0:
+            return
+
+        self._db.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY accessed LIMIT ?)",
+            (overflow,),
+        )
+
+        self._count -= overflow
+        self.stats.evictions += overflow
+
+
+def _encode(vector: List[float]) -> bytes:
+    return array("f", vector).tobytes()
+
+
+def _decode(blob: bytes) -> List[float]:
+    vector = array("f")
+    vector.frombytes(blob)
+
+    return vector.tolist()
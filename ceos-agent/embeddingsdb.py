@@ -1,56 +1,440 @@
 import os
 import shutil
 import json
-from typing import List
-import uuid
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
+from fnmatch import fnmatch
+from functools import partial
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+import numpy as np
 from langchain.docstore.document import Document
-from langchain.vectorstores.chroma import Chroma
+from langchain.vectorstores.utils import maximal_marginal_relevance
 from langchain.schema.embeddings import Embeddings
+from langchain.schema.retriever import BaseRetriever
+from langchain.callbacks.manager import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from manifest import IndexManifest, hash_text
+from bm25 import Bm25Index
+from metadata_index import MetadataFilter, MetadataIndex, header_fields
+from partitions import PartitionPool, partition_key
+from backends.base import SearchHit, VectorBackend
+
+# Names of the vector backends EmbeddingsDb can store the vectors in
+vector_backends = ("chroma", "flat")
+
+
+def open_backend(name: str, index_path: str, quantization: str = None, rescore=4) -> VectorBackend:
+    """
+    Opens (or creates) a vector backend
+    :param name: chroma or flat
+    :param index_path: The directory the backend persists in
+    :param quantization: float16 or int8 to search compressed vectors (flat only)
+    :param rescore: With quantization, candidates per result scored exactly, 0 to keep no float32 vectors
+    :return: The backend
+    """
+    # Imported on use, so that a flat index does not pay for importing chromadb
+    if name == "chroma":
+        if quantization is not None:
+            raise ValueError("The chroma backend does not support quantization")
+
+        from backends.chroma import ChromaBackend
+        return ChromaBackend(index_path)
+
+    if name == "flat":
+        from backends.flat import FlatBackend
+        return FlatBackend(index_path, quantization=quantization, rescore=rescore)
+
+    raise ValueError(f"Unknown vector backend: {name}, expected one of {', '.join(vector_backends)}")
+
+
+def chunk_id(id: Optional[str], text: str) -> str:
+    """
+    The id of a chunk of a file. Identical chunks of different files are
+    stored apart, each with the metadata (source, headers, owner) of its
+    file, the embeddings cache keeps them from being embedded twice.
+    :param id: The id (file path) of the file, if any
+    :param text: The content of the chunk
+    :return: The chunk id
+    """
+    return hash_text(text) if id is None else hash_text(f"{id}\0{text}")
+
+
+def distinct_hits(hits: List[SearchHit]) -> List[SearchHit]:
+    """
+    The hits with distinct content, the best of each. Identical chunks of
+    different files are stored apart (see chunk_id), a search finds them
+    once per file.
+    :param hits: The hits, best first
+    :return: The distinct hits, best first
+    """
+    seen: Set[str] = set()
+    distinct: List[SearchHit] = []
+
+    for hit in hits:
+        if hit.doc.page_content not in seen:
+            seen.add(hit.doc.page_content)
+            distinct.append(hit)
+
+    return distinct
+
+
+def scored_docs(hits: List[SearchHit]) -> List[Document]:
+    """
+    The documents of search hits, with the score in the metadata "score"
+    """
+    for hit in hits:
+        hit.doc.metadata["score"] = hit.score
+
+    return [hit.doc for hit in hits]
+
+
+def select_mmr(vector: List[float], hits: List[SearchHit], k: int) -> List[Document]:
+    """
+    Selects k diverse documents among search hits (that include the vectors)
+    with maximal marginal relevance
+    """
+    if len(hits) == 0:
+        return []
+
+    selected = maximal_marginal_relevance(
+        np.array(vector, dtype=np.float32),
+        [hit.vector for hit in hits],
+        k=k,
+    )
+
+    return [hits[i].doc for i in selected]
+
+
+def merge_rankings(rankings: List[List[Document]], k: int, rrf_k=60) -> List[Document]:
+    """
+    Merges the results of several searches (e.g. the shared index and a
+    partition) by rank with reciprocal rank fusion. Their scores are not
+    comparable (backends score differently, hybrid scores are fused), the
+    metadata "score" is replaced by the fused score. Documents are told
+    apart by their content: one found by more than one search is returned
+    once with the scores added up, repeats within a search are skipped.
+    :param rankings: The results, each best first
+    :param k: Number of documents
+    :param rrf_k: Rank constant of the fusion
+    :return: The k best documents
+    """
+    scores: Dict[str, float] = {}
+    docs: Dict[str, Document] = {}
+
+    # Ties go to the earlier ranking (dicts keep the insertion order, the sort is stable)
+    for ranking in rankings:
+        seen: Set[str] = set()
+
+        for doc in ranking:
+            if doc.page_content in seen:
+                continue
+
+            seen.add(doc.page_content)
+            scores[doc.page_content] = scores.get(doc.page_content, 0.0) + 1.0 / (rrf_k + len(seen))
+            docs.setdefault(doc.page_content, doc)
+
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+
+    for text in best:
+        docs[text].metadata["score"] = scores[text]
+
+    return [docs[text] for text in best]
+
+
+@dataclass
+class IngestStats:
+    """
+    Accumulated ingestion throughput of an EmbeddingsDb
+    """
+    chunks: int = 0
+    embedding_calls: int = 0
+    bytes_written: int = 0
+    seconds: float = 0.0
+
+    def chunks_per_second(self) -> float:
+        return self.chunks / self.seconds if self.seconds > 0 else 0.0
+
+    def since(self, earlier: 'IngestStats') -> 'IngestStats':
+        """
+        The difference between these stats and an earlier snapshot
+        :param earlier: Snapshot taken with copy()
+        :return: The stats accumulated in between
+        """
+        return IngestStats(
+            chunks=self.chunks - earlier.chunks,
+            embedding_calls=self.embedding_calls - earlier.embedding_calls,
+            bytes_written=self.bytes_written - earlier.bytes_written,
+            seconds=self.seconds - earlier.seconds,
+        )
+
+    def copy(self) -> 'IngestStats':
+        return replace(self)
+
+    def __str__(self):
+        return f'{self.chunks} chunks in {self.seconds:.2f}s ({self.chunks_per_second():.1f} chunks/s), ' \
+            f'{self.embedding_calls} embedding calls, {self.bytes_written / 1024:.1f} KiB written'
+
+
+class QueryResult(NamedTuple):
+    """
+    The result of one of the texts of EmbeddingsDb.query_many
+    """
+    text: str
+    docs: List[Document]
+    # Share of the batched embedding calls
+    embed_seconds: float
+    # Share of the batched vector search plus the own (BM25, mmr, fusion) time
+    search_seconds: float
+
+    @property
+    def seconds(self) -> float:
+        return self.embed_seconds + self.search_seconds
+
+
+class EmbeddingsDbRetriever(BaseRetriever):
+    """
+    Retriever that queries an EmbeddingsDb (any of its search types)
+    """
+    embeddings_db: Any
+    search_type: str
+    k: int
+    filter: Any = None
+
+    def _get_relevant_documents(
+            self, query: str, *, run_manager: CallbackManagerForRetrieverRun,
+    ) -> List[Document]:
+        return self.embeddings_db.query_text(query, k=self.k, search_type=self.search_type, filter=self.filter)
+
+    async def _aget_relevant_documents(
+            self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun,
+    ) -> List[Document]:
+        return await self.embeddings_db.aquery_text(query, k=self.k, search_type=self.search_type, filter=self.filter)
+
 
 class EmbeddingsDb:
     """
     Embeddings database
     """
-    chroma: Chroma
+    backend: VectorBackend
+    backend_name: str
     embeddings_path: str = "./data/embeddings"
+    index_path: str
     embeddings: Embeddings
+    manifest: IndexManifest
+    bm25: Bm25Index
+    metadata: MetadataIndex
     search_type: str
     k: int
+    fetch_k: int
+    rrf_k: int
+    search_executor: ThreadPoolExecutor
+    # Bounds the async queries in flight
+    query_semaphore: asyncio.Semaphore
+    embed_batch_size: int
+    stats: IngestStats
+    lock: threading.RLock
+    # Per owner (user or session) partitions, e.g. of uploaded files
+    partitions: Optional[PartitionPool] = None
+    partition_backend: str
+    # The database this is a partition of, and the key of this partition in it
+    parent: Optional['EmbeddingsDb'] = None
+    key: Optional[str] = None
+    # Bumped each time a write is committed, readers can use it to detect
+    # that the index has changed.
+    generation: int = 0
+    # The generation of each partition, kept when a partition is closed
+    partition_generations: Dict[str, int]
 
     def __init__(self,
                  embeddings: Embeddings,
                  search_type="similarity",
                  k=4,
+                 fetch_k=20,
+                 rrf_k=60,
+                 search_workers=4,
+                 async_queries=16,
+                 embed_batch_size=128,
+                 embeddings_path: str = None,
+                 backend="chroma",
+                 quantization: str = None,
+                 rescore=4,
+                 partitions=False,
+                 partition_backend="flat",
+                 partition_idle_seconds=15 * 60,
                  ):
         """
         Constructor
         :param embeddings: The embeddings creator to use.
+        :param search_type: similarity, mmr (maximal marginal relevance) or
+                            hybrid (BM25 and similarity, reciprocal rank fusion)
+        :param k: Number of documents to retrieve
+        :param fetch_k: Number of candidates the k documents are selected from (mmr, hybrid and
+                        identical chunks of different files, which are returned once)
+        :param rrf_k: Rank constant of the reciprocal rank fusion
+        :param search_workers: Number of threads running searches in parallel,
+                               the async queries search on these as well.
+        :param async_queries: Max number of async queries (aquery_text) in flight,
+                              the others wait without blocking the event loop.
+        :param embed_batch_size: Number of chunks embedded per embeddings call
+                                 and upserted per write.
+        :param embeddings_path: Directory of the index, defaults to ./data/embeddings
+        :param backend: Where the vectors are stored and searched, chroma or flat
+                        (in-process matrix, for small corpora). Each backend has
+                        its own index under embeddings_path.
+        :param quantization: float16 or int8 (with a per-vector scale) to search
+                             compressed vectors and re-score the best candidates
+                             exactly, flat backend only.
+        :param rescore: With quantization, number of candidates per result that are
+                        scored exactly, 0 to keep no float32 copy of the vectors.
+        :param partitions: Keep per owner partitions under embeddings_path/partitions,
+                           a query with an owner searches this database and
+                           the owner's partition.
+        :param partition_backend: The backend of the partitions.
+        :param partition_idle_seconds: Seconds an unused partition is kept open.
         """
-        if not os.path.exists(self.embeddings_path):
-            os.makedirs(self.embeddings_path)
+        self.embeddings_path = embeddings_path or self.embeddings_path
+        self.backend_name = backend
+        # Chroma keeps the original layout, other backends use a sub directory
+        self.index_path = self.embeddings_path if backend == "chroma" \
+            else os.path.join(self.embeddings_path, backend)
 
-        self.chroma = Chroma(
-            embedding_function=embeddings,
-            persist_directory=self.embeddings_path,
-        )
+        if not os.path.exists(self.index_path):
+            os.makedirs(self.index_path)
+
+        # Stores indexed with the old per file markers have no chunk ids
+        # and cannot be updated incrementally, start over.
+        if os.path.exists(os.path.join(self.embeddings_path, "indexed")) and \
+                not os.path.exists(self.manifest_path()):
+            self.reset()
+
+        self.manifest = IndexManifest(self.manifest_path())
+
+        self.backend = open_backend(backend, self.index_path, quantization=quantization, rescore=rescore)
+
+        self.bm25 = Bm25Index(self.bm25_path())
+
+        # Store indexed before the BM25 index existed
+        if len(self.bm25) == 0 and self.backend.count() > 0:
+            ids, docs = self.backend.get_all()
+            self.bm25.add(ids=ids, docs=docs)
+
+        # The BM25 index holds every chunk with its metadata
+        self.metadata = MetadataIndex()
+        self.metadata.add(*self.bm25.get_all())
 
         self.embeddings = embeddings
         self.search_type = search_type
         self.k = k
+        self.fetch_k = fetch_k
+        self.rrf_k = rrf_k
+        self.search_executor = ThreadPoolExecutor(max_workers=search_workers, thread_name_prefix="search")
+        self.query_semaphore = asyncio.Semaphore(async_queries)
+        self.embed_batch_size = embed_batch_size
+        self.stats = IngestStats()
+        # Serializes writers (startup indexing, upload indexing, ...)
+        self.lock = threading.RLock()
+
+        self.partition_backend = partition_backend
+        self.partition_generations = {}
+
+        if partitions:
+            self.partitions = PartitionPool(
+                os.path.join(self.embeddings_path, "partitions"),
+                self._open_partition,
+                idle_seconds=partition_idle_seconds,
+            )
 
     def get_embeddings(self) -> Embeddings:
         return self.embeddings
 
-    def as_retriever(self):
+    @contextmanager
+    def partition(self, owner: Optional[str], create=True) -> Iterator[Optional['EmbeddingsDb']]:
         """
-        Return the Chroma object as a retriever
-        :return: Chroma object
+        Leases the partition of an owner for the block, opening (or creating)
+        it if needed. It is not closed while leased.
+        :param owner: The owner (user or session), None for no partition
+        :param create: If the partition shall be created when it does not exist
+        :return: The partition, None if partitions are disabled, owner is
+                 None or it does not exist and create is False
         """
-        return self.chroma.as_retriever(
+        if self.partitions is None or owner is None:
+            yield None
+            return
+
+        with self.partitions.lease(partition_key(owner), create=create) as partition:
+            yield partition
+
+    def has_partition(self, owner: str) -> bool:
+        return self.partitions is not None and owner is not None and \
+            self.partitions.exists(partition_key(owner))
+
+    def _open_partition(self, key: str, path: str) -> 'EmbeddingsDb':
+        partition = EmbeddingsDb(
+            embeddings=self.embeddings,
             search_type=self.search_type,
-            search_kwargs={"k": self.k},
+            k=self.k,
+            fetch_k=self.fetch_k,
+            rrf_k=self.rrf_k,
+            search_workers=2,
+            embed_batch_size=self.embed_batch_size,
+            embeddings_path=path,
+            backend=self.partition_backend,
         )
 
+        partition.parent = self
+        partition.key = key
+
+        return partition
+
+    def partition_generation(self, owner: Optional[str]) -> int:
+        """
+        :param owner: The owner (user or session)
+        :return: Bumped each time a write is committed to the partition of the
+                 owner (while this database is open), 0 if it has none
+        """
+        return self.partition_generations.get(partition_key(owner), 0) if owner is not None else 0
+
+    def changed(self):
+        """
+        Records that a write was committed. A partition records it in its
+        partition generation of the database it is a partition of, not in
+        the generation of that database, since only the owner's searches see
+        the partition.
+        """
+        self.generation += 1
+
+        # The writes of a partition are serialized by its lock
+        if self.parent is not None:
+            self.parent.partition_generations[self.key] = self.parent.partition_generations.get(self.key, 0) + 1
+
+    def close(self):
+        """
+        Closes the backend, the open partitions and the search threads
+        """
+        if self.partitions is not None:
+            self.partitions.close()
+
+        self.search_executor.shutdown(wait=False)
+        self.backend.close()
+        self.bm25.close()
+
+    def manifest_path(self) -> str:
+        return os.path.join(self.index_path, "manifest.json")
+
+    def bm25_path(self) -> str:
+        return os.path.join(self.index_path, "bm25.json")
+
+    def as_retriever(self, filter: MetadataFilter = None) -> BaseRetriever:
+        """
+        Return the database as a retriever using the search type and k of the database
+        :param filter: Optional filter the retrieved documents must match
+        :return: The retriever
+        """
+        return EmbeddingsDbRetriever(embeddings_db=self, search_type=self.search_type, k=self.k, filter=filter)
+
     def embed(self, text: str) -> List[float]:
         """
         Embed a text
@@ -59,69 +443,483 @@ class EmbeddingsDb:
         """
         return self.embeddings.embed_query(text)
 
+    async def aembed(self, text: str) -> List[float]:
+        """
+        Embed a text with the async client of the embeddings
+        :param text: Text to embed
+        :return: List of floats
+        """
+        return await self.embeddings.aembed_query(text)
+
     def reset(self):
         """
-        Reset the vector store by delete all files and recreating the directory
-        where the embeddings are stored.
+        Reset the vector store by clearing the backend and deleting the
+        manifest and the BM25 index. Before the backend is opened, all files
+        where the embeddings are stored are deleted.
         :return:
         """
-        if not os.path.exists(self.embeddings_path):
-            return
+        if hasattr(self, "backend"):
+            self.backend.clear()
+
+            for item_path in [self.manifest_path(), self.bm25_path()]:
+                if os.path.exists(item_path):
+                    os.remove(item_path)
+        elif os.path.exists(self.embeddings_path):
+            for item in os.listdir(self.embeddings_path):
+                item_path = os.path.join(self.embeddings_path, item)
+
+                if os.path.isfile(item_path):
+                    os.remove(item_path)
+                elif os.path.isdir(item_path):
+                    shutil.rmtree(item_path)
+
+        self.manifest = IndexManifest(self.manifest_path())
 
-        for item in os.listdir(self.embeddings_path):
-            item_path = os.path.join(self.embeddings_path, item)
+        if hasattr(self, "bm25"):
+            self.bm25.clear()
+            self.metadata.clear()
 
-            if os.path.isfile(item_path):
-                os.remove(item_path)
-            elif os.path.isdir(item_path):
-                shutil.rmtree(item_path)
+        self.changed()
 
-    def query_text(self, text: str) -> List[Document]:
+    def query_text(self, text: str, k: int = None, search_type: str = None,
+                   filter: MetadataFilter = None, owner: str = None) -> List[Document]:
         """
-        Query the vector store for the given text
+        Query the vector store for the given text. Identical chunks of
+        different files are returned once (fetch_k candidates are searched),
+        so this returns k distinct documents unless fewer are stored.
+        Similarity and hybrid searches set the metadata "score" (higher is
+        better).
         :param text: Text to query
+        :param k: Number of documents, defaults to k of the database
+        :param search_type: similarity, mmr or hybrid, defaults to search_type of the database
+        :param filter: Optional filter, only the matching chunks are searched
+        :param owner: Optional owner, whose partition (if any) is searched as well
         :return: List of Document objects
         """
-        docs = self.chroma.as_retriever().get_relevant_documents(query=text)
+        k = k or self.k
+        search_type = search_type or self.search_type
+        with self.partition(owner, create=False) as partition:
+            result = self._query_text(text, k, search_type, filter)
 
-        seen_ids = set()
-        result: List[Document] = []
+            if partition is None:
+                return result
 
-        for doc in docs:
-            if str(uuid.uuid5(uuid.NAMESPACE_DNS, doc.page_content)) not in seen_ids:
-                result.append(doc)
+            return merge_rankings([result, partition.query_text(text, k, search_type, filter)], k, self.rrf_k)
+
+    async def aquery_text(self, text: str, k: int = None, search_type: str = None,
+                          filter: MetadataFilter = None, owner: str = None) -> List[Document]:
+        """
+        Same as query_text without blocking the event loop. The text is
+        embedded by the async client of the embeddings while the BM25 search
+        (hybrid) runs, the searches run on the search threads.
+        :param text: Text to query
+        :param k: Number of documents, defaults to k of the database
+        :param search_type: similarity, mmr or hybrid, defaults to search_type of the database
+        :param filter: Optional filter, only the matching chunks are searched
+        :param owner: Optional owner, whose partition (if any) is searched as well
+        :return: List of Document objects
+        """
+        k = k or self.k
+        search_type = search_type or self.search_type
+
+        key = partition_key(owner) if owner is not None and self.partitions is not None else None
+
+        async with self.query_semaphore:
+            # Opening a partition reads it from disk
+            partition = await self._run(self.partitions.acquire, key, False) if key is not None else None
+            vector = asyncio.ensure_future(self.aembed(text))
+
+            try:
+                searches = [self._asearch(text, vector, k, search_type, filter)]
+
+                if partition is not None:
+                    searches.append(partition._asearch(text, vector, k, search_type, filter))
 
-                seen_ids.add(
-                    str(uuid.uuid5(uuid.NAMESPACE_DNS, doc.page_content)))
+                results = await asyncio.gather(*searches)
+            finally:
+                vector.cancel()
 
-        return result
+                if partition is not None:
+                    # Closing it (when due) may wait for its searches
+                    await self._run(self.partitions.release, key)
+
+        return results[0] if len(results) == 1 else merge_rankings(results, k, self.rrf_k)
+
+    async def _asearch(self, text: str, vector: Awaitable[List[float]], k: int, search_type: str,
+                       filter: MetadataFilter) -> List[Document]:
+        """
+        The async search of aquery_text
+        :param vector: The embedding of the text, awaited when needed
+        """
+        ids, where = None, None
+
+        # Resolving sources goes through every indexed file
+        if filter is not None and not filter.is_empty():
+            ids, where = await self._run(lambda: (self.select(filter), self.where(filter)))
+
+            if len(ids) == 0:
+                return []
+
+        fetch_k = max(k, self.fetch_k)
+
+        if search_type == "hybrid":
+            sparse = self._run(self.bm25.search, text, fetch_k, ids)
+            dense = await self._run(self.backend.search, await vector, fetch_k, False, ids, where)
+
+            return self.fuse(dense, await sparse, k)
+
+        if search_type == "mmr":
+            embedded = await vector
+            hits = await self._run(self.backend.search, embedded, fetch_k, True, ids, where)
+
+            return select_mmr(embedded, distinct_hits(hits), k)
+
+        hits = await self._run(self.backend.search, await vector, fetch_k, False, ids, where)
+
+        return scored_docs(distinct_hits(hits)[:k])
+
+    def _run(self, func: Callable, *args) -> Awaitable:
+        """
+        Runs a function on the search threads
+        """
+        return asyncio.get_running_loop().run_in_executor(self.search_executor, partial(func, *args))
+
+    def _query_text(self, text: str, k: int, search_type: str, filter: MetadataFilter) -> List[Document]:
+        ids = self.select(filter)
+
+        if ids is not None and len(ids) == 0:
+            return []
+
+        where = self.where(filter)
+
+        if search_type == "hybrid":
+            return self.hybrid_search(text, k=k, ids=ids, where=where)
+
+        if search_type == "mmr":
+            return self.mmr_search(text, k=k, ids=ids, where=where)
+
+        return self.similarity_search(text, k=k, ids=ids, where=where)
+
+    def select(self, filter: Optional[MetadataFilter]) -> Optional[Set[str]]:
+        """
+        Resolves a filter into the chunks that match it. Sources are matched
+        against the files in the manifest, headers and owner are looked up
+        in the metadata index.
+        :param filter: The filter
+        :return: Set of chunk ids, or None if all chunks match
+        """
+        if filter is None or filter.is_empty():
+            return None
+
+        selections: List[Set[str]] = []
+
+        if len(filter.sources) > 0:
+            selected: Set[str] = set()
+
+            for file_path in self.source_files(filter):
+                selected.update(self.manifest.chunk_ids(file_path))
+
+            selections.append(selected)
+
+        for name, value in zip(header_fields, filter.headers):
+            selections.append(self.metadata.match(name, value))
+
+        if filter.owner is not None:
+            selections.append(self.metadata.match("owner", filter.owner))
+
+        selections.sort(key=len)
+
+        return selections[0].intersection(*selections[1:])
+
+    def where(self, filter: Optional[MetadataFilter]) -> Optional[dict]:
+        """
+        The same chunks as select as a (Chroma) where clause on the chunk
+        metadata, so that a backend can filter while it searches instead of
+        scanning the selected chunks (see VectorBackend.search)
+        :param filter: The filter
+        :return: The where clause, or None if all chunks match
+        """
+        if filter is None or filter.is_empty():
+            return None
+
+        conditions: List[dict] = []
+
+        if len(filter.sources) > 0:
+            conditions.append({"file": {"$in": self.source_files(filter)}})
+
+        for name, value in zip(header_fields, filter.headers):
+            conditions.append({name: value})
+
+        if filter.owner is not None:
+            conditions.append({"owner": filter.owner})
+
+        return conditions[0] if len(conditions) == 1 else {"$and": conditions}
+
+    def source_files(self, filter: MetadataFilter) -> List[str]:
+        """
+        Resolves the sources of a filter into the indexed files they match
+        :param filter: The filter
+        :return: List of file paths
+        """
+        # A copy, files may be indexed meanwhile
+        return [
+            file_path for file_path in list(self.manifest.files)
+            if any(file_path == source or fnmatch(file_path, source) for source in filter.sources)
+        ]
+
+    def similarity_search(self, text: str, k: int, ids: Set[str] = None, where: dict = None) -> List[Document]:
+        """
+        Dense similarity search
+        :param text: Text to query
+        :param k: Number of documents
+        :param ids: Only search among these chunks
+        :param where: The same chunks as ids as a where clause (see where)
+        :return: List of Document objects, best first
+        """
+        hits = self.backend.search(self.embed(text), k=max(k, self.fetch_k), ids=ids, where=where)
+
+        return scored_docs(distinct_hits(hits)[:k])
+
+    def mmr_search(self, text: str, k: int, ids: Set[str] = None, where: dict = None) -> List[Document]:
+        """
+        Selects k diverse documents among the fetch_k most similar
+        (maximal marginal relevance)
+        :param text: Text to query
+        :param k: Number of documents
+        :param ids: Only search among these chunks
+        :param where: The same chunks as ids as a where clause (see where)
+        :return: List of Document objects
+        """
+        vector = self.embed(text)
+        hits = self.backend.search(vector, k=max(k, self.fetch_k), include_vectors=True, ids=ids, where=where)
+
+        return select_mmr(vector, distinct_hits(hits), k)
+
+    def hybrid_search(self, text: str, k: int, ids: Set[str] = None, where: dict = None) -> List[Document]:
+        """
+        Runs the BM25 and the similarity search in parallel and merges the
+        two rankings with reciprocal rank fusion.
+        :param text: Text to query
+        :param k: Number of documents
+        :param ids: Only search among these chunks
+        :param where: The same chunks as ids as a where clause (see where)
+        :return: List of Document objects, best first
+        """
+        fetch_k = max(k, self.fetch_k)
+
+        dense = self.search_executor.submit(
+            lambda: self.backend.search(self.embed(text), k=fetch_k, ids=ids, where=where))
+        sparse = self.search_executor.submit(self.bm25.search, text, fetch_k, ids)
+
+        return self.fuse(dense.result(), sparse.result(), k)
+
+    def fuse(self, dense: List[SearchHit], sparse: List[Tuple[str, Document, float]], k: int) -> List[Document]:
+        """
+        Merges a dense and a BM25 ranking with reciprocal rank fusion (see
+        merge_rankings, identical chunks of different files count once)
+        :param dense: Hits of the similarity search, best first
+        :param sparse: Result of the BM25 search
+        :param k: Number of documents
+        :return: List of Document objects, best first
+        """
+        return merge_rankings([[hit.doc for hit in dense], [doc for _, doc, _ in sparse]], k, self.rrf_k)
+
+    def embed_many(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed many query texts, embed_batch_size texts per embeddings call.
+        Uses embed_queries of the embeddings if available (CachedEmbeddings),
+        otherwise embed_documents, i.e. it assumes that queries and documents
+        are embedded the same way (as by OpenAI).
+        :param texts: Texts to embed
+        :return: List of vectors (in the same order as texts)
+        """
+        embed = getattr(self.embeddings, "embed_queries", None) or self.embeddings.embed_documents
+        vectors: List[List[float]] = []
+
+        for offset in range(0, len(texts), self.embed_batch_size):
+            vectors.extend(embed(texts[offset:offset + self.embed_batch_size]))
+
+        return vectors
+
+    def query_many(self, texts: List[str], k: int = None, search_type: str = None,
+                   filter: MetadataFilter = None, owner: str = None) -> List[QueryResult]:
+        """
+        Query many texts at once (e.g. offline evaluation). The texts are
+        embedded in batches and the vector search of all texts is done at
+        once by the backend, the result is the same as query_text of each.
+        :param texts: Texts to query
+        :param k: Number of documents per text, defaults to k of the database
+        :param search_type: similarity, mmr or hybrid, defaults to search_type of the database
+        :param filter: Optional filter, only the matching chunks are searched
+        :param owner: Optional owner, whose partition (if any) is searched as well
+        :return: One result per text, in the same order as texts
+        """
+        if len(texts) == 0:
+            return []
+
+        k = k or self.k
+        search_type = search_type or self.search_type
+
+        start = time.perf_counter()
+        vectors = self.embed_many(texts)
+        embed_seconds = (time.perf_counter() - start) / len(texts)
+
+        docs, seconds = self._query_vectors(texts, vectors, k, search_type, filter)
+
+        with self.partition(owner, create=False) as partition:
+            if partition is not None:
+                partition_docs, partition_seconds = partition._query_vectors(texts, vectors, k, search_type, filter)
+                docs = [merge_rankings([a, b], k, self.rrf_k) for a, b in zip(docs, partition_docs)]
+                seconds = [a + b for a, b in zip(seconds, partition_seconds)]
+
+        return [
+            QueryResult(text=text, docs=text_docs, embed_seconds=embed_seconds, search_seconds=text_seconds)
+            for text, text_docs, text_seconds in zip(texts, docs, seconds)
+        ]
+
+    def _query_vectors(self, texts: List[str], vectors: List[List[float]], k: int, search_type: str,
+                       filter: MetadataFilter) -> Tuple[List[List[Document]], List[float]]:
+        """
+        Searches embedded texts, the time of the shared vector search is split
+        evenly between the texts
+        :return: The documents and the search seconds of each text
+        """
+        ids = self.select(filter)
+
+        if ids is not None and len(ids) == 0:
+            return [[] for _ in texts], [0.0 for _ in texts]
+
+        start = time.perf_counter()
+        fetch_k = max(k, self.fetch_k)
+        hits = self.backend.search_many(vectors, k=fetch_k, include_vectors=search_type == "mmr", ids=ids,
+                                        where=self.where(filter))
+        shared = (time.perf_counter() - start) / len(texts)
+
+        docs: List[List[Document]] = []
+        seconds: List[float] = []
+
+        for text, vector, text_hits in zip(texts, vectors, hits):
+            start = time.perf_counter()
+
+            if search_type == "hybrid":
+                docs.append(self.fuse(text_hits, self.bm25.search(text, fetch_k, ids), k))
+            elif search_type == "mmr":
+                docs.append(select_mmr(vector, distinct_hits(text_hits), k))
+            else:
+                docs.append(scored_docs(distinct_hits(text_hits)[:k]))
+
+            seconds.append(shared + time.perf_counter() - start)
+
+        return docs, seconds
+
+    def is_indexed(self, id: str) -> bool:
+        """
+        Checks if the file is indexed and unchanged since, without parsing it.
+        :param id: The file path that was used as id when stored
+        :return: True if the file can be skipped
+        """
+        return self.manifest.is_unchanged(id)
+
+    def indexed_files(self, pattern: str = None) -> List[str]:
+        """
+        Gets the ids (file paths) that are indexed
+        :param pattern: Optional pattern to match e.g. 'data/*.txt'
+        :return: List of ids
+        """
+        return self.manifest.indexed_files(pattern)
 
     def store_structured_data(self, docs: List[Document], id: str = None) -> bool:
         """
         Store structured data in the vector store
         :param docs:    List of Document objects
-        :param id:      Optional id, of which it checks if already indexed and skips
-                        if such is the case. 
-        :return:        True if the data was stored, False if the data was skipped
+        :param id:      Optional id (file path). When set, only the chunks that
+                        have changed since last time are embedded and chunks no
+                        longer present are removed.
+        :return:        True if the data was stored, False if nothing changed
         """
-        if not os.path.exists(self.embeddings_path):
-            os.makedirs(self.embeddings_path)
+        if not os.path.exists(self.index_path):
+            os.makedirs(self.index_path)
+
+        # Identical chunks within a file are stored once
+        chunks: Dict[str, Document] = {}
 
-        id_path = os.path.join(self.embeddings_path, "indexed", id)
+        for doc in docs:
+            # What source filters match on (see where)
+            if id is not None:
+                doc.metadata["file"] = id
 
-        if id is not None and os.path.exists(id_path):
-            return False
+            chunks.setdefault(chunk_id(id, doc.page_content), doc)
 
-        self.chroma.from_documents(
-            documents=docs,            
-            persist_directory=self.embeddings_path,
-            embedding=self.embeddings,
-        )
+        with self.lock:
+            previous = set(self.manifest.chunk_ids(id)) if id is not None else set()
+            added = [chunk_id for chunk_id in chunks if chunk_id not in previous]
+            removed = [chunk_id for chunk_id in previous if chunk_id not in chunks]
+
+            if len(added) > 0:
+                self.upsert(ids=added, docs=[chunks[chunk_id] for chunk_id in added])
+                self.bm25.add(ids=added, docs=[chunks[chunk_id] for chunk_id in added])
+                self.metadata.add(ids=added, docs=[chunks[chunk_id] for chunk_id in added])
+
+            if id is not None:
+                self.manifest.update(id, list(chunks.keys()))
+
+            if len(removed) > 0:
+                self.backend.delete(ids=removed)
+                self.bm25.remove(ids=removed)
+                self.metadata.remove(ids=removed)
+
+            if len(added) > 0 or len(removed) > 0:
+                self.changed()
+
+        return len(added) > 0 or len(removed) > 0
+
+    def upsert(self, ids: List[str], docs: List[Document]):
+        """
+        Embeds the documents in batches of embed_batch_size and upserts each
+        batch into the backend.
+        :param ids: The (deterministic) chunk ids, one per document
+        :param docs: The documents to embed and store
+        """
+        start = time.perf_counter()
+
+        for offset in range(0, len(docs), self.embed_batch_size):
+            batch_ids = ids[offset:offset + self.embed_batch_size]
+            texts = [doc.page_content for doc in docs[offset:offset + self.embed_batch_size]]
+            metadatas = [doc.metadata or None for doc in docs[offset:offset + self.embed_batch_size]]
+
+            vectors = self.embeddings.embed_documents(texts)
+            self.stats.embedding_calls += 1
+
+            self.backend.upsert(
+                ids=batch_ids,
+                vectors=vectors,
+                docs=docs[offset:offset + self.embed_batch_size],
+            )
+
+            self.stats.chunks += len(batch_ids)
+            self.stats.bytes_written += sum(4 * len(vector) for vector in vectors) + \
+                sum(len(text.encode("utf-8")) for text in texts) + \
+                sum(len(json.dumps(metadata)) for metadata in metadatas if metadata is not None)
+
+        self.stats.seconds += time.perf_counter() - start
+
+    def remove_structured_data(self, id: str) -> bool:
+        """
+        Remove all chunks stored for the id from the vector store
+        :param id: The id (file path) used when the data was stored
+        :return: True if the id was indexed, False otherwise
+        """
+        with self.lock:
+            if id not in self.manifest.files:
+                return False
+
+            chunk_ids = self.manifest.chunk_ids(id)
+            self.manifest.remove(id)
 
-        # Mark id as already done
-        if id is not None:
-            os.makedirs(os.path.dirname(id_path), exist_ok=True)
-            with open(id_path, "w") as f:
-                f.write(id)
+            if len(chunk_ids) > 0:
+                self.backend.delete(ids=chunk_ids)
+                self.bm25.remove(ids=chunk_ids)
+                self.metadata.remove(ids=chunk_ids)
+                self.changed()
 
         return True
@@ -1,24 +1,148 @@
 import os
+import queue
+import time
+import shutil
+import threading
+from typing import Callable, Dict, Iterable, Iterator, List
 from embeddingsdb import EmbeddingsDb
-from scanner import scan_directory, is_binary_file
+from partitions import partition_key, session_owner_prefix, latest_mtime
+from scanner import ScanResult, find_files, iter_scan_files, scan_file, scan_file_in_pool, is_binary_file
 
 user_file_path = os.path.join(os.path.dirname(__file__), "data", "user")
 
-def index_files(pattern: str, embeddings: EmbeddingsDb):
-  training = scan_directory(pattern)
+# Number of processes used to parse files (CEOS_SCAN_WORKERS=1 to parse in-process)
+scan_workers = int(os.environ.get("CEOS_SCAN_WORKERS", os.cpu_count() or 1))
 
-  for text in training:
-    if len(text) == 0:
+# Number of parsed files that may wait for the embedding/storage stage
+ingest_queue_size = int(os.environ.get("CEOS_INGEST_QUEUE_SIZE", 4))
+
+def index_files(pattern: str, embeddings: EmbeddingsDb, workers: int = None, owner: str = None):
+  """
+  index_files will index the files matching the pattern. Unchanged files
+  are skipped without being parsed, changed files only embeds the chunks
+  that changed and removed files are dropped from the index.
+
+  :param pattern: Pattern to match e.g. 'data/*.txt'
+  :param embeddings: The embeddings database to use.
+  :param workers: Number of processes to parse with, defaults to scan_workers.
+  :param owner: Optional owner recorded as "owner" metadata on the chunks.
+  :return: None
+  """
+  changed: List[str] = []
+
+  for file in find_files(pattern):
+    if embeddings.is_indexed(file):
+      print(f'\n*** SKIPPED: {file} ***')
+    else:
+      changed.append(file)
+
+  index_results(iter_scan_files(changed, workers=workers or scan_workers), embeddings, owner=owner)
+
+  for file in embeddings.indexed_files(pattern):
+    if not os.path.exists(file):
+      embeddings.remove_structured_data(id=file)
+      print(f'\n*** REMOVED: {file} ***')
+
+def index_results(results: Iterable[ScanResult], embeddings: EmbeddingsDb, owner: str = None):
+  """
+  index_results will store parsed results as they are produced. Parsing
+  runs in a background thread and hands over results through a bounded
+  queue, so embedding and storing runs while parsing continues and
+  parsing is held back when storage falls behind.
+
+  :param results: The parsed results e.g. from iter_scan_files or iter_scan_urls.
+  :param embeddings: The embeddings database to use.
+  :param owner: Optional owner recorded as "owner" metadata on the chunks.
+  :return: None
+  """
+  before = embeddings.stats.copy()
+  parse_times: Dict[str, List[float]] = {}
+
+  for result in stream_results(results, queue_size=ingest_queue_size):
+    file = result.file_path
+    parse_times.setdefault(result.strategy or "unknown", []).append(result.seconds)
+
+    if result.error is not None:
+      print(f'\n*** FAILED: {file} ({result.seconds:.2f}s): {result.error} ***')
       continue
 
-    file = text[0].metadata["file"]
-    stored = embeddings.store_structured_data(docs=text, id=file)
+    print(f'\n*** PARSED: {file} ({len(result.docs)} chunks, {result.strategy}, {result.seconds:.2f}s) ***')
+
+    if owner is not None:
+      for doc in result.docs:
+        doc.metadata["owner"] = owner
+
+    stored = embeddings.store_structured_data(docs=result.docs, id=file)
 
     if stored:
       print(f'\n*** STORED: {file} ***')
     else:
       print(f'\n*** SKIPPED: {file} ***')
 
+  stats = embeddings.stats.since(before)
+
+  if stats.chunks > 0:
+    print(f'\n*** INGESTED: {stats} ***')
+
+  for strategy, seconds in parse_times.items():
+    print(f'\n*** PARSE STRATEGY: {strategy}: {len(seconds)} files in {sum(seconds):.2f}s '
+          f'({sum(seconds) / len(seconds):.2f}s/file) ***')
+
+def stream_results(results: Iterable[ScanResult], queue_size: int) -> Iterator[ScanResult]:
+  """
+  stream_results will drain the results in a background thread into a
+  bounded queue and yield them in order. When the queue is full the
+  producer blocks (backpressure).
+
+  :param results: The results to drain.
+  :param queue_size: The max number of results waiting in the queue.
+  :return: Generator of ScanResult
+  """
+  done = object()
+  stop = threading.Event()
+  pending: queue.Queue = queue.Queue(maxsize=queue_size)
+
+  def put(item: any) -> bool:
+    while not stop.is_set():
+      try:
+        pending.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        continue
+
+    return False
+
+  def produce():
+    try:
+      for result in results:
+        if not put(result):
+          return
+
+      put(done)
+    except BaseException as e:
+      put(e)
+    finally:
+      if hasattr(results, "close"):
+        results.close()
+
+  producer = threading.Thread(target=produce, name="ingest-producer", daemon=True)
+  producer.start()
+
+  try:
+    while True:
+      item = pending.get()
+
+      if item is done:
+        return
+
+      if isinstance(item, BaseException):
+        raise item
+
+      yield item
+  finally:
+    stop.set()
+    producer.join()
+
 def system_index(embeddings: EmbeddingsDb):
   """
   system_index will index training and knowledge (if needed) and
@@ -30,34 +154,255 @@ def system_index(embeddings: EmbeddingsDb):
   index_files(pattern="data/training/*.md", embeddings=embeddings)
   index_files(pattern="data/knowledge/*.md", embeddings=embeddings)
 
-def user_index(embeddings: EmbeddingsDb):
+def user_index(embeddings: EmbeddingsDb, session_ttl: float = 24 * 3600):
   """
-  user_index will index the user's uploaded files
+  user_index will index the user's uploaded files. Files directly under
+  data/user are shared, the files of an owner (data/user/<owner>) are
+  indexed into the owner's partition, if partitions are enabled. The
+  uploads of sessions (not authenticated) older than session_ttl are
+  removed first.
   
   :param embeddings: The embeddings database to use.
+  :param session_ttl: Seconds the uploads of a session are kept.
   :return: None
   """
   index_files(pattern="data/user/*.*", embeddings=embeddings)
 
+  if embeddings.partitions is None:
+    return
+
+  expire_session_uploads(embeddings, session_ttl)
+
+  # The directories are named by the partition key of the owner, which is
+  # the owner itself for user names, e-mails and session ids
+  for key in sorted(os.listdir(user_file_path)):
+    if os.path.isdir(os.path.join(user_file_path, key)):
+      with embeddings.partitions.lease(key) as partition:
+        index_files(pattern=f"data/user/{key}/*.*", embeddings=partition, owner=key)
+
+  embeddings.partitions.evict_idle()
+
+def expire_session_uploads(embeddings: EmbeddingsDb, max_age_seconds: float) -> List[str]:
+  """
+  expire_session_uploads will remove the uploads (files and partition) of
+  sessions that have not uploaded anything for max_age_seconds, a session
+  id is never seen again once the session is gone.
+
+  :param embeddings: The embeddings database (with partitions).
+  :param max_age_seconds: Seconds since the last upload.
+  :return: The removed partition keys
+  """
+  now = time.time()
+  keys = set(embeddings.partitions.keys())
+
+  if os.path.isdir(user_file_path):
+    keys.update(key for key in os.listdir(user_file_path) if os.path.isdir(os.path.join(user_file_path, key)))
+
+  removed = []
+
+  for key in sorted(keys):
+    if not key.startswith(session_owner_prefix):
+      continue
+
+    uploads = os.path.join(user_file_path, key)
+    age = now - max(latest_mtime(uploads), latest_mtime(embeddings.partitions.path(key)))
+
+    if age > max_age_seconds and embeddings.partitions.remove(key):
+      shutil.rmtree(uploads, ignore_errors=True)
+      removed.append(key)
+
+  if len(removed) > 0:
+    print(f'\n*** EXPIRED: the uploads of {len(removed)} sessions ***')
+
+  return removed
+
+class IndexStatus:
+  """
+  Readiness of the startup indexing that runs in the background. Until
+  it is ready, queries are answered from what has been indexed so far.
+  """
+  state: str
+  message: str
+  started: float
+  finished: float | None
+
+  def __init__(self):
+    self.state = "pending"
+    self.message = "waiting to start"
+    self.started = time.time()
+    self.finished = None
+    self._ready = threading.Event()
+    self._lock = threading.Lock()
+    self._callbacks: List[Callable[[], None]] = []
+
+  def is_ready(self) -> bool:
+    return self._ready.is_set()
+
+  def wait(self, timeout: float = None) -> bool:
+    """
+    Blocks until the indexing is done (successfully or not)
+    :param timeout: Max seconds to wait, None waits forever
+    :return: True if done
+    """
+    return self._ready.wait(timeout)
+
+  def on_ready(self, callback: Callable[[], None]):
+    """
+    Calls back once the indexing is done (successfully or not), on the
+    indexing thread or right away if it is already done
+    :param callback: The callback, e.g. loop.call_soon_threadsafe of an event
+    """
+    with self._lock:
+      if not self._ready.is_set():
+        self._callbacks.append(callback)
+        return
+
+    callback()
+
+  def update(self, state: str, message: str):
+    self.state = state
+    self.message = message
+
+    if state in ("ready", "failed"):
+      self.finished = time.time()
+
+      with self._lock:
+        self._ready.set()
+        callbacks, self._callbacks = self._callbacks, []
+
+      for callback in callbacks:
+        callback()
+
+  def __str__(self):
+    elapsed = (self.finished or time.time()) - self.started
+    return f'{self.state}: {self.message} ({elapsed:.0f}s)'
+
+def start_background_index(embeddings: EmbeddingsDb, session_ttl: float = 24 * 3600) -> IndexStatus:
+  """
+  start_background_index will run system_index and user_index in a
+  background thread and return immediately.
+
+  :param embeddings: The embeddings database to use.
+  :param session_ttl: Seconds the uploads of a session are kept (see user_index).
+  :return: The status to follow the indexing with
+  """
+  status = IndexStatus()
+
+  def run():
+    try:
+      status.update("indexing", "system documents")
+      system_index(embeddings=embeddings)
+      status.update("indexing", "uploaded documents")
+      user_index(embeddings=embeddings, session_ttl=session_ttl)
+      status.update("ready", f"index generation {embeddings.generation}")
+    except Exception as e:
+      print(f'\n*** INDEXING FAILED: {type(e).__name__}: {e} ***')
+      status.update("failed", f"{type(e).__name__}: {e}")
+
+  threading.Thread(target=run, name="startup-index", daemon=True).start()
+
+  return status
+
 def add_file_to_user_index(
       file_name: str, 
       embeddings_db: EmbeddingsDb,
-      content: bytes | str | None
-      ):
+      content: bytes | str | None,
+      progress: Callable[[str], None] = None,
+      owner: str = None,
+      ) -> bool:
       """
       add_file_to_user_index will add a file to the user index
-      and reindex the user index
+      and index that file only
 
       :param file_name: The name of the file to add.
       :param embeddings_db: The embeddings database to use.
       :param content: The content of the file to add.
+      :param progress: Optional callback that receives progress messages.
+      :param owner: Optional owner (user or session). The file is stored in
+                    data/user/<owner> and indexed into the owner's partition,
+                    if partitions are enabled.
+      :return: True if the file was indexed, False if it failed to parse
+      """
+      progress = progress or (lambda message: None)
+
+      if owner is not None and embeddings_db.partitions is not None:
+          # Leased, so it is not closed while parsing and storing
+          with embeddings_db.partition(owner) as partition:
+              return save_and_index(
+                  os.path.join(user_file_path, partition_key(owner)), file_name, content, partition, progress, owner
+              )
+
+      return save_and_index(user_file_path, file_name, content, embeddings_db, progress, owner)
+
+def save_and_index(
+      directory: str,
+      file_name: str,
+      content: bytes | str | None,
+      embeddings_db: EmbeddingsDb,
+      progress: Callable[[str], None],
+      owner: str = None,
+      ) -> bool:
+      """
+      save_and_index will store an uploaded file in the directory and index it
       """
+      os.makedirs(directory, exist_ok=True)
+      file_path = os.path.join(directory, os.path.basename(file_name))
 
       if is_binary_file(file_name):
-          with open(os.path.join(user_file_path, file_name), "wb") as f:
+          with open(file_path, "wb") as f:
               f.write(content)
       else:
-          with open(os.path.join(user_file_path, file_name), "w") as f:
+          with open(file_path, "w") as f:
               f.write(content.decode("utf-8"))
 
-      user_index(embeddings=embeddings_db)
+      progress(f"Saved `{file_name}`")
+
+      # Same id as when user_index finds the file
+      return index_file(os.path.relpath(file_path), embeddings_db, progress, owner=owner)
+
+def index_file(
+      file_path: str,
+      embeddings: EmbeddingsDb,
+      progress: Callable[[str], None] = None,
+      owner: str = None,
+      ) -> bool:
+      """
+      index_file will parse and store a single file
+
+      :param file_path: The file to index.
+      :param embeddings: The embeddings database to use.
+      :param progress: Optional callback that receives progress messages.
+      :param owner: Optional owner recorded as "owner" metadata on the chunks.
+      :return: True if the file was indexed, False if it failed to parse
+      """
+      progress = progress or (lambda message: None)
+
+      # Parsed in another process, so that the chats are not stalled meanwhile
+      if scan_workers > 1:
+          result = scan_file_in_pool(file_path, workers=scan_workers)
+      else:
+          result = scan_file(file_path)
+
+      if result.error is not None:
+          print(f'\n*** FAILED: {file_path} ({result.seconds:.2f}s): {result.error} ***')
+          progress(f"Failed to parse: {result.error}")
+          return False
+
+      progress(f"Parsed {len(result.docs)} chunks in {result.seconds:.2f}s ({result.strategy})")
+
+      if owner is not None:
+          for doc in result.docs:
+              doc.metadata["owner"] = owner
+
+      before = embeddings.stats.copy()
+      stored = embeddings.store_structured_data(docs=result.docs, id=file_path)
+      stats = embeddings.stats.since(before)
+
+      if stored:
+          print(f'\n*** STORED: {file_path} ({stats}) ***')
+          progress(f"Stored {stats}")
+      else:
+          print(f'\n*** SKIPPED: {file_path} ***')
+          progress("Already indexed")
+
+      return True
@@ -0,0 +1,83 @@
+import os
+import json
+from typing import Iterator
+
+
+class Journal:
+    """
+    Append-only log of the changes made since a JSON snapshot was written
+    (e.g. the BM25 index), one JSON line per change. A change costs a write
+    of its own size instead of a rewrite of the snapshot. The owner replays
+    the log after loading the snapshot and rewrites the snapshot (then
+    truncates the log) when due(), i.e. once the log has grown larger than
+    the snapshot, so that the I/O stays linear in the changes.
+    """
+    log_path: str
+    min_bytes: int
+    size: int
+
+    def __init__(self, log_path: str, min_bytes=1024 * 1024):
+        """
+        Constructor
+        :param log_path: The log file.
+        :param min_bytes: The log is never due before it is this large.
+        """
+        self.log_path = log_path
+        self.min_bytes = min_bytes
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def replay(self) -> Iterator[dict]:
+        """
+        Reads the logged changes, in order. A last line that was not
+        completely written (a crash while appending) is dropped from the log.
+        :return: Generator of the changes
+        """
+        self.size = 0
+
+        if not os.path.exists(self.log_path):
+            return
+
+        with open(self.log_path, "rb+") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    f.truncate(self.size)
+                    return
+
+                self.size += len(line)
+
+                yield json.loads(line)
+
+    def append(self, change: dict):
+        """
+        Logs a change
+        :param change: The change, must be JSON serializable
+        """
+        line = (json.dumps(change) + "\n").encode("utf-8")
+
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+
+        with open(self.log_path, "ab") as f:
+            f.write(line)
+
+        self.size += len(line)
+
+    def due(self, snapshot_path: str) -> bool:
+        """
+        :param snapshot_path: The snapshot the log is applied to
+        :return: True if the snapshot shall be rewritten
+        """
+        snapshot_bytes = os.path.getsize(snapshot_path) if os.path.exists(snapshot_path) else 0
+
+        return self.size > max(self.min_bytes, snapshot_bytes)
+
+    def truncate(self):
+        """
+        Drops the logged changes, after they were written to the snapshot
+        """
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+
+        self.size = 0
@@ -0,0 +1,331 @@
+"""
+Simulates concurrent chat sessions against the OpenAI stand-in (see
+loadtest/server.py) and reports throughput, time to first token and tail
+latency per chain type as the concurrency increases. A session starts like
+app.on_chat_start (setup_chain_from_chat_settings) and asks the questions
+of the training Q&A like app.on_message (run_turn).
+
+    python -m loadtest.driver --concurrency 1 8 32 --turns 3
+    python -m loadtest.driver --base-url http://127.0.0.1:8900/v1 --output report.json
+
+Without --base-url a stand-in is started on --port with the given latency
+and token rate.
+"""
+import os
+import glob
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import multiprocessing
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional
+import numpy as np
+from bench.retrieval import parse_questions
+from loadtest.server import StandInSettings, serve
+
+chain_types = ("no-history", "history", "history-with-tools")
+
+
+@dataclass
+class TurnResult:
+    ttft: Optional[float]
+    seconds: float
+    tokens: int
+    frames: int
+    error: Optional[str] = None
+
+
+@dataclass
+class LevelResult:
+    """
+    The sessions of one chain type at one concurrency
+    """
+    chain: str
+    concurrency: int
+    seconds: float = 0.0
+    session_starts: List[float] = field(default_factory=list)
+    turns: List[TurnResult] = field(default_factory=list)
+
+    def report(self) -> Dict[str, float]:
+        ok = [turn for turn in self.turns if turn.error is None]
+        ttft = [turn.ttft for turn in ok if turn.ttft is not None]
+        latency = [turn.seconds for turn in ok]
+
+        def percentiles(values: List[float], name: str) -> Dict[str, float]:
+            if len(values) == 0:
+                return {}
+
+            return {
+                f"{name}_p50_ms": float(np.percentile(values, 50) * 1000),
+                f"{name}_p95_ms": float(np.percentile(values, 95) * 1000),
+                f"{name}_p99_ms": float(np.percentile(values, 99) * 1000),
+            }
+
+        return {
+            "chain": self.chain,
+            "concurrency": self.concurrency,
+            "turns": len(self.turns),
+            "errors": len(self.turns) - len(ok),
+            "turns_per_second": len(ok) / self.seconds if self.seconds > 0 else 0.0,
+            "tokens_per_second": sum(turn.tokens for turn in ok) / self.seconds if self.seconds > 0 else 0.0,
+            "frames_per_turn": sum(turn.frames for turn in ok) / len(ok) if len(ok) > 0 else 0.0,
+            **percentiles(ttft, "ttft"),
+            **percentiles(latency, "latency"),
+            **percentiles(self.session_starts, "session_start"),
+            "first_errors": sorted({turn.error for turn in self.turns if turn.error is not None})[:3],
+        }
+
+
+def session_settings(chain_type: str, model: str) -> dict:
+    """
+    The chat settings of a session (the defaults of chat_start.py)
+    """
+    return {
+        "Model": model,
+        "Temperature": 0,
+        "Streaming": True,
+        "MaxTokens": 4096,
+        "Chain": chain_type,
+        "Debug": False,
+        "Scope": "all",
+        "ContextTokens": 3000,
+        "HistoryTokens": 2000,
+    }
+
+
+async def run_session(index: int, chain_type: str, args, questions: List[str], embeddings_db, answer_cache,
+                      result: LevelResult):
+    from chain import setup_chain_from_chat_settings
+    from chains.utils import count_tokens
+    from turns import run_turn
+
+    start = time.perf_counter()
+    chain = setup_chain_from_chat_settings(session_settings(chain_type, args.model), embeddings_db)
+    result.session_starts.append(time.perf_counter() - start)
+
+    for number in range(args.turns):
+        question = questions[(index + number) % len(questions)]
+        first_token: List[float] = []
+        frames = 0
+
+        async def stream_token(frame: str):
+            nonlocal frames
+
+            if len(frame) > 0:
+                frames += 1
+
+                if len(first_token) == 0:
+                    first_token.append(time.perf_counter())
+
+        start = time.perf_counter()
+        answer = ""
+
+        try:
+            answer = await run_turn(
+                chain,
+                question,
+                owner=f"session-{index}",
+                stream_token=stream_token,
+                answer_cache=answer_cache,
+                stream_window=args.stream_window_ms / 1000 if args.stream_window_ms > 0 else None,
+                stream_bytes=args.stream_bytes,
+            )
+            error = None
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+        result.turns.append(TurnResult(
+            ttft=first_token[0] - start if len(first_token) > 0 else None,
+            seconds=time.perf_counter() - start,
+            tokens=count_tokens(answer, args.model),
+            frames=frames,
+            error=error,
+        ))
+
+        if args.think > 0:
+            await asyncio.sleep(args.think)
+
+
+async def run_level(chain_type: str, concurrency: int, args, questions: List[str], embeddings_db,
+                    answer_cache) -> LevelResult:
+    result = LevelResult(chain=chain_type, concurrency=concurrency)
+    start = time.perf_counter()
+
+    await asyncio.gather(*[
+        run_session(index, chain_type, args, questions, embeddings_db, answer_cache, result)
+        for index in range(concurrency)
+    ])
+
+    result.seconds = time.perf_counter() - start
+
+    return result
+
+
+def create_embeddings_db(embeddings_path: str, backend: str):
+    """
+    An EmbeddingsDb as in app.py, embedding through the (stand-in) API
+    """
+    from langchain.embeddings import OpenAIEmbeddings
+    from chain import openai_clients
+    from embeddingsdb import EmbeddingsDb
+    from embeddings_cache import CachedEmbeddings
+
+    client, async_client = openai_clients()
+
+    return EmbeddingsDb(
+        embeddings=CachedEmbeddings(
+            OpenAIEmbeddings(
+                openai_api_key=os.environ["OPENAI_API_KEY"],
+                client=client.embeddings,
+                async_client=async_client.embeddings,
+            ),
+            cache_path=os.path.join(embeddings_path, "cache", "embeddings.sqlite"),
+        ),
+        search_type="hybrid",
+        embeddings_path=embeddings_path,
+        backend=backend,
+        partitions=True,
+    )
+
+
+async def wait_for_server(base_url: str, timeout=10.0):
+    import aiohttp
+
+    deadline = time.perf_counter() + timeout
+
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                async with session.post(f"{base_url}/embeddings", json={"input": "ping"}) as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+
+            if time.perf_counter() > deadline:
+                raise TimeoutError(f"The stand-in at {base_url} did not start")
+
+            await asyncio.sleep(0.1)
+
+
+async def run(args) -> dict:
+    from index import index_files
+    from answer_cache import SemanticAnswerCache
+
+    await wait_for_server(os.environ["OPENAI_API_BASE"])
+
+    files = sorted({file for pattern in args.qa for file in glob.glob(pattern)})
+    questions = [question.text for file in files for question in parse_questions(file)]
+
+    if len(questions) == 0:
+        raise ValueError(f"No questions found in {args.qa}")
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        embeddings_db = create_embeddings_db(directory, args.backend)
+        # Indexing embeds through the stand-in as well
+        await asyncio.get_running_loop().run_in_executor(None, index_files, args.corpus, embeddings_db)
+        answer_cache = SemanticAnswerCache(embeddings_db) if args.answer_cache else None
+
+        for chain_type in args.chains:
+            for concurrency in args.concurrency:
+                level = await run_level(chain_type, concurrency, args, questions, embeddings_db, answer_cache)
+                results.append(level.report())
+
+        embeddings_db.close()
+
+    return {
+        "config": {
+            "base_url": os.environ["OPENAI_API_BASE"],
+            "model": args.model,
+            "backend": args.backend,
+            "turns": args.turns,
+            "think_seconds": args.think,
+            "answer_cache": args.answer_cache,
+            "stream_window_ms": args.stream_window_ms,
+            "stream_bytes": args.stream_bytes,
+            "stand_in": None if args.base_url else {
+                "latency": args.latency,
+                "jitter": args.jitter,
+                "tokens_per_second": args.tokens_per_second,
+                "completion_tokens": args.completion_tokens,
+            },
+        },
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test against an OpenAI stand-in")
+    parser.add_argument("--base-url", help="OpenAI compatible API to use instead of starting a stand-in")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.3)
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--completion-tokens", type=int, default=64)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 4, 16, 64])
+    parser.add_argument("--chains", nargs="+", default=list(chain_types))
+    parser.add_argument("--turns", type=int, default=3, help="Questions per session")
+    parser.add_argument("--think", type=float, default=0.0, help="Seconds between the questions of a session")
+    parser.add_argument("--stream-window-ms", type=float, default=40.0,
+                        help="Coalesce the streamed tokens in frames (as CEOS_STREAM_WINDOW_MS), 0 for each token")
+    parser.add_argument("--stream-bytes", type=int, default=512, help="Frame size (as CEOS_STREAM_FRAME_BYTES)")
+    parser.add_argument("--model", default="gpt-4-1106-preview")
+    parser.add_argument("--backend", default="chroma")
+    parser.add_argument("--answer-cache", action="store_true", help="Serve repeated questions from the answer cache")
+    parser.add_argument("--qa", nargs="+", default=["data/training/*_qa.md"], help="Questions (see bench.retrieval)")
+    parser.add_argument("--corpus", default="data/training/*.*", help="Files indexed before the test")
+    parser.add_argument("--output", help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    server = None
+
+    if args.base_url is None:
+        server = multiprocessing.get_context("spawn").Process(
+            target=serve,
+            args=(args.port, StandInSettings(
+                latency=args.latency,
+                jitter=args.jitter,
+                tokens_per_second=args.tokens_per_second,
+                completion_tokens=args.completion_tokens,
+            )),
+            daemon=True,
+        )
+        server.start()
+
+    # Before anything creates an OpenAI client
+    os.environ["OPENAI_API_BASE"] = args.base_url or f"http://127.0.0.1:{args.port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "stand-in")
+
+    try:
+        report = asyncio.run(run(args))
+    finally:
+        if server is not None:
+            server.terminate()
+
+    if args.output is not None:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    print(f"\n{report['config']}")
+
+    for result in report["results"]:
+        print(
+            f"{result['chain']:>18} x{result['concurrency']:<4}: "
+            f"{result['turns_per_second']:.1f} turns/s, {result['tokens_per_second']:.0f} tokens/s, "
+            f"{result['frames_per_turn']:.1f} frames/turn, "
+            f"ttft p50 {result.get('ttft_p50_ms', 0):.0f}ms p99 {result.get('ttft_p99_ms', 0):.0f}ms, "
+            f"latency p50 {result.get('latency_p50_ms', 0):.0f}ms p95 {result.get('latency_p95_ms', 0):.0f}ms "
+            f"p99 {result.get('latency_p99_ms', 0):.0f}ms, "
+            f"session start p50 {result.get('session_start_p50_ms', 0):.1f}ms, {result['errors']} errors"
+        )
+
+        for error in result["first_errors"]:
+            print(f"{'':>20}{error}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Local stand-in for the OpenAI API, for load tests without calling (and
+paying for) the real one. Chat completions answer with generated text,
+streamed (server-sent events) at a configurable token rate after a
+configurable latency. When tools are offered, the tools taking only text
+arguments (e.g. a search) are called first, with the question. Embeddings
+are deterministic (see HashingEmbeddings), so texts sharing words are
+similar.
+
+    python -m loadtest.server --port 8900 --latency 0.4 --tokens-per-second 60
+
+Point the app at it with OPENAI_API_BASE=http://127.0.0.1:8900/v1
+"""
+import json
+import time
+import base64
+import random
+import asyncio
+import argparse
+from functools import lru_cache
+from typing import Callable, List, Optional, Union
+import numpy as np
+from aiohttp import web
+from bench.embeddings import HashingEmbeddings
+
+words = (
+    "the heating of the building is optimized by CEOS using indoor sensors and the forecast "
+    "to lower the consumption while keeping a comfortable temperature in every room"
+).split()
+
+
+class StandInSettings:
+    """
+    How the stand-in answers
+    """
+    latency: float
+    jitter: float
+    tokens_per_second: float
+    completion_tokens: int
+    embeddings: HashingEmbeddings
+
+    def __init__(self, latency=0.3, jitter=0.1, tokens_per_second=50.0, completion_tokens=64, dims=1536):
+        """
+        Constructor
+        :param latency: Seconds until the first token (or the response when not streaming).
+        :param jitter: Max seconds randomly added to the latency.
+        :param tokens_per_second: Rate of the completion tokens, 0 for no delay.
+        :param completion_tokens: Number of tokens of a completion (max_tokens if lower).
+        :param dims: Dimensions of the embeddings.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.embeddings = HashingEmbeddings(dims=dims)
+
+
+def completion_tokens(settings: StandInSettings, request: dict) -> List[str]:
+    count = min(settings.completion_tokens, request.get("max_tokens") or settings.completion_tokens)
+
+    return [(" " if i > 0 else "") + words[i % len(words)] for i in range(count)]
+
+
+def requested_tool_calls(request: dict) -> List[dict]:
+    """
+    Calls the tools taking only text arguments with the last user message,
+    unless tools were already called (or may not be)
+    """
+    messages = request.get("messages") or []
+
+    if request.get("tool_choice") == "none" or any(message.get("role") == "tool" for message in messages):
+        return []
+
+    question = next((message.get("content") or "" for message in reversed(messages)
+                     if message.get("role") == "user"), "")
+    calls = []
+
+    for tool in request.get("tools") or []:
+        function = tool.get("function") or {}
+        properties = (function.get("parameters") or {}).get("properties") or {}
+
+        if len(properties) > 0 and all(schema.get("type") == "string" for schema in properties.values()):
+            calls.append({
+                "id": f"call_{random.getrandbits(64):016x}",
+                "type": "function",
+                "function": {"name": function["name"], "arguments": json.dumps({name: question for name in properties})},
+            })
+
+    return calls
+
+
+def completion_id() -> str:
+    return f"chatcmpl-{random.getrandbits(64):016x}"
+
+
+async def chat_completions(request: web.Request) -> web.StreamResponse:
+    settings: StandInSettings = request.app["settings"]
+    body = await request.json()
+    tokens = completion_tokens(settings, body)
+    calls = requested_tool_calls(body)
+    created = int(time.time())
+    model = body.get("model", "stand-in")
+    interval = 1.0 / settings.tokens_per_second if settings.tokens_per_second > 0 else 0.0
+
+    await asyncio.sleep(settings.latency + random.uniform(0, settings.jitter))
+
+    if not body.get("stream"):
+        if len(calls) > 0:
+            tokens = []
+            message = {"role": "assistant", "content": None, "tool_calls": calls}
+        else:
+            message = {"role": "assistant", "content": "".join(tokens)}
+
+        await asyncio.sleep(interval * len(tokens))
+
+        return web.json_response({
+            "id": completion_id(),
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": message,
+                "finish_reason": "tool_calls" if len(calls) > 0 else "stop",
+            }],
+            "usage": {
+                "prompt_tokens": 0,
+                "completion_tokens": len(tokens),
+                "total_tokens": len(tokens),
+            },
+        })
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+
+    id = completion_id()
+    start = time.perf_counter()
+
+    def event(delta: dict, finish_reason: str = None) -> bytes:
+        chunk = {
+            "id": id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+        return f"data: {json.dumps(chunk)}\n\n".encode("utf-8")
+
+    await response.write(event({"role": "assistant", "content": ""}))
+
+    if len(calls) > 0:
+        for index, call in enumerate(calls):
+            arguments = call["function"]["arguments"]
+            middle = len(arguments) // 2
+
+            await response.write(event({"tool_calls": [{
+                "index": index, "id": call["id"], "type": "function",
+                "function": {"name": call["function"]["name"], "arguments": ""},
+            }]}))
+
+            for part in (arguments[:middle], arguments[middle:]):
+                await response.write(event({"tool_calls": [{"index": index, "function": {"arguments": part}}]}))
+
+        tokens = []
+
+    for i, token in enumerate(tokens):
+        # Paced against the start, so slow writes do not add up
+        delay = start + i * interval - time.perf_counter()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        await response.write(event({"content": token}))
+
+    await response.write(event({}, "tool_calls" if len(calls) > 0 else "stop"))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+
+    return response
+
+
+@lru_cache(maxsize=None)
+def token_decoder() -> Optional[Callable[[List[int]], str]]:
+    """
+    :return: Decodes token ids, None if tiktoken (or its encoding files) are not available
+    """
+    try:
+        import tiktoken
+
+        return tiktoken.get_encoding("cl100k_base").decode
+    except Exception:
+        return None
+
+
+def input_text(value: Union[str, List[int]]) -> str:
+    """
+    OpenAIEmbeddings sends token ids, they are decoded if possible
+    """
+    if isinstance(value, str):
+        return value
+
+    decode = token_decoder()
+
+    return decode(value) if decode is not None else " ".join(str(token) for token in value)
+
+
+async def embeddings(request: web.Request) -> web.Response:
+    settings: StandInSettings = request.app["settings"]
+    body = await request.json()
+    inputs = body["input"]
+
+    # A single text or a single list of token ids
+    if isinstance(inputs, str) or (len(inputs) > 0 and isinstance(inputs[0], int)):
+        inputs = [inputs]
+
+    vectors = settings.embeddings.embed_documents([input_text(value) for value in inputs])
+
+    def encode(vector: List[float]):
+        if body.get("encoding_format") == "base64":
+            return base64.b64encode(np.asarray(vector, dtype="<f4").tobytes()).decode("ascii")
+
+        return vector
+
+    return web.json_response({
+        "object": "list",
+        "data": [
+            {"object": "embedding", "index": index, "embedding": encode(vector)}
+            for index, vector in enumerate(vectors)
+        ],
+        "model": body.get("model", "stand-in"),
+        "usage": {"prompt_tokens": 0, "total_tokens": 0},
+    })
+
+
+def create_app(settings: StandInSettings) -> web.Application:
+    app = web.Application()
+    app["settings"] = settings
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v1/embeddings", embeddings)
+
+    return app
+
+
+def serve(port: int, settings: StandInSettings):
+    """
+    Runs the stand-in until interrupted
+    """
+    web.run_app(create_app(settings), host="127.0.0.1", port=port, print=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenAI API stand-in")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds until the first token")
+    parser.add_argument("--jitter", type=float, default=0.1, help="Max random seconds added to the latency")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--completion-tokens", type=int, default=64)
+    parser.add_argument("--dims", type=int, default=1536, help="Dimensions of the embeddings")
+    args = parser.parse_args()
+
+    print(f"OpenAI stand-in on http://127.0.0.1:{args.port}/v1")
+
+    serve(args.port, StandInSettings(
+        latency=args.latency,
+        jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second,
+        completion_tokens=args.completion_tokens,
+        dims=args.dims,
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+import os
+import json
+import hashlib
+from fnmatch import fnmatch
+from typing import Dict, List
+
+
+def hash_text(text: str) -> str:
+    """
+    Creates a stable content hash for a text
+    :param text: Text to hash
+    :return: Hex encoded sha256 digest
+    """
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def hash_file(file_path: str, block_size=1024 * 1024) -> str:
+    """
+    Creates a content hash of a file without reading it all into memory
+    :param file_path: Path to the file
+    :param block_size: Number of bytes to read at a time
+    :return: Hex encoded sha256 digest
+    """
+    digest = hashlib.sha256()
+
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+class IndexManifest:
+    """
+    Chunk level manifest of what is stored in the vector store.
+
+    Each indexed file is recorded with its size, mtime and content hash
+    together with the ids of the chunks it produced. This makes it possible
+    to skip unchanged files without parsing them and to only embed the
+    chunks that actually changed.
+
+    Chunk ids are hashes of the file and the content (see
+    embeddingsdb.chunk_id), so each file has chunks, and metadata, of its
+    own and a chunk is removed from the store with its file.
+
+    Bump version when parsing, chunking or chunk ids change, files recorded
+    by an older version are then re-parsed (but their chunk ids are kept so
+    the old chunks can be replaced).
+    """
+    version: int = 4
+    manifest_path: str
+    files: Dict[str, dict]
+
+    def __init__(self, manifest_path: str):
+        """
+        Constructor
+        :param manifest_path: The JSON file where the manifest is persisted.
+        """
+        self.manifest_path = manifest_path
+        self.files = {}
+
+        if os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                data = json.load(f)
+
+            self.files = data.get("files", {})
+
+            if data.get("version") != self.version:
+                for entry in self.files.values():
+                    entry["sha256"] = ""
+                    entry["mtime_ns"] = 0
+
+    def is_unchanged(self, file_path: str) -> bool:
+        """
+        Checks if a file is indexed and unchanged since. It first compares
+        size and mtime, and only if the mtime differs the content hash.
+        :param file_path: Path to the file
+        :return: True if the file is indexed and unchanged
+        """
+        entry = self.files.get(file_path)
+
+        if entry is None or not os.path.exists(file_path):
+            return False
+
+        stat = os.stat(file_path)
+
+        if stat.st_size != entry["size"]:
+            return False
+
+        if stat.st_mtime_ns == entry["mtime_ns"]:
+            return True
+
+        # Touched, but the content may still be the same
+        if hash_file(file_path) != entry["sha256"]:
+            return False
+
+        entry["mtime_ns"] = stat.st_mtime_ns
+        self.save()
+
+        return True
+
+    def chunk_ids(self, file_path: str) -> List[str]:
+        """
+        Gets the chunk ids that was stored for a file
+        :param file_path: Path to the file
+        :return: List of chunk ids (empty if not indexed)
+        """
+        entry = self.files.get(file_path)
+
+        if entry is None:
+            return []
+
+        return entry["chunks"]
+
+    def indexed_files(self, pattern: str = None) -> List[str]:
+        """
+        Gets the indexed files
+        :param pattern: Optional pattern to match e.g. 'data/*.txt'
+        :return: List of file paths
+        """
+        return [
+            file_path for file_path in self.files
+            if pattern is None or fnmatch(file_path, pattern)
+        ]
+
+    def update(self, file_path: str, chunk_ids: List[str]):
+        """
+        Records the chunks of a file along with the file fingerprint and
+        persists the manifest.
+        :param file_path: Path to the file
+        :param chunk_ids: The ids of the chunks currently stored for the file
+        """
+        entry = {"size": 0, "mtime_ns": 0, "sha256": "", "chunks": chunk_ids}
+
+        if os.path.exists(file_path):
+            stat = os.stat(file_path)
+
+            entry["size"] = stat.st_size
+            entry["mtime_ns"] = stat.st_mtime_ns
+            entry["sha256"] = hash_file(file_path)
+
+        self.files[file_path] = entry
+        self.save()
+
+    def remove(self, file_path: str):
+        """
+        Removes a file from the manifest and persists the manifest.
+        :param file_path: Path to the file
+        """
+        if self.files.pop(file_path, None) is not None:
+            self.save()
+
+    def save(self):
+        """
+        Persists the manifest (atomically replaces the previous one)
+        """
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+
+        tmp_path = self.manifest_path + ".tmp"
+
+        with open(tmp_path, "w") as f:
+            json.dump({"version": self.version, "files": self.files}, f)
+
+        os.replace(tmp_path, self.manifest_path)
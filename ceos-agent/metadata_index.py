@@ -0,0 +1,106 @@
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+from langchain.docstore.document import Document
+
+# Metadata fields that can be filtered on (the source file is resolved
+# through the manifest instead, see EmbeddingsDb.select)
+header_fields = ("Header 1", "Header 2", "Header 3")
+indexed_fields = header_fields + ("owner",)
+
+
+@dataclass(frozen=True)
+class MetadataFilter:
+    """
+    Restricts a query to the chunks that match all of the given criteria
+    """
+    # File paths or patterns e.g. 'data/training/*', any may match
+    sources: Tuple[str, ...] = ()
+    # Markdown header path e.g. ("CEOS", "Installation") for the chunks
+    # under "# CEOS" / "## Installation"
+    headers: Tuple[str, ...] = ()
+    # Owner of uploaded chunks
+    owner: Optional[str] = None
+
+    def is_empty(self) -> bool:
+        return len(self.sources) == 0 and len(self.headers) == 0 and self.owner is None
+
+    def __str__(self):
+        parts = []
+
+        if len(self.sources) > 0:
+            parts.append(f"sources={','.join(self.sources)}")
+
+        if len(self.headers) > 0:
+            parts.append(f"headers={' / '.join(self.headers)}")
+
+        if self.owner is not None:
+            parts.append(f"owner={self.owner}")
+
+        return ";".join(parts)
+
+
+class MetadataIndex:
+    """
+    Inverted index of chunk metadata (field -> value -> chunk ids), so that
+    a filtered query can be restricted to the matching chunks up front.
+    """
+    fields: Tuple[str, ...]
+    values: Dict[str, Dict[str, Set[str]]]
+    chunks: Dict[str, List[Tuple[str, str]]]
+
+    def __init__(self, fields=indexed_fields):
+        """
+        Constructor
+        :param fields: The metadata fields to index
+        """
+        self.fields = fields
+        self.values = {name: {} for name in fields}
+        self.chunks = {}
+
+        self._lock = threading.RLock()
+
+    def add(self, ids: List[str], docs: List[Document]):
+        """
+        Adds (or replaces) the metadata of chunks
+        :param ids: The chunk ids
+        :param docs: The chunks
+        """
+        with self._lock:
+            self.remove(ids)
+
+            for chunk_id, doc in zip(ids, docs):
+                entries = [
+                    (name, str(doc.metadata[name])) for name in self.fields
+                    if doc.metadata.get(name) is not None
+                ]
+
+                for name, value in entries:
+                    self.values[name].setdefault(value, set()).add(chunk_id)
+
+                self.chunks[chunk_id] = entries
+
+    def remove(self, ids: List[str]):
+        with self._lock:
+            for chunk_id in ids:
+                for name, value in self.chunks.pop(chunk_id, []):
+                    matching = self.values[name][value]
+                    matching.discard(chunk_id)
+
+                    if len(matching) == 0:
+                        del self.values[name][value]
+
+    def clear(self):
+        with self._lock:
+            self.values = {name: {} for name in self.fields}
+            self.chunks = {}
+
+    def match(self, name: str, value: str) -> Set[str]:
+        """
+        Gets the chunks where the field has the value
+        :param name: The field e.g. 'Header 1'
+        :param value: The value
+        :return: Set of chunk ids (a copy)
+        """
+        with self._lock:
+            return set(self.values[name].get(value, ()))
@@ -0,0 +1,368 @@
+import os
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+from uuid import UUID
+from langchain.schema.callbacks.base import BaseCallbackHandler
+from langchain.schema.messages import BaseMessage
+from langchain.schema.output import LLMResult
+from chains.utils import ContextUsage, count_tokens
+
+# Buckets (upper bounds) of the histograms
+seconds_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+tokens_buckets = (16, 64, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+rate_buckets = (1, 5, 10, 20, 40, 60, 80, 100, 150, 200, 400)
+frames_buckets = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+documents_buckets = (0, 1, 2, 4, 8, 16, 32, 64)
+
+# name -> (help, buckets)
+turn_metrics = {
+    "ceos_retrieval_seconds": ("Time retrieving documents", seconds_buckets),
+    "ceos_prompt_seconds": ("Time from retrieval to the model request (context packing, memory, prompt)",
+                            seconds_buckets),
+    "ceos_time_to_first_token_seconds": ("Time from the question to the first streamed token", seconds_buckets),
+    "ceos_turn_seconds": ("Time from the question to the complete answer", seconds_buckets),
+    "ceos_tokens_per_second": ("Completion tokens per second after the first token", rate_buckets),
+    "ceos_prompt_tokens": ("Prompt tokens sent to the model", tokens_buckets),
+    "ceos_completion_tokens": ("Completion tokens of the answer", tokens_buckets),
+    "ceos_context_tokens": ("Tokens of the retrieved documents packed into the prompt", tokens_buckets),
+    "ceos_context_documents": ("Retrieved documents packed into the prompt", documents_buckets),
+    "ceos_context_dropped_documents": ("Retrieved documents left out of the prompt (near-duplicates, over budget)",
+                                       documents_buckets),
+    "ceos_stream_frames": ("Frames the answer was streamed in (see streaming.py)", frames_buckets),
+    "ceos_stream_flush_delay_seconds": ("Longest time a token was held back before its frame was sent",
+                                        seconds_buckets),
+}
+
+
+class Histogram:
+    """
+    Cumulative histogram per label set, as Prometheus histograms
+    """
+    name: str
+    help: str
+    buckets: Tuple[float, ...]
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...]):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+
+        self._lock = threading.Lock()
+        # labels -> (counts per bucket and +Inf, sum)
+        self._series: Dict[Tuple[Tuple[str, str], ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, labels: Dict[str, str]):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+
+        with self._lock:
+            counts, total = self._series.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[index] += 1
+            self._series[key] = (counts, total + value)
+
+    def render(self) -> List[str]:
+        """
+        :return: The lines of the Prometheus text format
+        """
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in sorted(self._series.items())]
+
+        for key, counts, total in series:
+            labels = ",".join(f'{name}="{value}"' for name, value in key)
+            cumulative = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                lines.append(f'{self.name}_bucket{{{labels},le="{le}"}} {cumulative}')
+
+            lines.append(f"{self.name}_sum{{{labels}}} {total:g}")
+            lines.append(f"{self.name}_count{{{labels}}} {cumulative}")
+
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Aggregates the turn metrics in histograms and writes each turn to a
+    JSONL file, both optional. When neither is enabled no turns are
+    measured at all (start_turn returns None).
+    """
+    histograms: Dict[str, Histogram]
+    # If the histograms are kept (prometheus)
+    aggregate: bool
+    jsonl_path: Optional[str] = None
+
+    def __init__(self):
+        self.histograms = {name: Histogram(name, help, buckets) for name, (help, buckets) in turn_metrics.items()}
+        self.aggregate = False
+
+        self._lock = threading.Lock()
+        self._jsonl = None
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.aggregate or self._jsonl is not None
+
+    def configure(self, exporters: str, port=9464, jsonl_path="./data/metrics/turns.jsonl"):
+        """
+        Turns the exporters on
+        :param exporters: Comma separated: prometheus (text format on
+                          http://localhost:<port>/metrics) and/or jsonl
+                          (one line per turn). Empty or off measures nothing.
+        :param port: Port of the prometheus endpoint.
+        :param jsonl_path: File the turns are appended to.
+        """
+        names = {name.strip() for name in (exporters or "").split(",")} - {"", "off"}
+        unknown = names - {"prometheus", "jsonl"}
+
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown metrics exporters: {', '.join(sorted(unknown))}")
+
+        if "jsonl" in names and self._jsonl is None:
+            os.makedirs(os.path.dirname(jsonl_path) or ".", exist_ok=True)
+            self.jsonl_path = jsonl_path
+            self._jsonl = open(jsonl_path, "a", encoding="utf-8")
+
+        if "prometheus" in names:
+            self.aggregate = True
+
+            if self._server is None:
+                self._server = serve(self, port)
+
+    def record(self, turn: 'TurnMetrics'):
+        values = turn.values()
+        labels = {"chain": turn.chain, "model": turn.model, "cached": "true" if turn.cached else "false"}
+
+        if self.aggregate:
+            for name, value in values.items():
+                if value is not None:
+                    self.histograms[name].observe(value, labels)
+
+        if self._jsonl is not None:
+            line = json.dumps({"time": turn.wall_time, **labels, **values})
+
+            with self._lock:
+                self._jsonl.write(line + "\n")
+                self._jsonl.flush()
+
+    def render(self) -> str:
+        return "\n".join(line for histogram in self.histograms.values() for line in histogram.render()) + "\n"
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server = None
+
+        with self._lock:
+            if self._jsonl is not None:
+                self._jsonl.close()
+                self._jsonl = None
+
+
+def serve(registry: MetricsRegistry, port: int) -> ThreadingHTTPServer:
+    """
+    Serves the registry in the Prometheus text format on localhost
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] != "/metrics":
+                self.send_error(404)
+                return
+
+            body = registry.render().encode("utf-8")
+
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+
+    print(f"*** METRICS: http://127.0.0.1:{port}/metrics ***")
+
+    return server
+
+
+# The metrics of all turns of the process
+registry = MetricsRegistry()
+
+
+@dataclass
+class TurnMetrics:
+    """
+    What is measured during a turn (a question and its answer). Times are
+    perf_counter seconds.
+    """
+    chain: str
+    model: str
+    started: float = field(default_factory=time.perf_counter)
+    wall_time: float = field(default_factory=time.time)
+    cached: bool = False
+    retrieval_seconds: Optional[float] = None
+    retrieved: Optional[float] = None
+    model_started: Optional[float] = None
+    first_token: Optional[float] = None
+    finished: Optional[float] = None
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    # Set when the tokens are coalesced (see streaming.TokenCoalescer)
+    stream_frames: Optional[int] = None
+    stream_flush_delay: Optional[float] = None
+    # Set when retrieved documents are packed (see chains.utils.ContextPacker)
+    context: Optional[ContextUsage] = None
+
+    def values(self) -> Dict[str, Optional[float]]:
+        """
+        :return: The value of each of turn_metrics, None if not measured
+        """
+        def since(start: Optional[float], end: Optional[float]) -> Optional[float]:
+            return end - start if start is not None and end is not None else None
+
+        streaming = since(self.first_token, self.finished)
+
+        return {
+            "ceos_retrieval_seconds": self.retrieval_seconds,
+            "ceos_prompt_seconds": since(self.retrieved or self.started, self.model_started),
+            "ceos_time_to_first_token_seconds": since(self.started, self.first_token),
+            "ceos_turn_seconds": since(self.started, self.finished),
+            "ceos_tokens_per_second": self.completion_tokens / streaming
+            if streaming is not None and streaming > 0 and self.completion_tokens > 1 else None,
+            "ceos_prompt_tokens": self.prompt_tokens if not self.cached else None,
+            "ceos_completion_tokens": self.completion_tokens,
+            "ceos_stream_frames": self.stream_frames,
+            "ceos_stream_flush_delay_seconds": self.stream_flush_delay,
+            "ceos_context_tokens": self.context.tokens if self.context is not None else None,
+            "ceos_context_documents": self.context.packed if self.context is not None else None,
+            "ceos_context_dropped_documents": self.context.retrieved - self.context.packed
+            if self.context is not None else None,
+        }
+
+    def token(self):
+        """
+        A token was streamed to the user
+        """
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+
+    def finish(self, answer: str):
+        """
+        Records the turn
+        :param answer: The complete answer, its tokens are counted when
+                       no model call reported them (e.g. a cached answer)
+        """
+        self.finished = time.perf_counter()
+
+        if self.completion_tokens == 0:
+            self.completion_tokens = count_tokens(answer, self.model)
+
+        registry.record(self)
+
+
+# The turn being answered by the current task
+current_turn: ContextVar[Optional[TurnMetrics]] = ContextVar("current_turn", default=None)
+
+
+def start_turn(chain: str, model: str) -> Optional[TurnMetrics]:
+    """
+    Starts measuring a turn of the current task
+    :param chain: The chain type (label)
+    :param model: The model name (label)
+    :return: The turn, None if metrics are off
+    """
+    if not registry.enabled:
+        return None
+
+    turn = TurnMetrics(chain=chain, model=model)
+    current_turn.set(turn)
+
+    return turn
+
+
+@contextmanager
+def timed_retrieval():
+    """
+    Adds the time of the block to the retrieval time of the current turn
+    """
+    turn = current_turn.get()
+
+    if turn is None:
+        yield
+        return
+
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        turn.retrieval_seconds = (turn.retrieval_seconds or 0.0) + end - start
+
+        # Prompt assembly is measured from the retrieval before the first
+        # model call, an agent retrieves after it (as a tool)
+        if turn.model_started is None:
+            turn.retrieved = end
+
+
+def record_context(usage: ContextUsage):
+    """
+    Adds what was packed into the prompt to the current turn, an agent may
+    pack the documents of several retrievals
+    """
+    turn = current_turn.get()
+
+    if turn is None:
+        return
+
+    if turn.context is None:
+        turn.context = ContextUsage()
+
+    turn.context.tokens += usage.tokens
+    turn.context.budget += usage.budget
+    turn.context.retrieved += usage.retrieved
+    turn.context.packed += usage.packed
+    turn.context.duplicates += usage.duplicates
+    turn.context.trimmed += usage.trimmed
+
+
+class TurnCallbackHandler(BaseCallbackHandler):
+    """
+    Measures the model calls of a turn (prompt assembly ends when the model
+    is called, prompt and completion tokens)
+    """
+    # Cheap, no need for a thread
+    run_inline = True
+
+    def __init__(self, turn: TurnMetrics):
+        self.turn = turn
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: List[List[BaseMessage]], *,
+                            run_id: UUID, **kwargs: Any) -> Any:
+        if self.turn.model_started is None:
+            self.turn.model_started = time.perf_counter()
+
+        self.turn.prompt_tokens += sum(
+            count_tokens(message.content, self.turn.model)
+            for prompt in messages for message in prompt if isinstance(message.content, str)
+        )
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any) -> Any:
+        self.turn.completion_tokens += sum(
+            count_tokens(generation.text, self.turn.model)
+            for generations in response.generations for generation in generations
+        )
@@ -0,0 +1,319 @@
+import os
+import re
+import time
+import shutil
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+
+def partition_key(owner: str) -> str:
+    """
+    Turns an owner (user name, e-mail or session id) into a name that is
+    safe to use as a directory
+    :param owner: The owner
+    :return: The key
+    """
+    return re.sub(r"[^\w.@-]", "_", owner).strip(".") or "_"
+
+
+# Owners that only live as long as a chat session (not authenticated), their
+# uploads are removed when expired (see index.expire_session_uploads)
+session_owner_prefix = "session-"
+
+
+def session_owner(session_id: str) -> str:
+    """
+    The owner of what is uploaded in a session that is not authenticated
+    """
+    return f"{session_owner_prefix}{session_id}"
+
+
+def latest_mtime(path: str) -> float:
+    """
+    The latest modification time of a directory and what is in it, 0 if it
+    does not exist
+    """
+    if not os.path.exists(path):
+        return 0.0
+
+    latest = os.path.getmtime(path)
+
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                latest = max(latest, os.path.getmtime(os.path.join(directory, name)))
+            except OSError:
+                pass
+
+    return latest
+
+
+class PartitionPool:
+    """
+    Lazily opened partitions (e.g. the uploads of a user or a session),
+    each persisted in its own directory under root_path. Partitions that
+    have not been used for idle_seconds are closed (checked every
+    evict_interval seconds by a background thread, and on each use), as
+    are the least recently used ones above max_open. A closed partition is
+    opened again from disk the next time it is used.
+
+    Partitions are leased (see lease), a leased partition is never closed,
+    it is closed when the last lease is returned if it is due by then.
+
+    Opening and closing a partition (reading it from disk) is done without
+    holding the pool lock, so other partitions can be used meanwhile. Who
+    wants a partition that is being opened or closed waits for it.
+    """
+    root_path: str
+    open_partition: Callable[[str, str], Any]
+    idle_seconds: float
+    max_open: int
+    evict_interval: float
+
+    def __init__(self,
+                 root_path: str,
+                 open_partition: Callable[[str, str], Any],
+                 idle_seconds=15 * 60,
+                 max_open=32,
+                 evict_interval=60,
+                 ):
+        """
+        Constructor
+        :param root_path: Directory with one sub directory per partition.
+        :param open_partition: Opens (or creates) a partition from its key and directory.
+        :param idle_seconds: Seconds a partition is kept open without being used.
+        :param max_open: Max number of partitions kept open.
+        :param evict_interval: Seconds between the checks for idle partitions.
+        """
+        self.root_path = root_path
+        self.open_partition = open_partition
+        self.idle_seconds = idle_seconds
+        self.max_open = max_open
+        self.evict_interval = evict_interval
+
+        self._lock = threading.Lock()
+        self._open: OrderedDict[str, Tuple[Any, float]] = OrderedDict()
+        # key -> number of leases out
+        self._leases: Dict[str, int] = {}
+        # key -> done when the partition is opened or closed
+        self._busy: Dict[str, Future] = {}
+        self._stop = threading.Event()
+        self._evictor: Optional[threading.Thread] = None
+
+    @contextmanager
+    def lease(self, key: str, create=True) -> Iterator[Optional[Any]]:
+        """
+        Leases a partition for the block, opening it if needed
+        :param key: The partition key (see partition_key)
+        :param create: If a partition that does not exist shall be created
+        :return: The partition, None if it does not exist and create is False
+        """
+        partition = self.acquire(key, create)
+
+        try:
+            yield partition
+        finally:
+            if partition is not None:
+                self.release(key)
+
+    def acquire(self, key: str, create=True) -> Optional[Any]:
+        """
+        Leases a partition, opening it if needed. It must be returned with
+        release (prefer lease).
+        :param key: The partition key (see partition_key)
+        :param create: If a partition that does not exist shall be created
+        :return: The partition, None if it does not exist and create is False
+        """
+        while True:
+            with self._lock:
+                busy = self._busy.get(key)
+
+                if busy is None:
+                    entry = self._open.get(key)
+
+                    if entry is not None:
+                        partition = entry[0]
+                        self._lease(key, partition)
+                        evicted = self._evict()
+                        break
+
+                    if not create and not self.exists(key):
+                        return None
+
+                    busy = self._busy[key] = Future()
+                    opening = True
+                else:
+                    opening = False
+
+            if not opening:
+                # Opened (or closed) by someone else, then look again
+                busy.exception()
+                continue
+
+            try:
+                partition = self.open_partition(key, self.path(key))
+            except BaseException as e:
+                with self._lock:
+                    del self._busy[key]
+
+                busy.set_exception(e)
+                raise
+
+            with self._lock:
+                del self._busy[key]
+                self._lease(key, partition)
+                evicted = self._evict()
+
+            busy.set_result(None)
+            self._start_evictor()
+            break
+
+        self._close(evicted)
+
+        return partition
+
+    def release(self, key: str):
+        """
+        Returns a lease of acquire
+        """
+        with self._lock:
+            count = self._leases.pop(key, 0) - 1
+
+            if count > 0:
+                self._leases[key] = count
+
+            if key in self._open:
+                self._open[key] = (self._open[key][0], time.time())
+
+            evicted = self._evict()
+
+        self._close(evicted)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root_path, key)
+
+    def exists(self, key: str) -> bool:
+        return key in self._open or os.path.isdir(self.path(key))
+
+    def keys(self) -> List[str]:
+        """
+        Gets the keys of all partitions on disk
+        """
+        if not os.path.isdir(self.root_path):
+            return []
+
+        return [key for key in os.listdir(self.root_path) if os.path.isdir(self.path(key))]
+
+    def open_count(self) -> int:
+        return len(self._open)
+
+    def evict_idle(self):
+        """
+        Closes the partitions that have been idle for too long
+        """
+        with self._lock:
+            evicted = self._evict()
+
+        self._close(evicted)
+
+    def remove(self, key: str) -> bool:
+        """
+        Closes a partition and removes it from disk, unless it is in use
+        :param key: The partition key
+        :return: True if removed (or it did not exist)
+        """
+        with self._lock:
+            if self._leases.get(key, 0) > 0 or key in self._busy:
+                return False
+
+            entry = self._open.pop(key, None)
+
+            # Nobody can open it while it is removed
+            busy = self._busy[key] = Future()
+
+        try:
+            if entry is not None:
+                entry[0].close()
+
+            shutil.rmtree(self.path(key), ignore_errors=True)
+        finally:
+            with self._lock:
+                del self._busy[key]
+
+            busy.set_result(None)
+
+        return True
+
+    def close(self):
+        self._stop.set()
+
+        with self._lock:
+            partitions = [partition for partition, _ in self._open.values()]
+            self._open.clear()
+            self._leases.clear()
+
+        for partition in partitions:
+            partition.close()
+
+    def _lease(self, key: str, partition: Any):
+        """
+        Records a lease and the use of an open partition. Call with the lock held.
+        """
+        self._open[key] = (partition, time.time())
+        self._open.move_to_end(key)
+        self._leases[key] = self._leases.get(key, 0) + 1
+
+    def _evict(self) -> List[Tuple[str, Any, Future]]:
+        """
+        Takes the idle and least recently used partitions that are not
+        leased out of the pool, they are marked busy until closed (see
+        _close). Call with the lock held.
+        :return: The (key, partition, busy) to close
+        """
+        now = time.time()
+        evicted: List[Tuple[str, Any, Future]] = []
+
+        for key in list(self._open.keys()):
+            partition, used = self._open[key]
+
+            if self._leases.get(key, 0) > 0:
+                continue
+
+            if now - used > self.idle_seconds or len(self._open) > self.max_open:
+                del self._open[key]
+                self._busy[key] = Future()
+                evicted.append((key, partition, self._busy[key]))
+
+        return evicted
+
+    def _close(self, evicted: List[Tuple[str, Any, Future]]):
+        """
+        Closes evicted partitions, without holding the lock
+        """
+        for key, partition, busy in evicted:
+            try:
+                partition.close()
+            finally:
+                with self._lock:
+                    del self._busy[key]
+
+                busy.set_result(None)
+
+    def _start_evictor(self):
+        """
+        Starts the thread closing idle partitions, once something was opened
+        """
+        with self._lock:
+            if self._evictor is not None or self._stop.is_set():
+                return
+
+            self._evictor = threading.Thread(target=self._evict_periodically, name="partition-evictor", daemon=True)
+
+        self._evictor.start()
+
+    def _evict_periodically(self):
+        while not self._stop.wait(self.evict_interval):
+            self.evict_idle()
@@ -1,5 +1,11 @@
-from typing import List
+from typing import Deque, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import os
 import re
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pydantic import BaseModel
 from langchain.document_loaders import UnstructuredFileLoader
 from unstructured.cleaners.core import clean_extra_whitespace
@@ -8,10 +14,35 @@ from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.docstore.document import Document
 from langchain.text_splitter import MarkdownHeaderTextSplitter
 
+# Parse strategy per file extension (anything else uses default_parse_strategy):
+#   text    - read the file as plain text, no Unstructured partitioning
+#   fast    - Unstructured without layout detection
+#   hi_res  - Unstructured with layout detection and OCR
+#   pdf     - 'fast' for born-digital PDFs, 'hi_res' when there is no text layer
+parse_strategies: Dict[str, str] = {
+    ".md": "text",
+    ".txt": "text",
+    ".pdf": "pdf",
+    ".png": "hi_res",
+    ".jpg": "hi_res",
+    ".jpeg": "hi_res",
+    ".tiff": "hi_res",
+    ".bmp": "hi_res",
+}
+
+default_parse_strategy = "fast"
+
+# A 'pdf' parsed with 'fast' yielding less text than this is re-parsed with 'hi_res'
+min_pdf_text_chars = 64
+
+# Parses the files that are scanned one at a time, see scan_file_in_pool
+_scan_pool: Optional[ProcessPoolExecutor] = None
+_scan_pool_lock = threading.Lock()
+
 
 def find_files(pattern) -> List[str]:
     """
-    Find files matching a pattern
+    Find files (not directories) matching a pattern
     :param pattern: Pattern to match e.g. 'data/*.txt'
     :return: List of file paths
     """
@@ -20,24 +51,156 @@ def find_files(pattern) -> List[str]:
     result: List[str] = []
 
     for file_path in glob.glob(pattern):
-        result.append(file_path)
+        if os.path.isfile(file_path):
+            result.append(file_path)
 
     return result
 
 
-def scan_directory(pattern: str,chunk_size=1024, chunk_overlap=100) -> List[List[Document]]:
+class ScanResult(NamedTuple):
+    """
+    The outcome of parsing a single file (or URL)
+    """
+    file_path: str
+    docs: List[Document]
+    seconds: float
+    error: Optional[str] = None
+    strategy: Optional[str] = None
+
+
+def scan_directory(pattern: str,chunk_size=1024, chunk_overlap=100, workers=1,
+                   strategies: Dict[str, str] = None) -> List[List[Document]]:
     """
     Retrieve structured data from a directory
     :param pattern: Pattern to match e.g. 'data/*.txt'
+    :param workers: Number of processes to parse with (1 parses in this process)
     :return: List of Document objects
     """
+    return scan_files(find_files(pattern), chunk_size=chunk_size, chunk_overlap=chunk_overlap, workers=workers,
+                      strategies=strategies)
 
-    result: List[List[Document]] = []
+def scan_files(file_paths: List[str], chunk_size=1024, chunk_overlap=100, workers=1,
+               strategies: Dict[str, str] = None) -> List[List[Document]]:
+    """
+    Retrieve structured data from a list of files
+    :param file_paths: List of file paths
+    :param workers: Number of processes to parse with (1 parses in this process)
+    :return: List of Document objects (one list per file, in the same order).
+             A file that fails to parse yields an empty list.
+    """
+    return [
+        result.docs for result in scan_files_timed(
+            file_paths, chunk_size=chunk_size, chunk_overlap=chunk_overlap, workers=workers,
+            strategies=strategies,
+        )
+    ]
+
+def iter_scan_directory(pattern: str, chunk_size=1024, chunk_overlap=100, workers=1,
+                        strategies: Dict[str, str] = None) -> Iterator[ScanResult]:
+    """
+    Lazily retrieve structured data from a directory, see iter_scan_files.
+    :param pattern: Pattern to match e.g. 'data/*.txt'
+    :param workers: Number of processes to parse with (1 parses in this process)
+    :return: Generator of ScanResult
+    """
+    return iter_scan_files(find_files(pattern), chunk_size=chunk_size, chunk_overlap=chunk_overlap, workers=workers,
+                           strategies=strategies)
 
-    for file_path in find_files(pattern):
-        result.append(process_file_data(file_path,chunk_overlap=chunk_overlap,chunk_size=chunk_size))
+def scan_files_timed(file_paths: List[str], chunk_size=1024, chunk_overlap=100, workers=1,
+                     strategies: Dict[str, str] = None) -> List[ScanResult]:
+    """
+    Parse a list of files, optionally in parallel using a process pool. A
+    failure in one file does not affect the others.
+    :param file_paths: List of file paths
+    :param workers: Number of processes to parse with (1 parses in this process)
+    :return: List of ScanResult (in the same order as file_paths)
+    """
+    return list(iter_scan_files(file_paths, chunk_size=chunk_size, chunk_overlap=chunk_overlap, workers=workers,
+                                strategies=strategies))
 
-    return result
+def iter_scan_files(file_paths: List[str], chunk_size=1024, chunk_overlap=100, workers=1,
+                    strategies: Dict[str, str] = None) -> Iterator[ScanResult]:
+    """
+    Lazily parse a list of files, optionally in parallel using a process pool.
+    At most 2 * workers files are parsed ahead of the consumer, so memory is
+    bounded by the window and not by the number of files.
+    :param file_paths: List of file paths
+    :param workers: Number of processes to parse with (1 parses in this process)
+    :return: Generator of ScanResult (in the same order as file_paths)
+    """
+    if workers <= 1 or len(file_paths) <= 1:
+        for file_path in file_paths:
+            yield scan_file(file_path, chunk_size, chunk_overlap, strategies)
+
+        return
+
+    window = 2 * workers
+    pending: Deque[Future] = deque()
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(file_paths))) as executor:
+        try:
+            for file_path in file_paths:
+                pending.append(executor.submit(scan_file, file_path, chunk_size, chunk_overlap, strategies))
+
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+
+            while len(pending) > 0:
+                yield pending.popleft().result()
+        finally:
+            # Consumer stopped early, do not parse what is left
+            for future in pending:
+                future.cancel()
+
+def scan_file(file_path: str, chunk_size=1024, chunk_overlap=100, strategies: Dict[str, str] = None) -> ScanResult:
+    """
+    Parse a single file, timing it and capturing any error
+    :param file_path: Path to the file
+    :param strategies: Parse strategy per file extension, defaults to parse_strategies
+    :return: ScanResult
+    """
+    start = time.perf_counter()
+    strategy = parse_strategy(file_path, strategies)
+
+    try:
+        docs, strategy = parse_file_data(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                         strategies=strategies)
+    except Exception as e:
+        return ScanResult(file_path, [], time.perf_counter() - start, f"{type(e).__name__}: {e}", strategy)
+
+    return ScanResult(file_path, docs, time.perf_counter() - start, strategy=strategy)
+
+def scan_file_in_pool(file_path: str, chunk_size=1024, chunk_overlap=100, strategies: Dict[str, str] = None,
+                      workers=1) -> ScanResult:
+    """
+    Parse a single file in a process pool shared by the callers (created on
+    first use), so that the parsing does not hold the GIL of this process,
+    e.g. while a server answers chats.
+    :param file_path: Path to the file
+    :param strategies: Parse strategy per file extension, defaults to parse_strategies
+    :param workers: Number of processes of the pool, when it is created
+    :return: ScanResult
+    """
+    global _scan_pool
+
+    start = time.perf_counter()
+
+    with _scan_pool_lock:
+        if _scan_pool is None:
+            _scan_pool = ProcessPoolExecutor(max_workers=workers)
+
+        pool = _scan_pool
+
+    try:
+        return pool.submit(scan_file, file_path, chunk_size, chunk_overlap, strategies).result()
+    except BrokenProcessPool as e:
+        # A parser process died (e.g. out of memory), the next file gets a new pool
+        with _scan_pool_lock:
+            if _scan_pool is pool:
+                _scan_pool = None
+
+        return ScanResult(file_path, [], time.perf_counter() - start, f"{type(e).__name__}: {e}",
+                          parse_strategy(file_path, strategies))
 
 def scan_urls(urls: List[str], chunk_size=1024, chunk_overlap=100) -> List[List[Document]]:
     """
@@ -45,12 +208,26 @@ def scan_urls(urls: List[str], chunk_size=1024, chunk_overlap=100) -> List[List[
     :param urls: List of URLs
     :return: List of Document objects
     """
-    result: List[List[Document]] = []
+    return [
+        result.docs for result in iter_scan_urls(urls, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    ]
 
+def iter_scan_urls(urls: List[str], chunk_size=1024, chunk_overlap=100) -> Iterator[ScanResult]:
+    """
+    Lazily retrieve structured data from a list of URLs, one URL at a time.
+    :param urls: List of URLs
+    :return: Generator of ScanResult (file_path is the URL)
+    """
     for url in urls:
-        result.append(process_url_data(url, chunk_size=chunk_size, chunk_overlap=chunk_overlap))
+        start = time.perf_counter()
 
-    return result
+        try:
+            docs = process_url_data(url, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        except Exception as e:
+            yield ScanResult(url, [], time.perf_counter() - start, f"{type(e).__name__}: {e}")
+            continue
+
+        yield ScanResult(url, docs, time.perf_counter() - start)
 
 def process_url_data(url: str, chunk_size=1024, chunk_overlap=100) -> List[Document]:
     """
@@ -69,31 +246,96 @@ def process_url_data(url: str, chunk_size=1024, chunk_overlap=100) -> List[Docum
     
     return handle_elements(url, docs)
 
-def process_file_data(file_path: str, chunk_size=1024, chunk_overlap=100) -> List[Document]:
+def process_file_data(file_path: str, chunk_size=1024, chunk_overlap=100,
+                      strategies: Dict[str, str] = None) -> List[Document]:
     """
     Retrieve structured data from a file
     :param file_path: Path to the file
+    :param strategies: Parse strategy per file extension, defaults to parse_strategies
     :return: List of Document objects
     """
+    docs, _ = parse_file_data(file_path, chunk_size=chunk_size, chunk_overlap=chunk_overlap, strategies=strategies)
+
+    return docs
+
+def parse_file_data(file_path: str, chunk_size=1024, chunk_overlap=100,
+                    strategies: Dict[str, str] = None) -> Tuple[List[Document], str]:
+    """
+    Retrieve structured data from a file using the parse strategy for its type
+    :param file_path: Path to the file
+    :param strategies: Parse strategy per file extension, defaults to parse_strategies
+    :return: List of Document objects and the strategy that was used
+    """
 
     mode = "single"
+    strategy = parse_strategy(file_path, strategies)
 
-    loader = UnstructuredFileLoader(
-        file_path=file_path,
-        strategy="hi-res",  # other option:"fast"
-        mode=mode,  # single (default), elements, paged (for PDFs)
-        post_processors=[clean_extra_whitespace],
-    )
+    if strategy == "text":
+        docs = load_text_file(file_path)
+    elif strategy == "pdf":
+        strategy = "fast"
+        docs = load_unstructured_file(file_path, strategy=strategy, mode=mode)
 
-    docs = loader.load()
+        # No text layer (scanned), needs layout detection and OCR
+        if len("".join(doc.page_content for doc in docs).strip()) < min_pdf_text_chars:
+            strategy = "hi_res"
+            docs = load_unstructured_file(file_path, strategy=strategy, mode=mode)
+    else:
+        docs = load_unstructured_file(file_path, strategy=strategy, mode=mode)
 
     if mode == "single":
         if file_path.endswith(".md"):
-            return handle_single_md(docs, file_path=file_path)
+            return handle_single_md(docs, file_path=file_path), strategy
+
+        return handle_single_text(file_path, docs, chunk_size, chunk_overlap), strategy
 
-        return handle_single_text(file_path, docs, chunk_size, chunk_overlap)
+    return handle_elements(file_path, docs), strategy
+
+def parse_strategy(file_path: str, strategies: Dict[str, str] = None) -> str:
+    """
+    Get the parse strategy for a file
+    :param file_path: Path to the file
+    :param strategies: Parse strategy per file extension, defaults to parse_strategies
+    :return: The strategy (text, fast, hi_res or pdf)
+    """
+    extension = os.path.splitext(file_path)[1].lower()
+
+    return (strategies or parse_strategies).get(extension, default_parse_strategy)
+
+def load_text_file(file_path: str) -> List[Document]:
+    """
+    Read a text file, with the extra whitespace of each paragraph removed (markdown
+    is kept verbatim so its headers can be split on)
+    :param file_path: Path to the file
+    :return: List with a single Document
+    """
+    with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+        text = f.read()
+
+    # Cleaned per paragraph, clean_extra_whitespace would join the paragraphs as well
+    if not file_path.endswith(".md"):
+        text = "\n\n".join(
+            clean_extra_whitespace(paragraph) for paragraph in re.split(r"\n\s*\n", text) if paragraph.strip()
+        )
+
+    return [Document(page_content=text, metadata={"source": file_path})]
+
+def load_unstructured_file(file_path: str, strategy: str, mode: str) -> List[Document]:
+    """
+    Read a file using Unstructured
+    :param file_path: Path to the file
+    :param strategy: Unstructured strategy (fast or hi_res)
+    :param mode: single (default), elements, paged (for PDFs)
+    :return: List of Document objects
+    """
+    loader = UnstructuredFileLoader(
+        file_path=file_path,
+        strategy=strategy,
+        mode=mode,
+        post_processors=[clean_extra_whitespace],
+    )
 
-    return handle_elements(file_path, docs)
+    return loader.load()
 
 def handle_elements(file_path: str, docs: List[Document]) -> List[Document]:
     """
@@ -0,0 +1,118 @@
+import time
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+from metrics import TurnMetrics
+
+
+class TokenCoalescer:
+    """
+    Streams tokens in frames instead of one by one. The first token is sent
+    right away (time to first token is unchanged), later tokens are buffered
+    and sent together when the oldest of them has waited `window` seconds or
+    the buffer reaches `max_bytes`, whichever comes first. This saves a
+    websocket frame and an event loop round-trip per token when the model
+    streams fast.
+
+    Tokens are pushed by a single task (the turn), frames are sent in order.
+    """
+    window: float
+    max_bytes: int
+    # Frames sent and the longest a token waited in the buffer
+    frames: int
+    max_delay: float
+
+    def __init__(self,
+                 send: Callable[[str], Awaitable[None]],
+                 window=0.04,
+                 max_bytes=512,
+                 turn: TurnMetrics = None,
+                 ):
+        """
+        Constructor
+        :param send: Sends a frame (e.g. cl.Message.stream_token).
+        :param window: Max seconds a token is held back.
+        :param max_bytes: A frame is sent when it reaches this size (UTF-8).
+        :param turn: Optional turn the frame count and delay are recorded on.
+        """
+        self.window = window
+        self.max_bytes = max_bytes
+        self.frames = 0
+        self.max_delay = 0.0
+
+        self._send = send
+        self._turn = turn
+        self._buffer: List[str] = []
+        self._bytes = 0
+        self._buffered_at = 0.0
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._error: Optional[BaseException] = None
+
+    async def push(self, token: str):
+        """
+        Adds a token, sent now, with the next frame or when the window closes
+        """
+        self._raise()
+
+        if len(token) == 0:
+            return
+
+        if len(self._buffer) == 0:
+            self._buffered_at = time.perf_counter()
+
+        self._buffer.append(token)
+        self._bytes += len(token.encode("utf-8"))
+
+        if self.frames == 0 or self._bytes >= self.max_bytes:
+            await self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_after(self.window))
+
+    async def flush(self):
+        """
+        Sends the buffered tokens as one frame
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        async with self._lock:
+            if len(self._buffer) == 0:
+                return
+
+            frame = "".join(self._buffer)
+            delay = time.perf_counter() - self._buffered_at
+
+            self._buffer = []
+            self._bytes = 0
+            self.frames += 1
+            self.max_delay = max(self.max_delay, delay)
+
+            await self._send(frame)
+
+    async def close(self):
+        """
+        Sends what is left and records the frames on the turn
+        """
+        await self.flush()
+        self._raise()
+
+        if self._turn is not None:
+            self._turn.stream_frames = self.frames
+            self._turn.stream_flush_delay = self.max_delay
+
+    async def _flush_after(self, delay: float):
+        await asyncio.sleep(delay)
+        # Done waiting, must not be cancelled by its own flush
+        self._timer = None
+
+        try:
+            await self.flush()
+        except Exception as e:
+            # Raised to the pushing task on its next push or close
+            self._error = e
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
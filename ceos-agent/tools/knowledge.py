@@ -0,0 +1,36 @@
+from langchain.schema.runnable import Runnable
+from langchain.tools import BaseTool
+from pydantic import BaseModel, Field
+from typing import Optional, Type
+
+
+class KnowledgeInput(BaseModel):
+    query: str = Field(..., description="What to look up, a standalone question or keywords")
+
+
+class KnowledgeTool(BaseTool):
+    """
+    Searches the indexed documents (see EmbeddingsDb) through the retriever
+    of a chain, as the owner of the session. A BaseTool, a StructuredTool
+    without a coroutine runs _run on a thread even when called async.
+    """
+    name: str = "SearchKnowledgeBase"
+    description: str = (
+        "Searches the CEOS documentation, training material and the files uploaded by the user. "
+        "Use it for questions about CEOS, HVAC equipment, onboarding, configuration or the uploads."
+    )
+    args_schema: Type[BaseModel] = KnowledgeInput
+    # Takes a chain message (question, owner) and returns the context messages
+    retriever: Runnable
+    owner: Optional[str] = None
+
+    def _run(self, query: str) -> str:
+        return self.format(self.retriever.invoke({"question": query, "owner": self.owner}))
+
+    async def _arun(self, query: str) -> str:
+        return self.format(await self.retriever.ainvoke({"question": query, "owner": self.owner}))
+
+    def format(self, messages: list) -> str:
+        text = "\n\n".join(message.content for message in messages)
+
+        return text if len(text) > 0 else "Nothing found."
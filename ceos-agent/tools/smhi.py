@@ -1,7 +1,7 @@
 import requests
 import aiohttp
 from requests.exceptions import HTTPError
-from langchain.tools import StructuredTool
+from langchain.tools import BaseTool
 from pydantic import BaseModel, Field
 from typing import Optional, Type
 
@@ -15,7 +15,7 @@ class ForecastOutput(BaseModel):
     wind_speed: Optional[float] = Field(None, description="Wind speed in meters per second")
     precipitation: Optional[float] = Field(None, description="Precipitation in millimeters")
 
-class ForecastTool(StructuredTool):
+class ForecastTool(BaseTool):
     name: str = "GetWeatherForecast"
     description: str = "Useful when you need to answer a question about weather in a specific location."
     args_schema: Type[BaseModel] = ForecastInput
@@ -45,7 +45,7 @@ class ForecastTool(StructuredTool):
                     forecast = await response.json()
                     return self.extract_weather_info(forecast=forecast)
                 else:
-                    raise HTTPError(f'Unexpected status code: {response.status_code}')
+                    raise HTTPError(f'Unexpected status code: {response.status}')
 
     def extract_weather_info(self, forecast: dict) -> ForecastOutput:                
         if 'timeSeries' in forecast and len(forecast['timeSeries']) > 0:
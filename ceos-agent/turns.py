@@ -0,0 +1,105 @@
+import asyncio
+from typing import Awaitable, Callable, List, Optional
+from langchain.schema.runnable import RunnableConfig
+from chains.base import BaseChain
+from answer_cache import SemanticAnswerCache, replay_tokens
+from metrics import start_turn, TurnCallbackHandler
+from streaming import TokenCoalescer
+
+
+async def run_turn(
+        chain: BaseChain,
+        question: str,
+        owner: str,
+        stream_token: Callable[[str], Awaitable[None]],
+        answer_cache: SemanticAnswerCache = None,
+        callbacks: Optional[List] = None,
+        stream_window: Optional[float] = None,
+        stream_bytes=512,
+) -> str:
+    """
+    Answers a question of a session (app.on_message without the UI), the
+    answer is streamed token by token.
+    :param chain: The chain of the session.
+    :param question: The question.
+    :param owner: The owner of the session (see app.session_owner).
+    :param stream_token: Gets each token of the answer.
+    :param answer_cache: Optional cache answers are served from and stored in.
+    :param callbacks: Optional callbacks of the chain run.
+    :param stream_window: When set, tokens are coalesced into frames sent at
+                          most this many seconds apart (see TokenCoalescer).
+    :param stream_bytes: Frame size sent without waiting for the window.
+    :return: The answer
+    """
+    turn = start_turn(chain.name, chain.model.model_name)
+    coalescer = None
+
+    if stream_window is not None:
+        coalescer = TokenCoalescer(stream_token, window=stream_window, max_bytes=stream_bytes, turn=turn)
+        stream_token = coalescer.push
+
+    chain_message = chain.before({
+        "question": question,
+        "owner": owner,
+    })
+
+    cacheable = answer_cache is not None and chain.cacheable(chain_message)
+    loop = asyncio.get_running_loop()
+    answer = None
+    cached = False
+
+    # Taken before answering, so that an answer to what was searched is not stored as newer
+    namespace = chain.cache_namespace(chain_message) if cacheable else None
+    generation = chain.cache_generation(chain_message) if cacheable else 0
+
+    if cacheable:
+        answer = await loop.run_in_executor(None, answer_cache.lookup, namespace, question, generation)
+        cached = answer is not None
+
+    try:
+        if cached:
+            print(f"*** ANSWER CACHE HIT: {answer_cache.stats} ***")
+
+            if turn is not None:
+                turn.cached = True
+
+            for token in replay_tokens(answer):
+                if turn is not None:
+                    turn.token()
+
+                await stream_token(token)
+        else:
+            callbacks = list(callbacks or [])
+            outputs: List[str] = []
+
+            if turn is not None:
+                callbacks.append(TurnCallbackHandler(turn))
+
+            async for chunk in chain.chain().astream(
+                input=chain_message,
+                config=RunnableConfig(callbacks=callbacks),
+            ):
+                chunk = chain.chunk(chunk)
+                output = chain.get_output(chunk)
+
+                if turn is not None and len(output) > 0:
+                    turn.token()
+
+                outputs.append(output)
+                await stream_token(output)
+
+            answer = "".join(outputs)
+    finally:
+        # What was streamed so far is sent, even when the turn failed
+        if coalescer is not None:
+            await coalescer.close()
+
+    if cacheable and not cached:
+        await loop.run_in_executor(None, answer_cache.store, namespace, question, answer, generation)
+
+    chain.after(answer)
+
+    if turn is not None:
+        turn.finish(answer)
+
+    return answer
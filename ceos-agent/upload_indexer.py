@@ -0,0 +1,90 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator
+from embeddingsdb import EmbeddingsDb
+from index import add_file_to_user_index
+
+
+class UploadJob:
+    """
+    A queued upload, progress messages are delivered on the event loop
+    that submitted the job.
+    """
+    file_name: str
+    events: asyncio.Queue
+    future: asyncio.Future
+
+    _done = object()
+
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.events = asyncio.Queue()
+
+    async def progress(self) -> AsyncIterator[str]:
+        """
+        Yields the progress messages until the job is done.
+        :return: Async generator of progress messages
+        """
+        while True:
+            message = await self.events.get()
+
+            if message is self._done:
+                return
+
+            yield message
+
+    async def result(self) -> bool:
+        """
+        Waits for the job to finish.
+        :return: True if the file was indexed, False otherwise
+        """
+        return await self.future
+
+
+class UploadIndexer:
+    """
+    Indexes uploaded files on a background worker so that parsing and
+    embedding never runs on the event loop. Only the uploaded file is
+    indexed. Jobs are processed in the order they were submitted.
+    """
+    embeddings_db: EmbeddingsDb
+    executor: ThreadPoolExecutor
+
+    def __init__(self, embeddings_db: EmbeddingsDb, workers=1):
+        """
+        Constructor
+        :param embeddings_db: The embeddings database to index into.
+        :param workers: Number of uploads indexed concurrently.
+        """
+        self.embeddings_db = embeddings_db
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload-indexer")
+
+    def submit(self, file_name: str, content: bytes | str | None, owner: str = None) -> UploadJob:
+        """
+        Queues an uploaded file for indexing. Must be called from the event loop.
+        :param file_name: The name of the uploaded file.
+        :param content: The content of the uploaded file.
+        :param owner: Optional owner (user or session) of the upload.
+        :return: The job, use progress() to follow it.
+        """
+        loop = asyncio.get_running_loop()
+        job = UploadJob(file_name)
+
+        def progress(message: any):
+            loop.call_soon_threadsafe(job.events.put_nowait, message)
+
+        def run() -> bool:
+            try:
+                return add_file_to_user_index(file_name, self.embeddings_db, content, progress=progress, owner=owner)
+            except Exception as e:
+                progress(f"Failed to index: {type(e).__name__}: {e}")
+                return False
+            finally:
+                progress(UploadJob._done)
+
+        job.future = loop.run_in_executor(self.executor, run)
+
+        return job
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)